@@ -0,0 +1,435 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  AsyncConnectionHandler.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import aiohttp
+import asyncio
+import logging
+import json
+
+from base64 import b64encode
+from inspect import isawaitable
+from time import monotonic
+from uuid import uuid4
+from .ConnectionHandler import (
+    REGISTER_PAYLOAD, DEFAULT_POOL_MAXSIZE, DEFAULT_IDLE_TIMEOUT,
+    renewalMargin, parseNotification, getSubscriptionRequestMessage,
+    loadCredentials, saveCredentials)
+from .Decoder import decode
+from .Exceptions import *
+
+
+class AsyncConnectionHandler:
+    """
+    This is the asyncio counterpart of the ConnectionHandler class:
+    HTTP requests and websockets towards SEPA are coroutines running
+    on a single event loop, so that no thread is needed.
+    """
+    def __init__(self, client_id=None, logLevel = 10,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, credentials_file=None):
+        """
+        Constructor of the AsyncConnectionHandler class.
+        'pool_maxsize', 'idle_timeout' and 'credentials_file' have the
+        same meaning they have in ConnectionHandler.
+        """
+        # logger configuration
+        self.logger = logging.getLogger("sepaLogger")
+        self.logger.setLevel(logLevel)
+        self.logger.debug("=== AsyncConnectionHandler::__init__ invoked ===")
+        # open subscriptions, the websockets shared by the subscriptions
+        # to the same url, and the tasks reading them
+        self.websockets = {}
+        self._sockets = {}
+        self._subscriptionSockets = {}
+        self._sockets_lock = None
+        self._readers = set()
+
+        # secure request objects
+        self.token = None
+        self.token_expiry = None
+        self.token_margin = 0
+        self.client_secret = None
+        self.client_id = client_id if client_id else str(uuid4())
+        self.credentials_file = credentials_file
+        self._auth_lock = None
+        if credentials_file is not None:
+            credentials = loadCredentials(credentials_file)
+            if (credentials is not None) and (
+                    client_id is None or credentials["client_id"] == client_id):
+                self.client_id = credentials["client_id"]
+                self.client_secret = credentials["client_secret"]
+
+        # the aiohttp session is bound to the running loop, so it is
+        # created on first use
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self.session = None
+
+    def get_client_id(self):
+        """
+        Getter for the client_id parameter.
+        """
+        return self.client_id
+
+    def _get_session(self):
+        if (self.session is None) or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=0, limit_per_host=self.pool_maxsize,
+                    keepalive_timeout=self.idle_timeout))
+        return self.session
+
+    async def _post(self, reqURI, headers, data=None, ssl=True, raw=False):
+        async with self._get_session().post(
+                reqURI, headers=headers, data=data, ssl=ssl) as r:
+            return r.status, await (r.read() if raw else r.text())
+
+    async def close(self):
+        """
+        Closes the open websockets and the HTTP connections.
+        """
+        self.logger.debug("=== AsyncConnectionHandler::close invoked ===")
+        for socket in list(self._sockets.values()):
+            await socket.ws.close()
+        if self._readers:
+            await asyncio.gather(*self._readers, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def unsecureRequest(self, reqURI, sparql, isQuery, raw=False):
+        """
+        Coroutine to issue a SPARQL request over HTTP.
+        See ConnectionHandler.unsecureRequest
+        """
+        self.logger.debug("=== AsyncConnectionHandler::unsecureRequest invoked ===")
+        headers = {
+            "Content-Type":"application/sparql-query" if isQuery else "application/sparql-update",
+            "Accept":"application/sparql-results+json"}
+        return await self._post(reqURI, headers, data=sparql, raw=raw)
+
+    async def secureRequest(self, reqURI, sparql, isQuery, registerURI, tokenURI,
+                            raw=False):
+        """
+        Coroutine to issue a SPARQL request over HTTPS.
+        See ConnectionHandler.secureRequest
+        """
+        self.logger.debug("=== AsyncConnectionHandler::secureRequest invoked ===")
+        token = await self.authorize(registerURI, tokenURI)
+
+        headers = {
+           "Content-Type":"application/sparql-query" if isQuery else "application/sparql-update",
+           "Accept":"application/json",
+           "Authorization": "Bearer " + token}
+        status, text = await self._post(
+            reqURI, headers, data=sparql, ssl=False, raw=raw)
+        if status == 401:
+            # the token expired: renew it, and retry once
+            token = await self.authorize(registerURI, tokenURI, expired=token)
+            headers["Authorization"] = "Bearer " + token
+            status, text = await self._post(
+                reqURI, headers, data=sparql, ssl=False, raw=raw)
+        if status == 401:
+            self.token = None
+            raise TokenExpiredException
+        return status, text
+
+    async def authorize(self, registerURI, tokenURI, expired=None):
+        """
+        Coroutine version of ConnectionHandler.authorize
+        """
+        token = self.token
+        if (token is not None) and (expired is None) and not self._token_expiring():
+            return token
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        async with self._auth_lock:
+            if (self.token is not None) and (self.token != expired) and not self._token_expiring():
+                return self.token
+            if not self.client_secret:
+                await self.register(registerURI)
+                await self.requestToken(tokenURI)
+            else:
+                try:
+                    await self.requestToken(tokenURI)
+                except TokenRequestFailedException:
+                    await self.register(registerURI)
+                    await self.requestToken(tokenURI)
+            return self.token
+
+    def _token_expiring(self):
+        return (self.token_expiry is not None) and (
+            monotonic() > self.token_expiry - self.token_margin)
+
+    async def register(self, registerURI):
+        """
+        Coroutine to perform a registration to SEPA.
+        registerURI is the url to which ask for registration
+        """
+        self.logger.debug("=== AsyncConnectionHandler::register invoked ===")
+        headers = {
+            "Content-Type":"application/json",
+            "Accept":"application/json"}
+        payload = REGISTER_PAYLOAD.format(self.client_id)
+        status, text = await self._post(registerURI, headers, data=payload, ssl=False)
+        if status == 201:
+            jresponse = json.loads(text)["credentials"]
+            self.client_secret = "Basic {}".format(
+                b64encode(bytes(
+                    "{}:{}".format(jresponse["client_id"],jresponse["client_secret"]),
+                    "utf-8")).decode("utf-8"))
+            if self.credentials_file is not None:
+                saveCredentials(
+                    self.credentials_file, self.client_id, self.client_secret)
+        else:
+            self.logger.error("{}: {}".format(status, text))
+            raise RegistrationFailedException
+
+    async def requestToken(self, tokenURI):
+        """
+        Coroutine to ask for a JWT to SEPA.
+        tokenURI is the url to be contacted.
+        """
+        self.logger.debug("=== AsyncConnectionHandler::requestToken invoked ===")
+        headers = {
+            "Content-Type":"application/json",
+            "Accept":"application/json",
+            "Authorization": self.client_secret}
+        status, text = await self._post(tokenURI, headers, ssl=False)
+        if status == 201:
+            jtoken = json.loads(text)["token"]
+            self.token = jtoken["access_token"]
+            self.token_expiry = None
+            if "expires_in" in jtoken:
+                self.token_expiry = monotonic() + float(jtoken["expires_in"])
+                self.token_margin = renewalMargin(jtoken["expires_in"])
+        else:
+            raise TokenRequestFailedException
+
+    async def openWebsocket(self,
+                            subscribeURI, sparql, alias, handler,
+                            registerURI=None, tokenURI=None,
+                            default_graph=None, named_graph=None):
+        """
+        Runs a SEPA subscription on the websocket (ws or wss) shared by
+        the subscriptions to 'subscribeURI', and returns the
+        subscription id once SEPA confirms it.
+        'handler' is called as handler(added, removed) for each
+        notification: it can be a plain function or a coroutine function.
+        'registerURI' and 'tokenURI' are needed for wss only.
+        See ConnectionHandler.openUnsecureWebsocket
+        """
+        self.logger.debug("=== AsyncConnectionHandler::openWebsocket invoked ===")
+        secure = subscribeURI.startswith("wss")
+        token = None
+        if secure:
+            token = await self.authorize(registerURI, tokenURI)
+
+        socket = await self._acquireSocket(subscribeURI, secure)
+        msg = getSubscriptionRequestMessage(
+            sparql, alias, token,
+            default_graph, named_graph)
+        try:
+            subid = await socket.subscribe(msg, handler)
+        finally:
+            socket.users -= 1
+            await self._releaseSocket(socket)
+        self._subscriptionSockets[subid] = socket
+        return subid
+
+    async def _acquireSocket(self, subscribeURI, secure):
+        """
+        Returns the websocket towards 'subscribeURI', opening it if
+        needed, and marks it as used by one more request.
+        """
+        if self._sockets_lock is None:
+            self._sockets_lock = asyncio.Lock()
+        async with self._sockets_lock:
+            socket = self._sockets.get(subscribeURI)
+            if (socket is None) or socket.ws.closed:
+                ws = await self._get_session().ws_connect(
+                    subscribeURI, ssl=not secure)
+                socket = AsyncSubscriptionSocket(self, subscribeURI, ws)
+                self._sockets[subscribeURI] = socket
+                self._readers.add(socket.reader)
+                socket.reader.add_done_callback(self._readers.discard)
+            socket.users += 1
+            return socket
+
+    async def _releaseSocket(self, socket):
+        """
+        Closes 'socket' when no subscription is using it anymore.
+        """
+        if socket.routes or socket.users or socket.unsubscribing:
+            return
+        if self._sockets.get(socket.url) is socket:
+            del self._sockets[socket.url]
+        await socket.ws.close()
+
+    async def closeWebsocket(self, subid):
+        """
+        Sends the unsubscribe request for 'subid': notifications for it
+        are not delivered anymore. The websocket is closed when SEPA
+        confirms, if no other subscription is using it.
+        """
+        self.logger.debug("=== AsyncConnectionHandler::closeWebsocket invoked ===")
+        socket = self._subscriptionSockets.pop(subid)
+        msg = {}
+        msg["unsubscribe"] = {}
+        msg["unsubscribe"]["spuid"] = subid
+        if self.token:
+            msg["unsubscribe"]["authorization"] = "Bearer " + self.token
+        await socket.unsubscribe(subid, msg)
+
+    def get_subscriptions(self):
+        return self.websockets
+
+
+class AsyncSubscriptionSocket:
+    """
+    A websocket towards a SEPA subscription url, shared by all the
+    subscriptions made to that url: the asyncio counterpart of
+    ConnectionHandler.SubscriptionSocket, without reconnection.
+    """
+    def __init__(self, connectionHandler, url, ws, timeout=10):
+        self.logger = logging.getLogger("sepaLogger")
+        self.owner = connectionHandler
+        self.url = url
+        self.ws = ws
+        self.timeout = timeout
+        # the handlers of the active subscriptions, by spuid
+        self.routes = {}
+        # number of subscriptions being requested on this socket
+        self.users = 0
+        # number of unsubscriptions waiting for their confirmation
+        self.unsubscribing = 0
+
+        # subscription requests are sent one at a time: the next
+        # confirmation received belongs to the pending one
+        self._subscribeLock = asyncio.Lock()
+        self._pending = None
+        self.reader = asyncio.ensure_future(self._read())
+
+    async def subscribe(self, msg, handler):
+        """
+        Sends the subscription request 'msg', and returns the spuid
+        once SEPA confirms it.
+        """
+        async with self._subscribeLock:
+            confirmation = asyncio.get_running_loop().create_future()
+            self._pending = (confirmation, handler)
+            await self.ws.send_str(json.dumps(msg))
+            self.logger.debug(msg)
+            self.logger.debug("Waiting for subscription ID")
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(confirmation), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                raise SubscriptionTimeoutException
+            finally:
+                self._pending = None
+
+    async def unsubscribe(self, spuid, msg):
+        """
+        Sends the unsubscription request 'msg' for 'spuid'.
+        """
+        self.routes.pop(spuid, None)
+        self.owner.websockets.pop(spuid, None)
+        self.unsubscribing += 1
+        try:
+            await self.ws.send_str(json.dumps(msg))
+        except Exception as e:
+            # the connection is down: there is nothing to unsubscribe from
+            self.logger.debug(e)
+            await self._unsubscribed()
+
+    async def _unsubscribed(self):
+        self.unsubscribing = max(self.unsubscribing - 1, 0)
+        await self.owner._releaseSocket(self)
+
+    async def _read(self):
+        """
+        Reads the notifications of the subscriptions until the websocket
+        is closed.
+        """
+        try:
+            async for message in self.ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                self.logger.debug(message.data)
+                await self.on_message(decode(message.data))
+        finally:
+            self.logger.debug("=== AsyncSubscriptionSocket::_read closed ===")
+            if self.owner._sockets.get(self.url) is self:
+                del self.owner._sockets[self.url]
+            for spuid in self.routes:
+                self.owner.websockets.pop(spuid, None)
+                self.owner._subscriptionSockets.pop(spuid, None)
+            self.routes = {}
+            if (self._pending is not None) and not self._pending[0].done():
+                self._pending[0].set_exception(
+                    SubscriptionFailedException("websocket closed"))
+
+    async def on_message(self, jmessage):
+        if "unsubscribed" in jmessage:
+            await self._unsubscribed()
+            return
+        if "error" in jmessage:
+            self.on_broker_error(jmessage)
+            return
+        if "notification" not in jmessage:
+            self.logger.warning("Unexpected message: {}".format(jmessage))
+            return
+        notification = jmessage["notification"]
+        spuid = notification["spuid"]
+        handler = self.routes.get(spuid)
+        if (notification["sequence"] == 0) and (self._pending is not None):
+            # subscription confirmation
+            confirmation, handler = self._pending
+            if not confirmation.done():
+                self.routes[spuid] = handler
+                self.owner.websockets[spuid] = self.ws
+                confirmation.set_result(spuid)
+        if handler is None:
+            return
+        added, removed = parseNotification(notification)
+        try:
+            result = handler(added, removed)
+            if isawaitable(result):
+                await result
+        except Exception as e:
+            self.logger.error("Subscription handler error: {}".format(e))
+
+    def on_broker_error(self, jmessage):
+        """
+        An error sent by SEPA: it is the answer to the pending
+        subscription request, if any, which fails at once.
+        """
+        error = jmessage["error"]
+        if isinstance(error, dict):
+            error = error.get("message", error)
+        if "error_description" in jmessage:
+            error = "{}: {}".format(error, jmessage["error_description"])
+        if (self._pending is None) or self._pending[0].done():
+            self.logger.error("SEPA error: {}".format(error))
+            return
+        self._pending[0].set_exception(SubscriptionFailedException(error))
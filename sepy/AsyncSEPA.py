@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  AsyncSEPA.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .AsyncConnectionHandler import *
+from .Decoder import decode
+
+from urllib.parse import urlparse
+
+import logging
+import json
+
+
+class AsyncSEPA:
+    """
+    The asyncio counterpart of the SEPA class. query, update and
+    subscription methods are coroutines, sharing the same connections.
+    Requires the 'aiohttp' package.
+    """
+    def __init__(self, sapObject=None, client_id=None, logLevel=logging.ERROR,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, credentials_file=None):
+        """
+        Constructor for asynchronous SEPA engine representation.
+        Parameters are the same of the SEPA class.
+        """
+        # logger configuration
+        self.logger = logging.getLogger("sepaLogger")
+        self.logger.setLevel(logLevel)
+        logging.basicConfig(format='%(levelname)s:%(message)s', level=logLevel)
+        self.logger.debug("=== AsyncSEPA::__init__ invoked ===")
+
+        # initialize data structures
+        self.sap = sapObject
+        self.connectionManager = AsyncConnectionHandler(
+            client_id=client_id, logLevel=logLevel,
+            pool_maxsize=pool_maxsize, idle_timeout=idle_timeout,
+            credentials_file=credentials_file)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def get_client_id(self):
+        """
+        Retrieves the current client_id.
+        """
+        return self.connectionManager.get_client_id()
+
+    def get_subscriptions(self):
+        """
+        Getter for subscriptions currently opened, in a dict form
+        """
+        return self.connectionManager.get_subscriptions()
+
+    def setSAP(self, sapObject):
+        """
+        Setter of sapObject at runtime.
+        """
+        self.sap = sapObject
+
+    async def close(self):
+        """
+        Closes subscriptions and connections towards SEPA.
+        """
+        await self.connectionManager.close()
+
+    def _oauth_urls(self, token_url, register_url):
+        if self.sap is None and (token_url is None or register_url is None):
+            raise ValueError("Token and Register URL must not be None if no SAPObject is given to SEPA instance")
+        sepa_token = self.sap.tokenRequest_url if (token_url is None) else token_url
+        sepa_register = self.sap.registration_url if (register_url is None) else register_url
+        return sepa_token, sepa_register
+
+    async def _request(self, sepa_host, sparql, isQuery, token_url, register_url,
+                       raw=False):
+        protocol = urlparse(sepa_host).scheme
+        if protocol == "https":
+            sepa_token, sepa_register = self._oauth_urls(token_url, register_url)
+            return await self.connectionManager.secureRequest(
+                sepa_host, sparql, isQuery, sepa_register, sepa_token, raw=raw)
+        elif protocol == "http":
+            return await self.connectionManager.unsecureRequest(
+                sepa_host, sparql, isQuery, raw=raw)
+        else:
+            raise NotImplementedError("Still only http, https, ws, wss protocols are implemented")
+
+    async def query(self, sapIdentifier, forcedBindings={}, destination=None,
+                    host=None, token_url=None, register_url=None):
+        """
+        Coroutine version of SEPA.query
+        """
+        sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
+        return await self.sparql_query(
+            sparql, destination=destination,
+            host=host, token_url=token_url, register_url=register_url)
+
+    async def sparql_query(self, sparql, destination=None, host=None,
+                           token_url=None, register_url=None):
+        """
+        Coroutine version of SEPA.sparql_query
+        """
+        if self.sap is None and host is None:
+            raise ValueError("Host parametrization is necessary if no SAPObject is given to SEPA instance")
+        sepa_host = self.sap.query_url if (host is None) else host
+        status, results = await self._request(
+            sepa_host, sparql, True, token_url, register_url, raw=True)
+        if int(status) == 200:
+            jresults = decode(results)
+            if "error" in jresults:
+                error_message = jresults["error"]["message"]
+                self.logger.error(error_message)
+                raise ValueError(error_message)
+            elif destination is not None:
+                with open(destination, "w") as fileDest:
+                    print(json.dumps(jresults), file=fileDest)
+            return jresults
+        else:
+            error_message = "Query status code: {}".format(status)
+            self.logger.error(error_message)
+            raise ValueError(error_message)
+
+    async def update(self, sapIdentifier, forcedBindings={},
+                     host=None, token_url=None, register_url=None):
+        """
+        Coroutine version of SEPA.update
+        """
+        sparql = self.sap.getUpdate(sapIdentifier, forcedBindings)
+        return await self.sparql_update(sparql, host=host, token_url=token_url,
+                                        register_url=register_url)
+
+    async def sparql_update(self, sparql, host=None, token_url=None, register_url=None):
+        """
+        Coroutine version of SEPA.sparql_update
+        """
+        if self.sap is None and host is None:
+            raise ValueError("Host parametrization is necessary if no SAPObject is given to SEPA instance")
+        sepa_host = self.sap.update_url if (host is None) else host
+        status, results = await self._request(
+            sepa_host, sparql, False, token_url, register_url)
+        if int(status) == 200:
+            return results
+        else:
+            self.logger.error(results)
+            raise ValueError(results)
+
+    async def clear(self, host=None, token_url=None, register_url=None):
+        """
+        Coroutine version of SEPA.clear
+        """
+        return await self.sparql_update(
+            "delete where {?a ?b ?c}", host=host,
+            token_url=token_url, register_url=register_url)
+
+    async def query_all(self, destination=None, host=None,
+                        token_url=None, register_url=None):
+        """
+        Coroutine version of SEPA.query_all
+        """
+        return await self.sparql_query(
+            "select * where {?a ?b ?c}", destination=destination,
+            host=host, token_url=token_url, register_url=register_url)
+
+    async def sparql_subscribe(self, sparql, alias, handler=lambda a, r: None,
+                               host=None, token_url=None, register_url=None,
+                               default_graph=None, named_graph=None):
+        """
+        Coroutine version of SEPA.sparql_subscribe: 'handler' can also be
+        a coroutine function.
+        Returns the subscription id.
+        """
+        if self.sap is None and host is None:
+            raise ValueError("Host parametrization is necessary if no SAPObject is given to SEPA instance")
+        sepa_host = self.sap.subscribe_url if (host is None) else host
+        protocol = urlparse(sepa_host).scheme
+
+        def_graph = None
+        if default_graph is not None:
+            def_graph = default_graph
+        elif self.sap is not None and "default-graph-uri" in self.sap.graphs.keys():
+            def_graph = self.sap.graphs["default-graph-uri"]
+        nam_graph = None
+        if named_graph is not None:
+            nam_graph = named_graph
+        elif self.sap is not None and "named-graph-uri" in self.sap.graphs.keys():
+            nam_graph = self.sap.graphs["named-graph-uri"]
+
+        if protocol == "wss":
+            sepa_token, sepa_register = self._oauth_urls(token_url, register_url)
+            return await self.connectionManager.openWebsocket(
+                sepa_host, sparql, alias, handler,
+                registerURI=sepa_register, tokenURI=sepa_token,
+                default_graph=def_graph, named_graph=nam_graph)
+        elif protocol == "ws":
+            return await self.connectionManager.openWebsocket(
+                sepa_host, sparql, alias, handler,
+                default_graph=def_graph, named_graph=nam_graph)
+        else:
+            raise NotImplementedError("Still only http, https, ws, wss protocols are implemented")
+
+    async def subscribe(self, sapIdentifier, alias, forcedBindings={},
+                        handler=lambda a, r: None,
+                        host=None, token_url=None, register_url=None,
+                        default_graph=None, named_graph=None):
+        """
+        Coroutine version of SEPA.subscribe
+        """
+        sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
+        return await self.sparql_subscribe(
+            sparql, alias, handler, host=host,
+            token_url=token_url, register_url=register_url,
+            default_graph=default_graph, named_graph=named_graph)
+
+    async def unsubscribe(self, subid):
+        """
+        Closes the subscription, given the subscription id
+        """
+        await self.connectionManager.closeWebsocket(subid)
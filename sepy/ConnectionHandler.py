@@ -23,42 +23,110 @@
 #  
 #  
 
-import requests
 import logging
 import json
 import sys
+import os
 
-from ssl import CERT_NONE
-from websocket import WebSocketApp
 from base64 import b64encode
-from time import sleep
-from threading import Thread, Event
+from time import sleep, monotonic
+from threading import Thread, Event, Lock, RLock, Timer, current_thread
+from urllib.parse import urlparse
 from uuid import uuid4
+from random import uniform
 from .Exceptions import *
+from .Results import BindingSet
+from .Decoder import decode
+from .Metrics import NULL_METRICS, OPERATIONS_TOTAL
 
 
 REGISTER_PAYLOAD = """{{ "register": {{ "client_identity": "{}", "grant_types":["client_credentials"] }} }}"""
 
+# keep-alive connection pool defaults
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_IDLE_TIMEOUT = 60
+
+# seconds before expiration at which a JWT is renewed (at most half of
+# its lifetime, see renewalMargin)
+TOKEN_RENEWAL_MARGIN = 10
+
+# websocket reconnection backoff, in seconds
+RECONNECT_BASE_DELAY = 0.5
+DEFAULT_MAX_BACKOFF = 30
+
 class ConnectionHandler:
     """
     This is the ConnectionHandler class, responsible for connections
     towards SEPA: HTTP and Websockets.
     """
-    def __init__(self, client_id=None, logLevel = 10):
-        """Constructor of the ConnectionHandler class"""
+    def __init__(self, client_id=None, logLevel = 10,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 credentials_file=None, token_refresh=True,
+                 reconnect=False, max_backoff=DEFAULT_MAX_BACKOFF,
+                 dispatcher=None, metrics=None):
+        """
+        Constructor of the ConnectionHandler class.
+        'pool_maxsize' is the number of keep-alive connections kept open
+        towards each host.
+        'idle_timeout' is the number of seconds after which the connections
+        towards a host that has not been contacted are closed.
+        'credentials_file' is the path where client credentials obtained by
+        registration are stored, and loaded from at the next start.
+        'token_refresh' enables the renewal of the JWT in background,
+        before it expires.
+        'reconnect' enables the supervision of subscriptions: when their
+        websocket drops, it is opened again (waiting at most 'max_backoff'
+        seconds between attempts) and the subscriptions are renewed.
+        Their handlers then receive the difference between the last
+        known results and the current ones.
+        'dispatcher' is an optional NotificationDispatcher: handlers are
+        then run by its workers instead of the websocket threads.
+        'metrics' is an optional Metrics instance (see sepy.Metrics).
+        """
         # logger configuration
         self.logger = logging.getLogger("sepaLogger")
         self.logger.setLevel(logLevel)
         self.logger.debug("=== ConnectionHandler::__init__ invoked ===")
         logging.getLogger("urllib3").setLevel(logLevel)
         logging.getLogger("requests").setLevel(logLevel)
-        # open subscriptions
+        # open subscriptions: spuid -> websocket, and the websockets
+        # shared by the subscriptions towards the same url
         self.websockets = {}
+        self._subscriptions = {}
+        self._sockets = {}
+        self._sockets_lock = Lock()
+        self.reconnect = reconnect
+        self.max_backoff = max_backoff
+        self.dispatcher = dispatcher
+        self.metrics = metrics if metrics is not None else NULL_METRICS
         
         # secure request objects
         self.token = None
+        self.token_expiry = None
+        self.token_margin = 0
         self.client_secret = None
         self.client_id = client_id if client_id else str(uuid4())
+        self.credentials_file = credentials_file
+        self.token_refresh = token_refresh
+        self._auth_lock = RLock()
+        self._refresh_timer = None
+        if credentials_file is not None:
+            credentials = loadCredentials(credentials_file)
+            if (credentials is not None) and (
+                    client_id is None or credentials["client_id"] == client_id):
+                self.client_id = credentials["client_id"]
+                self.client_secret = credentials["client_secret"]
+
+        # keep-alive HTTP connections: one pool per host
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        # requests is imported, and the session opened, on first use
+        self.session = None
+        # host -> last use, and number of requests in flight
+        self._pools = {}
+        self._inflight = {}
+        self._pools_lock = Lock()
         
     def get_client_id(self):
         """
@@ -66,12 +134,73 @@ class ConnectionHandler:
         """
         return self.client_id
 
-    def unsecureRequest(self, reqURI, sparql, isQuery):
+    def _post(self, reqURI, **kwargs):
+        """
+        Performs a POST request on the keep-alive connection pool of the
+        host of 'reqURI'. Pools that have been idle for more than
+        'idle_timeout' seconds, including the one of that host, are
+        closed before: their connections may have been dropped by the
+        server meanwhile. Pools with requests in flight are kept.
+        """
+        parsed = urlparse(reqURI)
+        prefix = "{}://{}".format(parsed.scheme, parsed.netloc)
+        now = monotonic()
+        idle = []
+        with self._pools_lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+            for host, last_used in list(self._pools.items()):
+                if (now - last_used > self.idle_timeout) and not self._inflight.get(host):
+                    idle.append((host, self.session.adapters.pop(host)))
+                    del self._pools[host]
+            if prefix not in self._pools:
+                from requests.adapters import HTTPAdapter
+                self.session.mount(prefix, HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_maxsize))
+            self._pools[prefix] = now
+            self._inflight[prefix] = self._inflight.get(prefix, 0) + 1
+        for host, adapter in idle:
+            self.logger.debug("Closing idle connections towards {}".format(host))
+            adapter.close()
+        try:
+            return self.session.post(reqURI, **kwargs)
+        finally:
+            with self._pools_lock:
+                self._inflight[prefix] -= 1
+                if prefix in self._pools:
+                    self._pools[prefix] = monotonic()
+
+    def close(self):
+        """
+        Closes all the keep-alive HTTP connections.
+        """
+        self.logger.debug("=== ConnectionHandler::close invoked ===")
+        with self._auth_lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+        with self._sockets_lock:
+            # including the websockets of their own of nested subscriptions
+            sockets = set(self._sockets.values()).union(
+                subscription.socket for subscription in self._subscriptions.values())
+            self._sockets.clear()
+        for socket in sockets:
+            socket.close()
+        with self._pools_lock:
+            self._pools.clear()
+            if self.session is not None:
+                self.session.close()
+
+    def unsecureRequest(self, reqURI, sparql, isQuery, raw=False, stream=False):
         """
         Method to issue a SPARQL request over HTTP.
         reqURI is the host destination
         sparql is the SPARQL request
         isQuery is a boolean to identify if the request is a query or an update.
+        raw is True to get the body of the response as bytes.
+        stream is True to get, in place of the body, the response itself,
+        whose content is still to be read (see _body).
         """
         # debug
         self.logger.debug("=== ConnectionHandler::unsecureRequest invoked ===")
@@ -79,13 +208,13 @@ class ConnectionHandler:
         headers = {
             "Content-Type":"application/sparql-query" if isQuery else "application/sparql-update", 
             "Accept":"application/sparql-results+json"}
-        r = requests.post(reqURI, headers=headers, data=sparql)
-        r.connection.close()
-        return r.status_code, r.text
+        r = self._post(reqURI, headers=headers, data=sparql, stream=stream)
+        return r.status_code, _body(r, raw, stream)
 
 
     # do HTTPS request
-    def secureRequest(self, reqURI, sparql, isQuery, registerURI, tokenURI):
+    def secureRequest(self, reqURI, sparql, isQuery, registerURI, tokenURI,
+                      raw=False, stream=False):
         """
         Method to issue a SPARQL request over HTTPS.
         reqURI is the host destination
@@ -93,34 +222,92 @@ class ConnectionHandler:
         isQuery is a boolean to identify if the request is a query or an update.
         registerURI is the uri for registration to SEPA
         tokenURI is the JWT
+        raw is True to get the body of the response as bytes.
+        stream is True to get the response itself (see unsecureRequest).
         """
         # debug
         self.logger.debug("=== ConnectionHandler::secureRequest invoked ===")
         
-        # if the client is not yet registered, then register!
-        if not self.client_secret:
-            self.logger.debug("Client secret = {}".format(self.client_secret))
-            self.register(registerURI)
-        
-        # if a token is not present, request it!
-        if not self.token:
-            self.logger.debug("Token = {}".format(self.token))
-            self.requestToken(tokenURI)
-                
+        # register and get a token, if needed
+        token = self.authorize(registerURI, tokenURI)
+
         # perform the request
         self.logger.debug("Performing a secure SPARQL request")
         headers = {
            "Content-Type":"application/sparql-query" if isQuery else "application/sparql-update", 
            "Accept":"application/json",
-           "Authorization": "Bearer " + self.token}
-        r = requests.post(reqURI, headers=headers, data=sparql, verify=False)        
-        r.connection.close()
+           "Authorization": "Bearer " + token}
+        r = self._post(reqURI, headers=headers, data=sparql, verify=False,
+                       stream=stream)
+
+        # the token expired: renew it, and retry once
+        if r.status_code == 401:
+            r.close()
+            token = self.authorize(registerURI, tokenURI, expired=token)
+            headers["Authorization"] = "Bearer " + token
+            r = self._post(reqURI, headers=headers, data=sparql, verify=False,
+                           stream=stream)
             
         # check for errors on token validity
         if r.status_code == 401:
+            r.close()
             self.token = None                
             raise TokenExpiredException
-        return r.status_code, r.text
+        return r.status_code, _body(r, raw, stream)
+
+    def authorize(self, registerURI, tokenURI, expired=None):
+        """
+        Returns a valid JWT, registering the client and requesting the
+        token if needed. The token is renewed if it is about to expire,
+        or if it is 'expired' (i.e. refused by SEPA).
+        Concurrent callers wait for a single registration and token
+        request.
+        """
+        token = self.token
+        if (token is not None) and (expired is None) and not self._token_expiring():
+            return token
+        with self._auth_lock:
+            if (self.token is not None) and (self.token != expired) and not self._token_expiring():
+                # somebody else renewed it meanwhile
+                return self.token
+            if not self.client_secret:
+                self.logger.debug("Client secret = {}".format(self.client_secret))
+                self.register(registerURI)
+                self.requestToken(tokenURI)
+            else:
+                try:
+                    self.requestToken(tokenURI)
+                except TokenRequestFailedException:
+                    # stored credentials may be unknown to SEPA: register again
+                    self.logger.debug("Token refused: registering again")
+                    self.register(registerURI)
+                    self.requestToken(tokenURI)
+            return self.token
+
+    def _token_expiring(self):
+        return (self.token_expiry is not None) and (
+            monotonic() > self.token_expiry - self.token_margin)
+
+    def _schedule_refresh(self, tokenURI, expires_in):
+        """
+        Schedules the renewal of the token before its expiration.
+        """
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+        delay = float(expires_in) - renewalMargin(expires_in)
+
+        def refresh():
+            try:
+                with self._auth_lock:
+                    if self._refresh_timer is timer:
+                        self.requestToken(tokenURI)
+            except Exception as e:
+                self.logger.warning("Background token renewal failed: {}".format(e))
+
+        timer = Timer(delay, refresh)
+        timer.daemon = True
+        self._refresh_timer = timer
+        timer.start()
 
     
     ###################################################
@@ -146,8 +333,11 @@ class ConnectionHandler:
 
         # perform the request
         self.logger.debug("RegisterURI: {}".format(registerURI))
-        r = requests.post(registerURI, headers=headers, data=payload, verify=False)        
-        r.connection.close()
+        with self.metrics.phase("register", "network", endpoint=registerURI):
+            r = self._post(registerURI, headers=headers, data=payload, verify=False)
+        self.metrics.count(
+            OPERATIONS_TOTAL, operation="register", endpoint=registerURI,
+            status=r.status_code)
         
         if r.status_code == 201:
             # parse the response
@@ -158,6 +348,9 @@ class ConnectionHandler:
                 b64encode(bytes(
                     "{}:{}".format(jresponse["client_id"],jresponse["client_secret"]), 
                     "utf-8")).decode("utf-8"))
+            if self.credentials_file is not None:
+                saveCredentials(
+                    self.credentials_file, self.client_id, self.client_secret)
         else:
             print("{}: {}".format(r.status_code, r.text))
             raise RegistrationFailedException
@@ -185,11 +378,23 @@ class ConnectionHandler:
             "Authorization": self.client_secret}    
 
         # perform the request
-        r = requests.post(tokenURI, headers=headers, verify=False)        
-        r.connection.close()
+        with self.metrics.phase("token", "network", endpoint=tokenURI):
+            r = self._post(tokenURI, headers=headers, verify=False)
+        self.metrics.count(
+            OPERATIONS_TOTAL, operation="token", endpoint=tokenURI,
+            status=r.status_code)
         if r.status_code == 201:
             self.logger.debug(r.text)
-            self.token = json.loads(r.text)["token"]["access_token"]
+            jtoken = json.loads(r.text)["token"]
+            with self._auth_lock:
+                self.token = jtoken["access_token"]
+                if "expires_in" in jtoken:
+                    self.token_expiry = monotonic() + float(jtoken["expires_in"])
+                    self.token_margin = renewalMargin(jtoken["expires_in"])
+                    if self.token_refresh:
+                        self._schedule_refresh(tokenURI, jtoken["expires_in"])
+                else:
+                    self.token_expiry = None
         else:
             raise TokenRequestFailedException
 
@@ -211,79 +416,15 @@ class ConnectionHandler:
         handler is the function to call when a new notification is received
         default_graph and named_graph allow subscriptions to be more fine grained,
         (look to SEPA documentation for this).
+        All the subscriptions towards the same subscribeURI share the
+        same websocket.
         """
         # debug
         self.logger.debug("=== ConnectionHandler::openUnsecureWebsocket invoked ===")
+        msg = getSubscriptionRequestMessage(
+            sparql, alias, None, default_graph, named_graph)
+        return self._subscribe(subscribeURI, lambda: msg, handler)
 
-        # initialization
-        handler = handler
-        subid = None
-        subidEvent = Event()
-
-        # on_message callback
-        def on_message(ws, message):
-            # Triggered when new messages are received
-            nonlocal subid
-            nonlocal subidEvent
-
-            self.logger.debug("=== ConnectionHandler::on_message (unsecure) invoked ===")
-            self.logger.debug(message)
-
-            # process message
-            subid_code, added, removed = parseWSMessage(message)
-            
-            if ((added is None) and (removed is None)):
-                if subid_code is None:
-                    # None, None, None case
-                    ws.close()
-            else:
-                # None/Value, value, value case
-                if not (subid_code is None):
-                    # value, value, value case
-                    # save the subscription id and the thread
-                    subid = subid_code
-                    self.websockets[subid] = ws
-                    subidEvent.set()
-                handler(added,removed)
-
-        # on_error callback
-        def on_error(ws, error):
-            self.logger.debug("=== ConnectionHandler::on_error (unsecure) invoked ===")
-            self.logger.debug(error)
-
-        # on_close callback
-        def on_close(ws):
-            self.logger.debug("=== ConnectionHandler::on_close (unsecure) invoked ===")
-            # destroy the websocket dictionary
-            del self.websockets[subid]
-
-        # on_open callback
-        def on_open(ws):           
-            self.logger.debug("=== ConnectionHandler::on_open (unsecure) invoked ===")
-            # send subscription request
-            msg = getSubscriptionRequestMessage(
-                sparql, alias, None, default_graph, named_graph)
-            ws.send(json.dumps(msg))
-            self.logger.debug(msg)
-
-        # configuring the websocket
-        ws = WebSocketApp(subscribeURI,
-                          on_message = on_message,
-                          on_error = on_error,
-                          on_close = on_close,
-                          on_open = on_open)                                        
-
-        wst = Thread(target=ws.run_forever)
-        wst.daemon = True
-        wst.start()
-
-        # return
-        self.logger.debug("Waiting for subscription ID")
-        if not subidEvent.wait(timeout=10):
-            raise SubscriptionTimeoutException
-        return subid
-
-    
     # do open websocket
     def openSecureWebsocket(self,
                             subscribeURI, sparql, alias, handler, 
@@ -299,109 +440,392 @@ class ConnectionHandler:
         'tokenURI' is the url to which ask for a JWT
         'default_graph' and 'named_graph' allow subscriptions to be more fine grained,
         (look to SEPA documentation for this).
+        All the subscriptions towards the same subscribeURI share the
+        same websocket.
         """
         # debug
         self.logger.debug("=== ConnectionHandler::openSecureWebsocket invoked ===")
         
-        # if the client is not yet registered, then register!
-        if not self.client_secret:
-            self.register(registerURI)
-            
-        # if a token is not present, request it!
-        if not self.token:
-            self.requestToken(tokenURI)
-
-        # initialization
-        handler = handler
-        subid = None
-        subidEvent = Event()
-
-        # on_message callback
-        def on_message(ws, message):
-            nonlocal subid
-            nonlocal subidEvent
-            # debug
-            self.logger.debug("=== ConnectionHandler::on_message (secure) invoked ===")
-            self.logger.debug(message)
-
-            # process message
-            subid_code, added, removed = parseWSMessage(message)
-            
-            if ((added is None) and (removed is None)):
-                if subid_code is None:
-                    ws.close()
-            else:
-                if not (subid_code is None):
-                    # save the subscription id and the thread
-                    subid = subid_code
-                    self.websockets[subid] = ws
-                    subidEvent.set()
-                handler(added,removed)
-
-        # on_error callback
-        def on_error(ws, error):
-            # debug
-            self.logger.debug("=== ConnectionHandler::on_error (unsecure) invoked ===")
-            self.logger.debug(error)
-
-        # on_close callback
-        def on_close(ws):
-            # debug
-            self.logger.debug("=== ConnectionHandler::on_close (secure) invoked ===")
-            # destroy the websocket dictionary
-            del self.websockets[subid]
-
-        # on_open callback
-        def on_open(ws):           
-            # debug
-            self.logger.debug("=== ConnectionHandler::on_open (secure) invoked ===")
-            # send subscription request
-            msg = getSubscriptionRequestMessage(
-                sparql, alias, self.token, default_graph, named_graph)
-            ws.send(json.dumps(msg))
-            self.logger.debug(msg)
-
-
-        # configuring the websocket        
-        ws = WebSocketApp(subscribeURI,
-                          on_message = on_message,
-                          on_error = on_error,
-                          on_close = on_close,
-                          on_open = on_open)                                        
-
-        # starting the websocket thread
-        wst = Thread(
-            target=ws.run_forever, 
-            kwargs=dict(sslopt={"cert_reqs": CERT_NONE}))
-        wst.daemon = True
-        wst.start()
-
-        # return
-        self.logger.debug("Waiting for subscription ID")
-        if not subidEvent.wait(timeout=10):
-            raise SubscriptionTimeoutException
-        return subid
-    
+        # the request is built each time the subscription is sent, with
+        # a valid token
+        def request():
+            return getSubscriptionRequestMessage(
+                sparql, alias, self.authorize(registerURI, tokenURI),
+                default_graph, named_graph)
+        from ssl import CERT_NONE
+        return self._subscribe(
+            subscribeURI, request, handler, sslopt={"cert_reqs": CERT_NONE})
+
+    def _subscribe(self, subscribeURI, request, handler, sslopt=None):
+        """
+        Sends the subscription request built by 'request' on the websocket
+        shared by the subscriptions to 'subscribeURI', opening it if needed.
+        Returns the subscription id.
+        """
+        queue = None
+        if self.dispatcher is not None:
+            if self.metrics.enabled:
+                # the handler phase is timed on the dispatcher workers
+                handler = timedHandler(handler, self.metrics, subscribeURI)
+            handler = queue = self.dispatcher.wrap(handler)
+        subscription = Subscription(request, handler, track=self.reconnect)
+        with self._sockets_lock:
+            socket = self._sockets.get(subscribeURI)
+            if (socket is not None) and (socket.thread is current_thread()):
+                # called by a handler run on the thread reading the shared
+                # websocket, which could not read the confirmation: the
+                # subscription gets a websocket of its own
+                socket = SubscriptionSocket(self, subscribeURI, sslopt=sslopt)
+            elif socket is None:
+                socket = SubscriptionSocket(self, subscribeURI, sslopt=sslopt)
+                self._sockets[subscribeURI] = socket
+            socket.users += 1
+        try:
+            socket.subscribe(subscription)
+        finally:
+            with self._sockets_lock:
+                socket.users -= 1
+            self._releaseSocket(socket)
+        if queue is not None:
+            self.dispatcher.register(subscription.subid, queue)
+        return subscription.subid
+
+    def _releaseSocket(self, socket):
+        """
+        Closes 'socket' if no subscription is using it anymore.
+        """
+        with self._sockets_lock:
+            if socket.subscriptions or socket.users or socket.unsubscribing:
+                return
+            if self._sockets.get(socket.url) is socket:
+                del self._sockets[socket.url]
+        socket.close()
+
+    def _socketClosed(self, socket):
+        """
+        Called when 'socket' is closed for good: its subscriptions are gone.
+        """
+        with self._sockets_lock:
+            if self._sockets.get(socket.url) is socket:
+                del self._sockets[socket.url]
+            for subscription in socket.subscriptions:
+                self.websockets.pop(subscription.subid, None)
+                self._subscriptions.pop(subscription.subid, None)
+                if self.dispatcher is not None:
+                    self.dispatcher.unregister(subscription.subid)
 
     def closeWebsocket(self, subid):
         # debug
         self.logger.debug("=== ConnectionHandler::closeWebSocket invoked ===")
-        msg = {}
-        msg["unsubscribe"] = {}
-        msg["unsubscribe"]["spuid"] = subid
-        if self.token:
-            msg["unsubscribe"]["authorization"] = "Bearer " + self.token
-        self.websockets[subid].send(json.dumps(msg))
+        subscription = self._subscriptions[subid]
+        msg = getUnsubscribeRequestMessage(subscription.spuid, self.token)
+        subscription.socket.unsubscribe(subscription, msg)
+        if self.dispatcher is not None:
+            self.dispatcher.unregister(subid)
         
     def get_subscriptions(self):
         return self.websockets
 
 
+class Subscription:
+    """
+    A subscription made through a SubscriptionSocket. 'subid' is the
+    subscription id given to the user, and stays the same when the
+    subscription is renewed; 'spuid' is the current one given by SEPA.
+    When tracked, the last known results are kept to compute the
+    difference with the results of a renewed subscription.
+    """
+    __slots__ = ("subid", "spuid", "socket", "request", "handler", "state")
+
+    def __init__(self, request, handler, track=False):
+        self.subid = None
+        self.spuid = None
+        self.socket = None
+        self.request = request
+        self.handler = handler
+        self.state = BindingSet() if track else None
+
+    def notify(self, added, removed, resync=False):
+        if self.state is not None:
+            if resync:
+                # the first notification of a renewed subscription holds
+                # all the current results
+                current = BindingSet(added)
+                added, removed = self.state.diff(current)
+                self.state = current
+                if not (added or removed):
+                    return
+            else:
+                self.state.remove(removed)
+                self.state.add(added)
+        self.handler(added, removed)
+
+
+class SubscriptionSocket:
+    """
+    A websocket towards a SEPA subscription url, shared by all the
+    subscriptions made to that url. SEPA notifications carry the spuid,
+    which is used to route them to the right subscription.
+    When the connection drops, it is opened again with a jittered
+    exponential backoff, and all the subscriptions are renewed.
+    """
+    def __init__(self, connectionHandler, url, sslopt=None, timeout=10):
+        self.logger = logging.getLogger("sepaLogger")
+        self.owner = connectionHandler
+        self.url = url
+        self.sslopt = sslopt
+        self.timeout = timeout
+        # the active subscriptions, and their spuid on this connection
+        self.subscriptions = set()
+        self.routes = {}
+        # number of subscriptions being requested on this socket
+        self.users = 0
+
+        # subscription requests are sent one at a time: the next
+        # confirmation received belongs to the pending one
+        self._subscribeLock = Lock()
+        self._pending = None
+        self._failure = None
+        self._confirmed = Event()
+        # number of unsubscriptions waiting for their confirmation
+        self.unsubscribing = 0
+        self._opened = Event()
+        self._closing = False
+        self._attempt = 0
+
+        self.ws = None
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """
+        Runs the websocket, opening it again when it drops, until it is
+        closed on purpose.
+        """
+        from websocket import WebSocketApp
+
+        while not self._closing:
+            self._opened.clear()
+            self.routes = {}
+            self.ws = WebSocketApp(self.url,
+                                   on_message = self.on_message,
+                                   on_error = self.on_error,
+                                   on_close = self.on_close,
+                                   on_open = self.on_open)
+            self.ws.run_forever(**(dict(sslopt=self.sslopt) if self.sslopt else {}))
+            with self.owner._sockets_lock:
+                # the broker forgets the subscriptions of a dropped connection
+                self.unsubscribing = 0
+            if self._closing or not self.owner.reconnect or not self.subscriptions:
+                break
+            delay = uniform(0, min(
+                self.owner.max_backoff, RECONNECT_BASE_DELAY * 2 ** self._attempt))
+            self._attempt += 1
+            self.logger.warning("Websocket {} dropped: reconnecting in {:.2f}s".format(
+                self.url, delay))
+            sleep(delay)
+        self.owner._socketClosed(self)
+
+    def subscribe(self, subscription, renew=False):
+        """
+        Sends the request of 'subscription', and waits for its spuid.
+        When 'renew' is True, nothing is sent if the subscription has
+        been removed meanwhile.
+        """
+        with self._subscribeLock:
+            if not self._opened.wait(timeout=self.timeout):
+                raise SubscriptionTimeoutException
+            if renew:
+                with self.owner._sockets_lock:
+                    if subscription not in self.subscriptions:
+                        return
+            msg = subscription.request()
+            self._confirmed.clear()
+            self._failure = None
+            self._pending = subscription
+            with self.owner.metrics.phase("subscribe", "serialize", endpoint=self.url):
+                msg = json.dumps(msg)
+            self.ws.send(msg)
+            self.logger.debug(msg)
+            self.logger.debug("Waiting for subscription ID")
+            if not self._confirmed.wait(timeout=self.timeout):
+                self._pending = None
+                raise SubscriptionTimeoutException
+            if self._failure is not None:
+                raise SubscriptionFailedException(self._failure)
+
+    def _resubscribe(self):
+        """
+        Renews all the subscriptions after a reconnection.
+        """
+        # the socket is in use until the renewals are over
+        with self.owner._sockets_lock:
+            self.users += 1
+        try:
+            self._renew()
+        finally:
+            with self.owner._sockets_lock:
+                self.users -= 1
+            self.owner._releaseSocket(self)
+
+    def _renew(self):
+        for subscription in list(self.subscriptions):
+            try:
+                self.subscribe(subscription, renew=True)
+            except SubscriptionFailedException as e:
+                # refused by SEPA: it would be refused again
+                self.logger.error("Subscription {} refused on renewal: {}".format(
+                    subscription.subid, e))
+                with self.owner._sockets_lock:
+                    self.subscriptions.discard(subscription)
+                    self.owner.websockets.pop(subscription.subid, None)
+                    self.owner._subscriptions.pop(subscription.subid, None)
+            except Exception as e:
+                self.logger.error("Unable to renew subscription {}: {}".format(
+                    subscription.subid, e))
+                # try again on a new connection
+                self.ws.close()
+                return
+        self._attempt = 0
+
+    def unsubscribe(self, subscription, msg):
+        """
+        Sends the unsubscription request 'msg': notifications for
+        'subscription' are not delivered anymore.
+        """
+        with self.owner._sockets_lock:
+            self.subscriptions.discard(subscription)
+            self.routes.pop(subscription.spuid, None)
+            self.owner.websockets.pop(subscription.subid, None)
+            self.owner._subscriptions.pop(subscription.subid, None)
+            self.unsubscribing += 1
+        try:
+            self.ws.send(json.dumps(msg))
+        except Exception as e:
+            # the connection is down: there is nothing to unsubscribe from
+            self.logger.debug(e)
+            self._unsubscribed()
+
+    def _unsubscribed(self):
+        """
+        Accounts for a confirmed (or lost) unsubscription: the socket is
+        closed once the last one is confirmed, if no subscription is
+        using it anymore.
+        """
+        with self.owner._sockets_lock:
+            self.unsubscribing = max(self.unsubscribing - 1, 0)
+        self.owner._releaseSocket(self)
+
+    def close(self):
+        self._closing = True
+        if self.ws is not None:
+            self.ws.close()
+
+    def on_message(self, ws, message):
+        self.logger.debug("=== SubscriptionSocket::on_message invoked ===")
+        self.logger.debug(message)
+
+        metrics = self.owner.metrics
+        with metrics.phase("notification", "decode", endpoint=self.url):
+            jmessage = decode(message)
+            if "notification" in jmessage:
+                notification = jmessage["notification"]
+                added, removed = parseNotification(notification)
+            else:
+                notification = None
+        if "unsubscribed" in jmessage:
+            self._unsubscribed()
+            return
+        if "error" in jmessage:
+            self.on_broker_error(jmessage)
+            return
+        if notification is None:
+            self.logger.warning("Unexpected message: {}".format(message))
+            return
+        spuid = notification["spuid"]
+
+        subscription = self.routes.get(spuid)
+        resync = False
+        if (notification["sequence"] == 0) and (self._pending is not None):
+            # subscription confirmation
+            subscription = self._pending
+            self._pending = None
+            resync = subscription.subid is not None
+            with self.owner._sockets_lock:
+                dropped = resync and (subscription not in self.subscriptions)
+                if dropped:
+                    # unsubscribed while it was being renewed
+                    self.unsubscribing += 1
+                else:
+                    if not resync:
+                        subscription.subid = spuid
+                        subscription.socket = self
+                        self.owner._subscriptions[spuid] = subscription
+                    subscription.spuid = spuid
+                    self.subscriptions.add(subscription)
+                    self.routes[spuid] = subscription
+                    self.owner.websockets[subscription.subid] = ws
+            self._confirmed.set()
+            if dropped:
+                ws.send(json.dumps(
+                    getUnsubscribeRequestMessage(spuid, self.owner.token)))
+                return
+        if subscription is not None:
+            metrics.count(OPERATIONS_TOTAL, operation="notification", endpoint=self.url)
+            # with a dispatcher, the handler is only given the notification
+            # here: it is timed where it runs
+            phase = "handler" if self.owner.dispatcher is None else "enqueue"
+            with metrics.phase("notification", phase, endpoint=self.url):
+                subscription.notify(added, removed, resync=resync)
+
+    def on_broker_error(self, jmessage):
+        """
+        An error sent by SEPA: it is the answer to the pending
+        subscription request, if any, which fails at once.
+        """
+        error = jmessage["error"]
+        if isinstance(error, dict):
+            error = error.get("message", error)
+        if "error_description" in jmessage:
+            error = "{}: {}".format(error, jmessage["error_description"])
+        if self._pending is None:
+            self.logger.error("SEPA error: {}".format(error))
+            return
+        self._pending = None
+        self._failure = error
+        self._confirmed.set()
+
+    def on_error(self, ws, error):
+        self.logger.debug("=== SubscriptionSocket::on_error invoked ===")
+        self.logger.debug(error)
+
+    def on_close(self, ws, *args):
+        self.logger.debug("=== SubscriptionSocket::on_close invoked ===")
+
+    def on_open(self, ws):
+        self.logger.debug("=== SubscriptionSocket::on_open invoked ===")
+        self._opened.set()
+        if self.subscriptions:
+            # reconnection: the subscriptions are renewed by another
+            # thread, since confirmations are read by this one
+            resubscriber = Thread(target=self._resubscribe)
+            resubscriber.daemon = True
+            resubscriber.start()
+        else:
+            self._attempt = 0
+
+
+def _body(response, raw, stream):
+    if stream:
+        return response
+    return response.content if raw else response.text
+
 def parseWSMessage(message):
     subid = None
     logger = logging.getLogger("sepaLogger")
     
-    jmessage = json.loads(message)
+    jmessage = decode(message)
     if "unsubscribed" in jmessage:
         return None, None, None
     notification = jmessage["notification"]
@@ -409,7 +833,15 @@ def parseWSMessage(message):
         logger.debug("Subscription Confirmation")
         subid = notification["spuid"]
         logger.debug("SUBID = " + subid)
-    
+    added, removed = parseNotification(notification)
+    return subid, added, removed
+
+def parseNotification(notification):
+    """
+    Extracts the added and removed bindings from a SEPA notification.
+    """
+    logger = logging.getLogger("sepaLogger")
+
     added = []
     if "addedResults" not in notification.keys():
         logger.warning("No 'addedResults' key in notification")
@@ -429,7 +861,7 @@ def parseWSMessage(message):
         logger.warning("No 'bindings' key in notification['removedResults']['results']")
     else:
         removed = notification["removedResults"]["results"]["bindings"]
-    return subid, added, removed
+    return added, removed
         
 def getSubscriptionRequestMessage(sparql, alias, token, default_graph, named_graph):
     # composing message
@@ -444,3 +876,53 @@ def getSubscriptionRequestMessage(sparql, alias, token, default_graph, named_gra
     if named_graph is not None:
         msg["subscribe"]["default-graph-uri"] = named_graph
     return msg
+
+def timedHandler(handler, metrics, url):
+    """
+    Wraps 'handler', recording its duration as the handler phase of the
+    notifications of 'url'.
+    """
+    def timed(added, removed):
+        with metrics.phase("notification", "handler", endpoint=url):
+            handler(added, removed)
+    return timed
+
+def getUnsubscribeRequestMessage(spuid, token):
+    msg = {}
+    msg["unsubscribe"] = {}
+    msg["unsubscribe"]["spuid"] = spuid
+    if token:
+        msg["unsubscribe"]["authorization"] = "Bearer " + token
+    return msg
+
+def renewalMargin(expires_in):
+    """
+    Returns the seconds before expiration at which a JWT lasting
+    'expires_in' seconds is renewed.
+    """
+    return min(TOKEN_RENEWAL_MARGIN, float(expires_in) / 2)
+
+def loadCredentials(path):
+    """
+    Loads the client credentials stored at 'path' by saveCredentials.
+    Returns None if they are not available.
+    """
+    try:
+        with open(path, "r") as credentials_file:
+            credentials = json.load(credentials_file)
+        if ("client_id" in credentials) and ("client_secret" in credentials):
+            return credentials
+    except (OSError, ValueError):
+        pass
+    return None
+
+def saveCredentials(path, client_id, client_secret):
+    """
+    Stores the client credentials at 'path', readable by the user only.
+    """
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as credentials_file:
+        json.dump({"client_id": client_id, "client_secret": client_secret},
+                  credentials_file)
+    os.replace(tmp_path, path)
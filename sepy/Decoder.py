@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Decoder.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+The JSON decoder used for query results and notifications. It is
+orjson or ujson when installed, the standard json module otherwise,
+and can be replaced with set_decoder.
+"""
+
+import json
+
+
+def _default_decoder():
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return ujson.loads
+    except ImportError:
+        return json.loads
+
+
+_decoder = _default_decoder()
+
+
+def decode(data):
+    """
+    Parses the JSON document 'data', given as bytes or str.
+    """
+    return _decoder(data)
+
+
+def set_decoder(decoder=None):
+    """
+    Sets the function parsing JSON documents: it is given bytes (HTTP
+    responses) or str (websocket frames), and has to return the same
+    dicts and lists of json.loads. None restores the default decoder.
+    """
+    global _decoder
+    _decoder = _default_decoder() if decoder is None else decoder
+
+
+def get_decoder():
+    """
+    Returns the function currently parsing JSON documents.
+    """
+    return _decoder
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Dispatcher.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .Results import mergeNotifications
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Timer
+from time import perf_counter
+
+import logging
+
+# overflow policies of the notification queues
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+COALESCE = "coalesce"
+
+
+class NotificationQueue:
+    """
+    The bounded queue of the notifications of a subscription. It is
+    drained by one task at a time of the dispatcher executor, so that
+    the handler sees notifications in order.
+    """
+    def __init__(self, dispatcher, handler):
+        self.dispatcher = dispatcher
+        self.handler = handler
+        self.subid = None
+        self._queue = deque()
+        self._condition = Condition()
+        self._scheduled = False
+        # statistics
+        self.handled = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def __call__(self, added, removed):
+        """
+        Enqueues a notification: this is called by the websocket thread
+        in place of the handler.
+        """
+        max_queue = self.dispatcher.max_queue
+        with self._condition:
+            if len(self._queue) >= max_queue:
+                policy = self.dispatcher.overflow
+                if policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                elif policy == COALESCE:
+                    self._queue.append(mergeNotifications(
+                        [self._queue.pop(), (added, removed)]))
+                    self.coalesced += 1
+                    return
+                else:
+                    while len(self._queue) >= max_queue:
+                        self._condition.wait()
+            self._queue.append((added, removed))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.dispatcher.executor.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self._condition:
+                if not self._queue:
+                    self._scheduled = False
+                    return
+                added, removed = self._queue.popleft()
+                self._condition.notify()
+            start = perf_counter()
+            try:
+                self.handler(added, removed)
+            except Exception as e:
+                self.dispatcher.logger.error(
+                    "Subscription {} handler error: {}".format(self.subid, e))
+            latency = perf_counter() - start
+            self.handled += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "latency_avg": self.latency_total / self.handled if self.handled else 0.0,
+            "latency_max": self.latency_max}
+
+
+class NotificationDispatcher:
+    """
+    Decouples subscription handlers from the websocket threads: each
+    subscription gets a bounded queue of notifications, and handlers
+    run on a shared pool of workers, in order for each subscription.
+    When a queue is full, the 'overflow' policy applies:
+    BLOCK waits for the handler (slowing down the websocket reads),
+    DROP_OLDEST discards the oldest notification, COALESCE merges the
+    new notification into the last queued one.
+    """
+    def __init__(self, workers=4, max_queue=1000, overflow=BLOCK,
+                 executor=None):
+        """
+        Constructor of the NotificationDispatcher class.
+        'workers' is the size of the thread pool running handlers,
+        'max_queue' the maximum number of notifications waiting for
+        each subscription, 'overflow' the policy for full queues.
+        Any concurrent.futures 'executor' can be given in place of the
+        thread pool.
+        """
+        if overflow not in (BLOCK, DROP_OLDEST, COALESCE):
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
+        self.logger = logging.getLogger("sepaLogger")
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.executor = executor if executor is not None else ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="sepy-dispatcher")
+        self._queues = {}
+
+    def wrap(self, handler):
+        """
+        Returns the NotificationQueue to be used in place of 'handler'.
+        """
+        return NotificationQueue(self, handler)
+
+    def register(self, subid, queue):
+        queue.subid = subid
+        self._queues[subid] = queue
+
+    def unregister(self, subid):
+        self._queues.pop(subid, None)
+
+    def stats(self):
+        """
+        Returns, for each subscription id, the queue depth, the handled,
+        dropped and coalesced notifications and the handler latency
+        (average and maximum, in seconds).
+        """
+        return {subid: queue.stats() for subid, queue in list(self._queues.items())}
+
+    def close(self, wait=True):
+        """
+        Stops the workers, after the queued notifications are handled
+        if 'wait' is True.
+        """
+        self.executor.shutdown(wait=wait)
+
+
+class NotificationCoalescer:
+    """
+    Handler wrapper that merges the notifications received within
+    'window' seconds into a single net difference, so that bindings
+    added and then removed (or vice versa) never reach the handler.
+    The first notification, holding the initial results, is given to
+    the handler straight away.
+    """
+    def __init__(self, handler, window):
+        self.handler = handler
+        self.window = window
+        self._pending = None
+        self._timer = None
+        self._lock = Lock()
+        self._handlerLock = Lock()
+
+    def __call__(self, added, removed):
+        with self._lock:
+            if self._pending is None:
+                # initial results
+                self._pending = []
+                first = True
+            else:
+                self._pending.append((added, removed))
+                first = False
+                if self._timer is None:
+                    self._timer = Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if first:
+            with self._handlerLock:
+                self.handler(added, removed)
+
+    def flush(self):
+        """
+        Gives the handler the net difference of the notifications
+        received so far.
+        """
+        with self._handlerLock:
+            with self._lock:
+                pending = self._pending
+                if pending is not None:
+                    self._pending = []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if pending:
+                added, removed = mergeNotifications(pending)
+                if added or removed:
+                    self.handler(added, removed)
@@ -33,3 +33,6 @@ class TokenRequestFailedException(Exception):
 
 class SubscriptionTimeoutException(Exception):
     pass
+
+class SubscriptionFailedException(Exception):
+    pass
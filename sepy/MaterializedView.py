@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  MaterializedView.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .Results import BindingSet
+
+from threading import Event, Lock
+
+import logging
+
+
+class MaterializedView:
+    """
+    The current result set of a subscription, kept up to date with its
+    notifications. Bindings are hashed on their whole content, and can
+    be indexed on some of their variables for fast lookups.
+    Use SEPA.materialize to get one.
+    """
+    def __init__(self, indexes=(), handler=None):
+        """
+        Constructor of the MaterializedView class.
+        'indexes' are the variables to index bindings by.
+        'handler', if given, is called as the subscription handler
+        after each notification has been applied.
+        """
+        self.logger = logging.getLogger("sepaLogger")
+        self.handler = handler
+        self.subid = None
+        self.unsubscribe = None
+        self._bindingSet = BindingSet()
+        # variable -> value -> binding key -> binding
+        self._indexes = {var: {} for var in indexes}
+        self._lock = Lock()
+        self._ready = Event()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._bindingSet)
+
+    def __contains__(self, binding):
+        with self._lock:
+            return binding in self._bindingSet
+
+    def notify(self, added, removed):
+        """
+        Applies a notification: this is the subscription handler.
+        """
+        with self._lock:
+            for key, binding in self._bindingSet.remove(removed):
+                for var, index in self._indexes.items():
+                    if var in binding:
+                        value = binding[var]["value"]
+                        index[value].pop(key, None)
+                        if not index[value]:
+                            del index[value]
+            for key, binding in self._bindingSet.add(added):
+                for var, index in self._indexes.items():
+                    if var in binding:
+                        index.setdefault(binding[var]["value"], {})[key] = binding
+        self._ready.set()
+        if self.handler is not None:
+            self.handler(added, removed)
+
+    def wait(self, timeout=None):
+        """
+        Waits for the first notification, i.e. for the initial result set.
+        Returns False if 'timeout' expired before.
+        """
+        return self._ready.wait(timeout=timeout)
+
+    def lookup(self, var, value):
+        """
+        Returns the bindings in which 'var' is bound to 'value'. The
+        lookup is a hash access if 'var' is indexed, a scan otherwise.
+        """
+        with self._lock:
+            index = self._indexes.get(var)
+            if index is not None:
+                return list(index.get(value, {}).values())
+            return [
+                binding for binding in self._bindingSet.bindings()
+                if var in binding and binding[var]["value"] == value]
+
+    def get(self, var, value, target):
+        """
+        Returns the value bound to 'target' in a binding where 'var' is
+        bound to 'value', or None: e.g. the current value of a sensor.
+        """
+        for binding in self.lookup(var, value):
+            if target in binding:
+                return binding[target]["value"]
+        return None
+
+    def snapshot(self):
+        """
+        Returns a copy of the current bindings.
+        """
+        with self._lock:
+            return self._bindingSet.bindings()
+
+    def close(self):
+        """
+        Closes the subscription that keeps the view up to date.
+        """
+        if self.unsubscribe is not None:
+            self.unsubscribe(self.subid)
+            self.unsubscribe = None
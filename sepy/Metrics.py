@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Metrics.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+Counters and latency histograms of the operations towards SEPA.
+Operations are timed phase by phase, e.g.
+
+    sepy_phase_seconds{operation="query",phase="network",endpoint="..."}
+
+and counted by outcome in sepy_operations_total. Metrics are disabled
+(and cost next to nothing) unless a Metrics instance is given to SEPA.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+# upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PHASE_SECONDS = "sepy_phase_seconds"
+OPERATIONS_TOTAL = "sepy_operations_total"
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullMetrics:
+    """
+    The default, disabled, metrics: nothing is recorded.
+    """
+    enabled = False
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return _NULL_TIMER
+
+    def phase(self, operation, phase, **labels):
+        return _NULL_TIMER
+
+
+NULL_METRICS = NullMetrics()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram:
+    """
+    Cumulative-ready bucket counts, sum and count of observed values.
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Keeps counters and histograms, identified by name and labels.
+    If given, 'callback' is called as callback(kind, name, value, labels)
+    for each value recorded, kind being "counter" or "histogram", e.g.
+    to forward them to another monitoring system.
+    """
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, callback=None):
+        self.buckets = tuple(buckets)
+        self.callback = callback
+        self._counters = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def count(self, name, value=1, **labels):
+        """
+        Increments the counter 'name' by 'value'.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        if self.callback is not None:
+            self.callback("counter", name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """
+        Records 'value' in the histogram 'name'.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+        if self.callback is not None:
+            self.callback("histogram", name, value, labels)
+
+    def timer(self, name, **labels):
+        """
+        Returns a context manager recording its duration in 'name'.
+        """
+        return _Timer(self, name, labels)
+
+    def phase(self, operation, phase, **labels):
+        """
+        Returns a context manager timing a 'phase' of an 'operation'.
+        """
+        return _Timer(self, PHASE_SECONDS,
+                      dict(labels, operation=operation, phase=phase))
+
+    def snapshot(self):
+        """
+        Returns the current values, as a dict with the "counters" and
+        "histograms" lists of (name, labels, value) tuples; histogram
+        values are dicts with "buckets", "sum" and "count".
+        """
+        with self._lock:
+            counters = [
+                (name, dict(labels), value)
+                for (name, labels), value in self._counters.items()]
+            histograms = [
+                (name, dict(labels), {
+                    "buckets": list(zip(self.buckets + (float("inf"),),
+                                        _cumulative(histogram.counts))),
+                    "sum": histogram.sum,
+                    "count": histogram.count})
+                for (name, labels), histogram in self._histograms.items()]
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheus(self):
+        """
+        Returns the current values in the Prometheus text format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _, _ in snapshot["counters"]}):
+            lines.append("# TYPE {} counter".format(name))
+            for other, labels, value in snapshot["counters"]:
+                if other == name:
+                    lines.append("{}{} {}".format(name, _labels(labels), value))
+        for name in sorted({name for name, _, _ in snapshot["histograms"]}):
+            lines.append("# TYPE {} histogram".format(name))
+            for other, labels, histogram in snapshot["histograms"]:
+                if other != name:
+                    continue
+                for bound, count in histogram["buckets"]:
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append("{}_bucket{} {}".format(
+                        name, _labels(dict(labels, le=le)), count))
+                lines.append("{}_sum{} {}".format(
+                    name, _labels(labels), histogram["sum"]))
+                lines.append("{}_count{} {}".format(
+                    name, _labels(labels), histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+def _cumulative(counts):
+    total = 0
+    for count in counts:
+        total += count
+        yield total
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in sorted(labels.items())) + "}"
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  QueryCache.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .Results import BindingSet
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+import logging
+import json
+
+
+class CacheEntry:
+    """
+    A cached query result. Live entries are kept up to date by a SEPA
+    subscription on the same sparql: their bindings are patched with
+    each notification, and the result is rebuilt on the next read.
+    """
+    __slots__ = ("key", "results", "size", "expires", "head",
+                 "subid", "alive", "unsubscribe", "bindingSet")
+
+    def __init__(self, key, results, size, expires):
+        self.key = key
+        self.results = results
+        self.size = size
+        self.expires = expires
+        self.head = results.get("head")
+        # live entries only
+        self.subid = None
+        self.alive = None
+        self.unsubscribe = None
+        self.bindingSet = None
+
+    @property
+    def live(self):
+        return self.alive is not None
+
+    def get(self):
+        if self.results is None:
+            self.results = {
+                "head": self.head,
+                "results": {"bindings": self.bindingSet.bindings()}}
+        return self.results
+
+    def notify(self, added, removed):
+        """
+        Patches the live entry with a notification. The first one
+        (i.e. the subscription confirmation) carries the whole current
+        result, and replaces what has been obtained by the query.
+        Returns the size variation of the entry.
+        """
+        if self.bindingSet is None:
+            self.bindingSet = BindingSet(added)
+            delta = len(json.dumps(added)) - self.size
+        else:
+            delta = len(json.dumps(added)) - len(json.dumps(removed))
+            self.bindingSet.remove(removed)
+            self.bindingSet.add(added)
+        self.results = None
+        self.size += delta
+        return delta
+
+
+class QueryCache:
+    """
+    LRU cache of query results, keyed by the query endpoint and the
+    final sparql. Entries expire after 'ttl' seconds, unless they are
+    live: in 'live' mode, a cached query is kept up to date by a SEPA
+    subscription on the same sparql, and never expires.
+    Cached results are shared, and must not be modified by the caller.
+    """
+    def __init__(self, max_entries=1024, max_bytes=64*1024*1024,
+                 ttl=None, live=False):
+        """
+        Constructor of the QueryCache class.
+        'max_entries' is the maximum number of cached queries.
+        'max_bytes' is the maximum size of the cached results, estimated
+        from their JSON serialization.
+        'ttl' is the time in seconds after which a result is dropped;
+        None to keep it until evicted.
+        'live' activates the subscription driven update of cached results.
+        """
+        self.logger = logging.getLogger("sepaLogger")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.live = live
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, host, sparql):
+        """
+        Returns the cached results of 'sparql' on 'host', or None.
+        """
+        key = (host, sparql)
+        evicted = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.live:
+                stale = not entry.alive()
+            else:
+                stale = (entry.expires is not None) and (monotonic() > entry.expires)
+            if stale:
+                evicted = self._pop(key)
+            else:
+                self._entries.move_to_end(key)
+                return entry.get()
+        self._close([evicted])
+        return None
+
+    def put(self, host, sparql, results, size):
+        """
+        Caches the 'results' of 'sparql' on 'host'. 'size' is the
+        length of their JSON serialization.
+        Returns the cache entry.
+        """
+        key = (host, sparql)
+        entry = CacheEntry(
+            key, results, size,
+            None if self.ttl is None else monotonic() + self.ttl)
+        with self._lock:
+            evicted = [self._pop(key)] if key in self._entries else []
+            self._entries[key] = entry
+            self.size += size
+            evicted += self._shrink()
+        self._close(evicted)
+        return entry
+
+    def make_live(self, entry, subid, alive, unsubscribe):
+        """
+        Turns 'entry' into a live one, kept up to date by the
+        subscription 'subid'. 'alive' is a function telling whether the
+        subscription is still open, 'unsubscribe' the one closing it.
+        Returns False if the entry has already been evicted.
+        """
+        with self._lock:
+            if self._entries.get(entry.key) is not entry:
+                return False
+            entry.subid = subid
+            entry.alive = alive
+            entry.unsubscribe = unsubscribe
+            entry.expires = None
+            return True
+
+    def notifier(self, entry):
+        """
+        Returns the subscription handler that patches 'entry'.
+        """
+        def notify(added, removed):
+            with self._lock:
+                delta = entry.notify(added, removed)
+                if self._entries.get(entry.key) is not entry:
+                    return
+                self.size += delta
+                evicted = self._shrink()
+            self._close(evicted)
+        return notify
+
+    def invalidate(self, host=None, sparql=None):
+        """
+        Drops the entries of 'sparql' on 'host'. If one of the two is
+        None, all the matching entries are dropped.
+        """
+        with self._lock:
+            evicted = [
+                self._pop(key) for key in list(self._entries)
+                if (host is None or key[0] == host) and (sparql is None or key[1] == sparql)]
+        self._close(evicted)
+
+    def clear(self):
+        """
+        Drops all the entries, closing the live ones.
+        """
+        self.invalidate()
+
+    def _pop(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        return entry
+
+    def _shrink(self):
+        evicted = []
+        while self._entries and (
+                len(self._entries) > self.max_entries or self.size > self.max_bytes):
+            evicted.append(self._pop(next(iter(self._entries))))
+        return evicted
+
+    def _close(self, entries):
+        # unsubscription of live entries is done outside of the lock
+        for entry in entries:
+            if entry.unsubscribe is not None:
+                try:
+                    entry.unsubscribe(entry.subid)
+                except Exception as e:
+                    self.logger.warning(
+                        "Unable to close live cache entry: {}".format(e))
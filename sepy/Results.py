@@ -0,0 +1,513 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Results.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+Utilities to handle SPARQL JSON results and SEPA notifications.
+"""
+
+from array import array
+from codecs import getincrementaldecoder
+from collections import Counter
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from json import JSONDecoder, JSONDecodeError
+
+import re
+import sys
+
+# the beginning of the bindings array in SPARQL JSON results
+BINDINGS_START = re.compile(r'"bindings"\s*:\s*\[')
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+# xsd datatype -> kind of the converted values
+XSD_KINDS = {XSD + datatype: "int" for datatype in (
+    "integer", "int", "long", "short", "byte",
+    "nonNegativeInteger", "nonPositiveInteger",
+    "positiveInteger", "negativeInteger",
+    "unsignedLong", "unsignedInt", "unsignedShort", "unsignedByte")}
+XSD_KINDS.update({XSD + datatype: "float" for datatype in (
+    "double", "float", "decimal")})
+XSD_KINDS[XSD + "dateTime"] = "datetime"
+XSD_KINDS[XSD + "boolean"] = "bool"
+
+
+def parseDateTime(value):
+    """
+    Parses an xsd:dateTime, into an aware datetime if it has a timezone.
+    """
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
+
+
+# translation of term kind codes to the mask of unbound values
+UNBOUND_MASK = bytes([1] + [0] * 255)
+
+# kind -> (conversion of a term value, array typecode, fill value)
+CONVERSIONS = {
+    "int": (int, "q", 0),
+    "float": (float, "d", float("nan")),
+    "bool": (lambda value: value in ("true", "1"), "B", False),
+    "datetime": (parseDateTime, None, None),
+    "str": (str, None, None)}
+
+
+def bindingKey(binding):
+    """
+    Returns a hashable key for 'binding', a dict variable -> term as
+    found in SPARQL JSON results. Two bindings have the same key if
+    they bind the same variables to the same terms.
+    """
+    return frozenset(
+        (var, term["type"], term["value"],
+         term.get("datatype"), term.get("xml:lang"))
+        for var, term in binding.items())
+
+
+def mergeNotifications(notifications):
+    """
+    Merges consecutive notifications, given as (added, removed) pairs,
+    into a single net (added, removed) pair: bindings added and then
+    removed (or the other way round) cancel out.
+    """
+    delta = Counter()
+    bindings = {}
+    for added, removed in notifications:
+        for binding in removed:
+            key = bindingKey(binding)
+            bindings.setdefault(key, binding)
+            delta[key] -= 1
+        for binding in added:
+            key = bindingKey(binding)
+            bindings.setdefault(key, binding)
+            delta[key] += 1
+    added = []
+    removed = []
+    for key, count in delta.items():
+        if count > 0:
+            added += [bindings[key]] * count
+        elif count < 0:
+            removed += [bindings[key]] * -count
+    return added, removed
+
+
+def iterBindings(chunks):
+    """
+    Parses incrementally SPARQL JSON results, given as an iterable of
+    bytes chunks, yielding their bindings one by one: only the bindings
+    not yet complete are kept in memory.
+    Raises ValueError if the document holds an error instead.
+    """
+    decoder = JSONDecoder()
+    utf8 = getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    position = None
+    done = False
+
+    def read():
+        nonlocal buffer, done
+        chunk = next(chunks, None)
+        if chunk is None:
+            done = True
+            buffer += utf8.decode(b"", final=True)
+        else:
+            buffer += utf8.decode(chunk)
+
+    # head, up to the bindings array
+    while position is None:
+        match = BINDINGS_START.search(buffer)
+        if match is not None:
+            position = match.end()
+        elif done:
+            document = decoder.decode(buffer)
+            if "error" in document:
+                raise ValueError(document["error"]["message"])
+            return
+        else:
+            read()
+
+    while True:
+        # skip separators
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            if done:
+                raise ValueError("Truncated SPARQL results")
+            buffer = ""
+            position = 0
+            read()
+            continue
+        if buffer[position] == "]":
+            return
+        try:
+            binding, end = decoder.raw_decode(buffer, position)
+        except JSONDecodeError:
+            # the binding is not complete yet
+            if done:
+                raise ValueError("Truncated SPARQL results")
+            buffer = buffer[position:]
+            position = 0
+            read()
+            continue
+        position = end
+        yield binding
+
+
+class BindingSet:
+    """
+    A multiset of bindings, kept in insertion order, that can be patched
+    with the added and removed bindings of SEPA notifications.
+    """
+    def __init__(self, bindings=[]):
+        # key -> [binding, multiplicity]
+        self.items = {}
+        self.add(bindings)
+
+    def __len__(self):
+        return sum(count for _, count in self.items.values())
+
+    def __contains__(self, binding):
+        return bindingKey(binding) in self.items
+
+    def add(self, bindings):
+        """
+        Adds 'bindings' to the set. Returns the (key, binding) pairs that
+        were not in the set before.
+        """
+        new = []
+        for binding in bindings:
+            key = bindingKey(binding)
+            item = self.items.get(key)
+            if item is None:
+                self.items[key] = [binding, 1]
+                new.append((key, binding))
+            else:
+                item[1] += 1
+        return new
+
+    def remove(self, bindings):
+        """
+        Removes 'bindings' from the set. Returns the (key, binding) pairs
+        that are not in the set anymore.
+        """
+        dropped = []
+        for binding in bindings:
+            key = bindingKey(binding)
+            item = self.items.get(key)
+            if item is not None:
+                item[1] -= 1
+                if item[1] == 0:
+                    del self.items[key]
+                    dropped.append((key, item[0]))
+        return dropped
+
+    def diff(self, other):
+        """
+        Returns the (added, removed) lists of bindings that turn this
+        set into 'other'.
+        """
+        added = []
+        for key, (binding, count) in other.items.items():
+            item = self.items.get(key)
+            added += [binding] * (count - (item[1] if item else 0))
+        removed = []
+        for key, (binding, count) in self.items.items():
+            item = other.items.get(key)
+            removed += [binding] * (count - (item[1] if item else 0))
+        return added, removed
+
+    def bindings(self):
+        """
+        Returns the list of the bindings in the set
+        """
+        return [
+            binding
+            for binding, count in self.items.values()
+            for _ in range(count)]
+
+
+class ColumnarResults:
+    """
+    A compact, column-wise representation of SPARQL JSON bindings.
+    Each variable has three arrays: the term kind (type, and whether a
+    datatype or language tag follows), the term value and the datatype
+    or language tag, both as ids in a term dictionary shared by all the
+    columns, so that each distinct string is stored once.
+    Iterating yields read-only binding views, usable as binding dicts.
+    """
+    def __init__(self, vars=(), bindings=()):
+        self.vars = []
+        self._columns = {}
+        # kind code -> (type, key of the extra field or None); 0 is unbound
+        self._kinds = [None]
+        self._kindCodes = {}
+        # term dictionary: id -> string, string -> id
+        self.terms = []
+        self._termIds = {}
+        self._length = 0
+        for var in vars:
+            self._addColumn(var)
+        self.extend(bindings)
+
+    @classmethod
+    def from_results(cls, jresults):
+        """
+        Builds the columnar form of SPARQL JSON results.
+        """
+        return cls(jresults["head"].get("vars", ()),
+                   jresults["results"]["bindings"])
+
+    def to_results(self):
+        """
+        Returns the SPARQL JSON results holding the same bindings.
+        """
+        return {"head": {"vars": list(self.vars)},
+                "results": {"bindings": self.bindings()}}
+
+    def _addColumn(self, var):
+        var = sys.intern(var)
+        self.vars.append(var)
+        column = (array("B", bytes(self._length)),
+                  array("i", [-1]) * self._length,
+                  array("i", [-1]) * self._length)
+        self._columns[var] = column
+        return column
+
+    def _termId(self, term):
+        termId = self._termIds.get(term)
+        if termId is None:
+            termId = len(self.terms)
+            self.terms.append(term)
+            self._termIds[term] = termId
+        return termId
+
+    def _kindCode(self, term):
+        if "datatype" in term:
+            kind = (term["type"], "datatype")
+        elif "xml:lang" in term:
+            kind = (term["type"], "xml:lang")
+        else:
+            kind = (term["type"], None)
+        code = self._kindCodes.get(kind)
+        if code is None:
+            code = len(self._kinds)
+            self._kinds.append(kind)
+            self._kindCodes[kind] = code
+        return code, kind[1]
+
+    def append(self, binding):
+        """
+        Appends a binding, given as a dict variable -> term.
+        """
+        for var in binding:
+            if var not in self._columns:
+                self._addColumn(var)
+        for var, (kinds, values, extras) in self._columns.items():
+            term = binding.get(var)
+            if term is None:
+                kinds.append(0)
+                values.append(-1)
+                extras.append(-1)
+            else:
+                code, extra = self._kindCode(term)
+                kinds.append(code)
+                values.append(self._termId(term["value"]))
+                extras.append(-1 if extra is None else self._termId(term[extra]))
+        self._length += 1
+
+    def extend(self, bindings):
+        for binding in bindings:
+            self.append(binding)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for row in range(self._length):
+            yield ColumnarRow(self, row)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self._length
+        if not 0 <= row < self._length:
+            raise IndexError("row index out of range")
+        return ColumnarRow(self, row)
+
+    def term(self, var, row):
+        """
+        Returns the term bound to 'var' in 'row', as a dict, or None.
+        """
+        column = self._columns.get(var)
+        if column is None:
+            return None
+        kinds, values, extras = column
+        code = kinds[row]
+        if code == 0:
+            return None
+        termType, extra = self._kinds[code]
+        term = {"type": termType, "value": self.terms[values[row]]}
+        if extra is not None:
+            term[extra] = self.terms[extras[row]]
+        return term
+
+    def column(self, var):
+        """
+        Returns the values bound to 'var', with None where unbound.
+        """
+        kinds, values, _ = self._columns[var]
+        terms = self.terms
+        return [terms[value] if value >= 0 else None for value in values]
+
+    def bindings(self):
+        """
+        Returns the list of the bindings, as dicts.
+        """
+        return [dict(row) for row in self]
+
+    def kind(self, var):
+        """
+        Returns the kind of the values of 'var' ("int", "float", "bool",
+        "datetime" or "str"), according to the datatypes of its literals.
+        """
+        kinds, _, extras = self._columns[var]
+        for code in set(kinds):
+            if code != 0:
+                termType, extra = self._kinds[code]
+                if extra != "datatype":
+                    return "str"
+        found = set()
+        for termId in set(extras):
+            if termId >= 0:
+                found.add(XSD_KINDS.get(self.terms[termId], "str"))
+        if found == {"int", "float"}:
+            return "float"
+        if len(found) == 1:
+            return found.pop()
+        return "str"
+
+    def _plan(self, var, dtypes):
+        kind = (dtypes or {}).get(var) or self.kind(var)
+        if kind not in CONVERSIONS:
+            raise ValueError("Unknown kind for {}: {}".format(var, kind))
+        return kind
+
+    def to_arrays(self, dtypes=None):
+        """
+        Returns a dict variable -> (values, mask). 'values' is an
+        array.array for int, float and bool variables, a list otherwise;
+        'mask' is an array.array with 1 where the variable is unbound
+        (where values hold 0, NaN, False or None).
+        The kind of each variable is inferred from its datatypes, or can
+        be forced through 'dtypes', a dict variable -> kind (see kind).
+        Each distinct term is converted once.
+        """
+        arrays = {}
+        for var in self.vars:
+            kind = self._plan(var, dtypes)
+            convert, typecode, fill = CONVERSIONS[kind]
+            kinds, values, _ = self._columns[var]
+            table = {-1: fill}
+            for termId in set(values):
+                if termId >= 0:
+                    table[termId] = convert(self.terms[termId])
+            converted = map(table.__getitem__, values)
+            arrays[var] = (
+                array(typecode, converted) if typecode else list(converted),
+                array("B", kinds.tobytes().translate(UNBOUND_MASK)))
+        return arrays
+
+    def to_numpy(self, dtypes=None):
+        """
+        Returns a dict variable -> numpy masked array, masked where the
+        variable is unbound: int64, float64, bool, datetime64[us] (in UTC)
+        or object arrays, according to the kind of the variable (see
+        to_arrays for 'dtypes'). Requires numpy.
+        """
+        import numpy
+
+        arrays = {}
+        for var in self.vars:
+            kind = self._plan(var, dtypes)
+            kinds, values, _ = self._columns[var]
+            mask = numpy.frombuffer(kinds, dtype=numpy.uint8) == 0
+            ids = numpy.frombuffer(values, dtype="i{}".format(values.itemsize))
+            # each distinct term is converted once, then gathered
+            unique, inverse = numpy.unique(ids, return_inverse=True)
+            strings = [self.terms[termId] if termId >= 0 else None
+                       for termId in unique.tolist()]
+            if kind == "int":
+                table = numpy.array(
+                    [string or "0" for string in strings]).astype(numpy.int64)
+            elif kind == "float":
+                table = numpy.array(
+                    [string or "nan" for string in strings]).astype(numpy.float64)
+            elif kind == "bool":
+                table = numpy.isin(
+                    numpy.array(strings, dtype=object), ["true", "1"])
+            elif kind == "datetime":
+                table = numpy.array(
+                    [_naiveUTC(string) for string in strings],
+                    dtype="datetime64[us]")
+            else:
+                table = numpy.array(strings, dtype=object)
+            arrays[var] = numpy.ma.MaskedArray(table[inverse], mask=mask)
+        return arrays
+
+
+def _naiveUTC(value):
+    if value is None:
+        return None
+    value = parseDateTime(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class ColumnarRow(Mapping):
+    """
+    A read-only view on a row of ColumnarResults, behaving as the
+    binding dict variable -> term.
+    """
+    __slots__ = ("results", "row")
+
+    def __init__(self, results, row):
+        self.results = results
+        self.row = row
+
+    def __getitem__(self, var):
+        term = self.results.term(var, self.row)
+        if term is None:
+            raise KeyError(var)
+        return term
+
+    def __iter__(self):
+        row = self.row
+        columns = self.results._columns
+        return (var for var in self.results.vars if columns[var][0][row])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -23,15 +23,27 @@
 #  
 
 from urllib.parse import urlparse, urlunparse
-from jinja2 import Environment, FileSystemLoader, BaseLoader
-from os.path import split, abspath, isfile
-from pkg_resources import resource_filename
-from collections import defaultdict
+from os import stat, environ, makedirs, replace, getpid
+from os.path import split, abspath, isfile, dirname, join, expanduser
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
+from hashlib import sha1
 from io import TextIOBase
+from threading import Lock
 
+import json
 import logging
+import re
 
-YsapTemplate = resource_filename(__name__, "ysap_template.sap")
+YsapTemplate = join(dirname(abspath(__file__)), "ysap_template.sap")
+
+# where SAPObject.from_file keeps the parsed saps
+SAP_CACHE_DIR = join(
+    environ.get("XDG_CACHE_HOME") or join(expanduser("~"), ".cache"),
+    "sepy", "sap")
+
+# a SPARQL variable, as ?name or $name
+SPARQL_VARIABLE = re.compile(r"([?$]\w+)")
 
 
 class SAPObject:
@@ -46,9 +58,44 @@ class SAPObject:
         parsed_sap_dict must be a dictionary.
         """
         self.parsed_sap = parsed_sap_dict
+        self._prefixes = None
+        self._urls = {}
+        self._compiled = {}
         self.logger = logging.getLogger("sapLogger")
         logging.basicConfig(format='%(levelname)s:%(message)s', level=log)
 
+    @classmethod
+    def from_file(cls, path, cache_dir=SAP_CACHE_DIR, log=logging.DEBUG):
+        """
+        Loads the sap file at 'path': a jsap is parsed as JSON, anything
+        else as YAML, with the C loader of pyyaml when available.
+        The parsed sap is kept in 'cache_dir', as JSON named after the
+        hash of the file, so that loading the same file again skips
+        the YAML parsing. Set 'cache_dir' to None to disable the cache.
+        """
+        with open(path, "rb") as sap_file:
+            content = sap_file.read()
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = join(cache_dir, sha1(content).hexdigest() + ".json")
+            try:
+                with open(cache_file, "rb") as cached:
+                    return cls(json.loads(cached.read()), log=log)
+            except (OSError, ValueError):
+                pass
+        parsed_sap = parseSap(content, path)
+        if cache_file is not None:
+            try:
+                makedirs(cache_dir, exist_ok=True)
+                temporary = "{}.{}.tmp".format(cache_file, getpid())
+                with open(temporary, "w") as cached:
+                    json.dump(parsed_sap, cached)
+                replace(temporary, cache_file)
+            except (OSError, TypeError, ValueError) as e:
+                logging.getLogger("sapLogger").debug(
+                    "Unable to cache sap {}: {}".format(path, e))
+        return cls(parsed_sap, log=log)
+
     def explore(self, path):
         """
         Generic SAP dictionary explorer.
@@ -116,11 +163,14 @@ class SAPObject:
         According to SAP data, this method builds up the query url to
         which send query requests.
         """
-        return urlunparse([
-            self.sparql11protocol(path=["protocol"]),
-            "{}:{}".format(self.host, self.sparql11protocol(path=["port"])),
-            self.sparql11protocol(["query", "path"]),
-            "", "", ""])
+        url = self._urls.get("query")
+        if url is None:
+            url = self._urls["query"] = urlunparse([
+                self.sparql11protocol(path=["protocol"]),
+                "{}:{}".format(self.host, self.sparql11protocol(path=["port"])),
+                self.sparql11protocol(["query", "path"]),
+                "", "", ""])
+        return url
 
     @property
     def update_url(self):
@@ -128,11 +178,14 @@ class SAPObject:
         According to SAP data, this method builds up the update url to
         which send update requests
         """
-        return urlunparse([
-            self.sparql11protocol(path=["protocol"]),
-            "{}:{}".format(self.host, self.sparql11protocol(path=["port"])),
-            self.sparql11protocol(["update", "path"]),
-            "", "", ""])
+        url = self._urls.get("update")
+        if url is None:
+            url = self._urls["update"] = urlunparse([
+                self.sparql11protocol(path=["protocol"]),
+                "{}:{}".format(self.host, self.sparql11protocol(path=["port"])),
+                self.sparql11protocol(["update", "path"]),
+                "", "", ""])
+        return url
 
     @property
     def subscribe_url(self):
@@ -140,12 +193,15 @@ class SAPObject:
         According to SAP data, this method builds up the subscribe url 
         to which send subscription and unsubscription requests
         """
-        use_protocol = self.sparql11seprotocol(["protocol"])
-        return urlunparse([
-            use_protocol,
-            "{}:{}".format(self.host, self.sparql11seprotocol(["availableProtocols", use_protocol, "port"])),
-            self.sparql11seprotocol(["availableProtocols", use_protocol, "path"]),
-            "", "", ""])
+        url = self._urls.get("subscribe")
+        if url is None:
+            use_protocol = self.sparql11seprotocol(["protocol"])
+            url = self._urls["subscribe"] = urlunparse([
+                use_protocol,
+                "{}:{}".format(self.host, self.sparql11seprotocol(["availableProtocols", use_protocol, "port"])),
+                self.sparql11seprotocol(["availableProtocols", use_protocol, "path"]),
+                "", "", ""])
+        return url
 
     @property
     def updates(self):
@@ -165,7 +221,8 @@ class SAPObject:
 
     def getSparql(self,
                   sparqlSet,
-                  identifier, forcedBindings={}, bindingCheck=True):
+                  identifier, forcedBindings={}, bindingCheck=True,
+                  prefixes=True):
         """
         Get a sparql from the sap, and performs forced bindings check and
         substitution.
@@ -177,25 +234,29 @@ class SAPObject:
         ALL required bindings have been specified in forcedBindings,
         otherwise raising exception. The check will be skipped, if set to
         False.
-        """
-        if "forcedBindings" in sparqlSet[identifier]:
-            bindings = sparqlSet[identifier]["forcedBindings"]
-            if bindingCheck:
-                checkBindings(forcedBindings, bindings)
-            for b in (set(bindings.keys()) & set(forcedBindings.keys())):
-                bindings[b]["value"] = forcedBindings[b]
-        else:
-            bindings = {}
-        return sparqlBuilder(
-            sparqlSet[identifier]["sparql"],
-            bindings,
-            namespaces=self.get_namespaces(stringList=True))
-
-    def getUpdate(self, identifier, forcedBindings={}):
+        'prefixes' can be set to False to get the sparql without the
+        PREFIX declarations of the SAP namespaces.
+        The SAP is never modified, so the same SAPObject can be used
+        by many threads at once.
+        """
+        entry = sparqlSet[identifier]
+        key = (id(sparqlSet), identifier)
+        compiled = self._compiled.get(key)
+        if (compiled is None) or (compiled.entry is not entry) or (
+                compiled.sparql != entry["sparql"]):
+            compiled = CompiledSparql(entry)
+            self._compiled[key] = compiled
+        if bindingCheck:
+            compiled.check(forcedBindings)
+        return compiled.render(
+            forcedBindings, self.prefix_block() if prefixes else " ")
+
+    def getUpdate(self, identifier, forcedBindings={}, prefixes=True):
         """
         See getSparql, with 'sparqlSet' as 'updates'
         """
-        return self.getSparql(self.updates, identifier, forcedBindings)
+        return self.getSparql(
+            self.updates, identifier, forcedBindings, prefixes=prefixes)
 
     def getQuery(self, identifier, forcedBindings={}):
         """
@@ -219,8 +280,40 @@ class SAPObject:
         else:
             return namespaces
 
+    def prefix_block(self):
+        """
+        Returns the PREFIX declarations of the SAP namespaces, as they
+        are put in front of each sparql. The block is computed once.
+        """
+        if self._prefixes is None:
+            self._prefixes = " ".join(self.get_namespaces(stringList=True)) + " "
+        return self._prefixes
+
     def update_namespaces(self, ns_id, ns_uri):
         self.get_namespaces()[ns_id] = ns_uri
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drops the endpoint urls, the PREFIX block and the compiled
+        sparqls computed from the sap. To be called after modifying
+        'parsed_sap' directly.
+        """
+        self._prefixes = None
+        self._urls = {}
+        self._compiled = {}
+
+
+def parseSap(content, path=""):
+    """
+    Parses the sap file 'content' (bytes): JSON if 'path' ends in
+    .jsap, YAML otherwise.
+    """
+    if path.endswith(".jsap"):
+        return json.loads(content)
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    return yaml.load(content, Loader=loader)
 
 
 def checkBindings(current, expected):
@@ -269,15 +362,102 @@ def sparqlBuilder(unbound_sparql, bindings, namespaces=[]):
     """
     Forced bindings substitution into unbounded SPARQL
     """
-    sparql = " ".join(namespaces) + " " + unbound_sparql
-    for b in bindings.keys():
-        bValue = bindings[b]["value"]
-        if bValue is not None:
-            if (bindings[b]["type"] == "literal") and (bValue != "UNDEF"):
-                sparql = sparql.replace("?"+b, "'"+bValue+"'")
-            else:
-                sparql = sparql.replace("?"+b, uriFormat(bValue))
-    return sparql
+    return compileSparql(unbound_sparql).render(
+        bindings, " ".join(namespaces) + " ")
+
+
+def termFormat(bType, bValue):
+    """
+    Formats the value of a forced binding as a SPARQL term
+    """
+    if (bType == "literal") and (bValue != "UNDEF"):
+        return "'"+bValue+"'"
+    return uriFormat(bValue)
+
+
+class SparqlTemplate:
+    """
+    A SPARQL parsed once into text segments and variable slots, so that
+    forced bindings substitution is a single join.
+    """
+    __slots__ = ("sparql", "parts", "slots")
+
+    def __init__(self, sparql):
+        self.sparql = sparql
+        # text segments at even indices, variables at odd indices
+        self.parts = SPARQL_VARIABLE.split(sparql)
+        self.slots = {}
+        for i in range(1, len(self.parts), 2):
+            self.slots.setdefault(self.parts[i][1:], []).append(i)
+
+    def render(self, bindings, head=""):
+        """
+        Substitutes the forced 'bindings' (as they are in the SAP) into
+        the variables, and puts 'head' in front of the result.
+        """
+        parts = self.parts[:]
+        for b, binding in bindings.items():
+            slots = self.slots.get(b)
+            if slots is None:
+                continue
+            bValue = binding["value"]
+            if bValue is not None:
+                term = termFormat(binding["type"], bValue)
+                for i in slots:
+                    parts[i] = term
+        return head + "".join(parts)
+
+
+class CompiledSparql:
+    """
+    A SAP query or update entry, compiled once: its SparqlTemplate,
+    and the metadata of the forced bindings that have a slot in it.
+    Rendering merges the given forced bindings with the SAP defaults
+    without modifying the SAP entry.
+    """
+    __slots__ = ("entry", "sparql", "template", "bindings", "required")
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.sparql = entry["sparql"]
+        self.template = compileSparql(self.sparql)
+        expected = entry.get("forcedBindings", {})
+        # forced bindings without default value
+        self.required = frozenset(
+            b for b in expected if expected[b]["value"] == "")
+        self.bindings = tuple(
+            (b, expected[b]["type"], expected[b]["value"], tuple(self.template.slots[b]))
+            for b in expected if b in self.template.slots)
+
+    def check(self, forcedBindings):
+        """
+        Raises KeyError if a required forced binding is not given
+        """
+        for key in self.required:
+            if key not in forcedBindings:
+                raise KeyError(key+" is a required forcedbinding")
+
+    def render(self, forcedBindings, head=""):
+        """
+        Substitutes 'forcedBindings', or the SAP defaults, into the
+        sparql, and puts 'head' in front of the result.
+        """
+        parts = self.template.parts[:]
+        for b, bType, default, slots in self.bindings:
+            bValue = forcedBindings.get(b, default)
+            if bValue is not None:
+                term = termFormat(bType, bValue)
+                for i in slots:
+                    parts[i] = term
+        return head + "".join(parts)
+
+
+@lru_cache(maxsize=1024)
+def compileSparql(unbound_sparql):
+    """
+    Returns the (cached) SparqlTemplate of 'unbound_sparql'
+    """
+    return SparqlTemplate(unbound_sparql)
 
 
 def generate(sap_template,
@@ -295,9 +475,37 @@ def generate(sap_template,
     Generates an ysap file, and returns it as string.
     If destination_file is given, the file is created and written at
     the corresponding path. The same is returned as string.
+    The template is compiled once, and kept by a module-level
+    SAPGenerator.
+    """
+    logger = logging.getLogger("sapLogger")
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+    if (sap_template is not None) and not isfile(sap_template):
+        logger.warning("'sap_template' is interpreted as string")
+    render_data = renderData(
+        host, sparql11, sparql11se, queries=queries, updates=updates,
+        namespaces=namespaces, graphs=graphs, extended=extended,
+        oauth=oauth, logger=logger)
+    return defaultGenerator().render(
+        sap_template, render_data, destination_file=destination_file)
+
+
+def renderData(host,
+               sparql11,
+               sparql11se,
+               queries=None,
+               updates=None,
+               namespaces=None,
+               graphs=None,
+               extended=None,
+               oauth=None,
+               logger=None):
     """
-    if sap_template is None:
-        raise ValueError("'sap_template' cannot be None")
+    Checks the parameters of a sap, and returns the data to render the
+    sap template with. Warnings about unchecked content are logged on
+    'logger', if given.
+    """
+    warning = logger.warning if logger is not None else (lambda message: None)
     if host is None:
         raise ValueError("'host' cannot be None")
     if sparql11 is None:
@@ -306,23 +514,7 @@ def generate(sap_template,
         raise ValueError("'sparql11se' cannot be None")
     if ((queries is None or queries == {}) and (updates is None or updates == {})):
         raise ValueError("'queries' and 'updates' cannot be both None or empty")
-    logger = logging.getLogger("sapLogger")
-    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
-    if isfile(sap_template):
-        logger.debug("'sap_template' is a path to existing file")
-        sap_dir, sap_file = split(abspath(sap_template))
-        j2_env = Environment(
-            loader=FileSystemLoader(sap_dir),
-            trim_blocks=True, lstrip_blocks=True)
-        template = j2_env.get_template(sap_file)
-    else:
-        logger.warning("'sap_template' is interpreted as string")
-        j2_env = Environment(
-            loader=BaseLoader(),
-            trim_blocks=True, lstrip_blocks=True)
-        template = j2_env.from_string(sap_template)
-    
     render_data = {}
     render_data["host_ip_address"] = host
     
@@ -334,12 +526,12 @@ def generate(sap_template,
         raise KeyError("Missing key in sparql11::update parameter")
     render_data["sparql11"] = sparql11
     
-    logger.warning("No check is made on sparql11se content, except 'protocol'!")
+    warning("No check is made on sparql11se content, except 'protocol'!")
     if "protocol" not in sparql11se.keys():
         raise KeyError("Missing 'protocol' key in sparql11se parameter")
     render_data["sparql11se"] = sparql11se
     
-    logger.warning("No check is made on queries and updates, except 'sparql'!")
+    warning("No check is made on queries and updates, except 'sparql'!")
     if (queries is not None) and (queries != {}):
         for key in queries.keys():
             if "sparql" not in queries[key].keys():
@@ -353,29 +545,158 @@ def generate(sap_template,
                     "Missing 'sparql' key in updates::{}".format(key))
         render_data["updates"] = updates
     if oauth is not None:
-        logger.warning("No check is made on oauth content!")
+        warning("No check is made on oauth content!")
         render_data["oauth"] = oauth
     if namespaces is not None:
-        logger.warning("No check is made on namespaces content!")
+        warning("No check is made on namespaces content!")
         render_data["namespaces"] = namespaces
     if graphs is not None:
-        logger.warning("No check is made on graphs content!")
+        warning("No check is made on graphs content!")
         render_data["graphs"] = graphs
     if extended is not None:
-        logger.warning("No check is made on extended content!")
+        warning("No check is made on extended content!")
         render_data["extended"] = extended
-    
-    sapFileString = template.render(render_data)
-    if destination_file is not None:
-        try:
-            if isinstance(destination_file, TextIOBase):
-                print(sapFileString, file=destination_file)
+    return render_data
+
+
+class SAPGenerator:
+    """
+    Generates sap files from a jinja2 template, for many sets of
+    parameters. Compiled templates are cached: file templates by path
+    and modification time, string templates by content hash.
+    """
+    def __init__(self, max_templates=64):
+        """
+        Constructor of the SAPGenerator class. At most 'max_templates'
+        compiled templates are kept.
+        """
+        self.logger = logging.getLogger("sapLogger")
+        self.max_templates = max_templates
+        self._templates = OrderedDict()
+        self._environments = {}
+        self._lock = Lock()
+
+    def _environment(self, directory):
+        from jinja2 import Environment, FileSystemLoader, BaseLoader
+
+        environment = self._environments.get(directory)
+        if environment is None:
+            environment = Environment(
+                loader=FileSystemLoader(directory) if directory else BaseLoader(),
+                trim_blocks=True, lstrip_blocks=True,
+                auto_reload=False, cache_size=0)
+            self._environments[directory] = environment
+        return environment
+
+    def template(self, sap_template):
+        """
+        Returns the compiled template, given as the path to a file or as
+        a string.
+        """
+        if sap_template is None:
+            raise ValueError("'sap_template' cannot be None")
+        if isfile(sap_template):
+            path = abspath(sap_template)
+            status = stat(path)
+            key = (path, status.st_mtime_ns, status.st_size)
+        else:
+            path = None
+            key = sha1(sap_template.encode("utf-8")).hexdigest()
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                return template
+            if path is not None:
+                sap_dir, sap_file = split(path)
+                template = self._environment(sap_dir).get_template(sap_file)
             else:
-                with open(destination_file, "w") as csap:
-                    print(sapFileString, file=csap)
-        except Exception as e:
-            logger.error("Unable to export sapFile: {}".format(e))
-    return sapFileString
+                template = self._environment(None).from_string(sap_template)
+            self._templates[key] = template
+            if len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+            return template
+
+    def render(self, sap_template, render_data, destination_file=None):
+        """
+        Renders 'sap_template' with 'render_data' (see renderData), and
+        returns the sap as a string. If destination_file is given, the
+        sap is also written there.
+        """
+        sapFileString = self.template(sap_template).render(render_data)
+        if destination_file is not None:
+            try:
+                if isinstance(destination_file, TextIOBase):
+                    print(sapFileString, file=destination_file)
+                else:
+                    with open(destination_file, "w") as csap:
+                        csap.write(sapFileString + "\n")
+            except Exception as e:
+                self.logger.error("Unable to export sapFile: {}".format(e))
+        return sapFileString
+
+    def generate(self, sap_template, destination_file=None, **parameters):
+        """
+        Same as the generate function: 'parameters' are its keyword
+        arguments.
+        """
+        return self.render(
+            sap_template, renderData(**parameters),
+            destination_file=destination_file)
+
+    def generate_many(self, sap_template, parameters, destinations=None,
+                      processes=None, chunk_size=100):
+        """
+        Generates a sap for each dict of generate keyword arguments in
+        'parameters', writing it to the path at the same position in
+        'destinations', if given. Returns the list of the saps.
+        With 'processes', saps are rendered and written by a pool of
+        that many processes, 'chunk_size' saps at a time.
+        """
+        parameters = list(parameters)
+        if destinations is None:
+            destinations = [None] * len(parameters)
+        else:
+            destinations = list(destinations)
+            if len(destinations) != len(parameters):
+                raise ValueError("'destinations' and 'parameters' must have the same length")
+        jobs = list(zip(parameters, destinations))
+        if not processes:
+            return [
+                self.generate(sap_template, destination_file=destination, **params)
+                for params, destination in jobs]
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        # the template is compiled in the parent, to fail early
+        self.template(sap_template)
+        chunks = [jobs[i:i+chunk_size] for i in range(0, len(jobs), chunk_size)]
+        saps = []
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for chunk in executor.map(
+                    _generateChunk, [sap_template] * len(chunks), chunks):
+                saps += chunk
+        return saps
+
+
+_default_generator = None
+
+
+def defaultGenerator():
+    """
+    Returns the SAPGenerator shared by the generate calls.
+    """
+    global _default_generator
+    if _default_generator is None:
+        _default_generator = SAPGenerator()
+    return _default_generator
+
+
+def _generateChunk(sap_template, jobs):
+    generator = defaultGenerator()
+    return [
+        generator.generate(sap_template, destination_file=destination, **params)
+        for params, destination in jobs]
 
 
 def defaultdict_to_dict(d):
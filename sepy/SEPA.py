@@ -24,19 +24,64 @@
 
 from .SAPObject import SAPObject
 from .ConnectionHandler import *
+from .MaterializedView import MaterializedView
+from .Dispatcher import NotificationCoalescer
+from .Decoder import decode
+from .Results import iterBindings, ColumnarResults
+from .Metrics import NULL_METRICS, OPERATIONS_TOTAL
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from urllib.parse import urlparse
 
 import logging
 import json
+import re
+
+# maximum size in bytes of a batched update request
+DEFAULT_BATCH_PAYLOAD = 1048576
+
+# bytes read at a time from streamed query results
+DEFAULT_CHUNK_SIZE = 65536
+
+# bindings per page of paginated queries
+DEFAULT_PAGE_SIZE = 10000
+
+# PREFIX and BASE declarations at the beginning of a query
+PROLOGUE = re.compile(
+    r"\s*((?:(?:PREFIX\s+[^\s:]*:\s*<[^>]*>|BASE\s*<[^>]*>)\s*)*)(.*)",
+    re.IGNORECASE | re.DOTALL)
+
+# the beginning of a SELECT query, and its dataset clauses
+SELECT = re.compile(r"\s*SELECT\b", re.IGNORECASE)
+DATASET = re.compile(
+    r"(?<![?$\w])FROM\s+(?:NAMED\s+)?(?:<[^>]*>|[^\s{<]*:[^\s{]*)",
+    re.IGNORECASE)
 
 
 class SEPA:
-    def __init__(self, sapObject=None, client_id=None, logLevel=logging.ERROR):
+    def __init__(self, sapObject=None, client_id=None, logLevel=logging.ERROR,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 query_cache=None, credentials_file=None, reconnect=False,
+                 max_backoff=DEFAULT_MAX_BACKOFF, dispatcher=None, metrics=None):
         """
         Constructor for SEPA engine representation.
         'sapObject' must be given, to use update, query, subscribe functions.
         'client_id
+        'pool_maxsize' and 'idle_timeout' configure the keep-alive
+        connections towards each host (see ConnectionHandler).
+        'query_cache' is an optional QueryCache for query results.
+        'credentials_file' is the path where client credentials are kept
+        between runs, to skip registration (see ConnectionHandler).
+        'reconnect' enables the automatic renewal of subscriptions whose
+        websocket dropped, waiting at most 'max_backoff' seconds between
+        attempts (see ConnectionHandler).
+        'dispatcher' is an optional NotificationDispatcher, running the
+        subscription handlers out of the websocket threads.
+        'metrics' is an optional Metrics instance, recording the latency
+        of each phase of the operations (see sepy.Metrics).
         """
         # logger configuration
         self.logger = logging.getLogger("sepaLogger")
@@ -46,7 +91,17 @@ class SEPA:
 
         # initialize data structures
         self.sap = sapObject
-        self.connectionManager = ConnectionHandler(client_id=client_id, logLevel=logLevel)
+        self.query_cache = query_cache
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.connectionManager = ConnectionHandler(
+            client_id=client_id, logLevel=logLevel,
+            pool_maxsize=pool_maxsize, idle_timeout=idle_timeout,
+            credentials_file=credentials_file, reconnect=reconnect,
+            max_backoff=max_backoff, dispatcher=dispatcher, metrics=self.metrics)
+        # workers for concurrent requests, one per pooled connection
+        self.pool_maxsize = pool_maxsize
+        self._executor = None
+        self._executor_lock = Lock()
     
     def get_client_id(self):
         """
@@ -54,6 +109,23 @@ class SEPA:
         """
         return self.connectionManager.get_client_id()
 
+    def close(self):
+        """
+        Closes the keep-alive connections towards SEPA.
+        """
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        self.connectionManager.close()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pool_maxsize, thread_name_prefix="sepy")
+            return self._executor
+
     def get_subscriptions(self):
         """
         Getter for subscriptions currently opened, in a dict form
@@ -67,7 +139,8 @@ class SEPA:
         self.sap = sapObject
 
     def query(self, sapIdentifier, forcedBindings={}, destination=None,
-              host=None, token_url=None, register_url=None):
+              host=None, token_url=None, register_url=None, columnar=False,
+              cache=True):
         """
         Performs a query with the sap entry tag 'sapIdentifier';
         'forcedBindings' can be given as dict form for substitution.
@@ -75,54 +148,267 @@ class SEPA:
         'destination' field to give the path.
         'host', 'token_url' and 'register_url' can be given to overwrite
         the sap values (if any).
-        Returns the output of the query.
+        Returns the output of the query (see sparql_query for 'columnar'
+        and 'cache').
         """
-        sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
+        with self.metrics.phase("query", "build", sap=sapIdentifier):
+            sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
         return self.sparql_query(
             sparql, destination=destination,
-            host=host, token_url=token_url, register_url=register_url)
+            host=host, token_url=token_url, register_url=register_url,
+            columnar=columnar, cache=cache)
 
     def sparql_query(self, sparql, destination=None, host=None,
-                     token_url=None, register_url=None):
+                     token_url=None, register_url=None, columnar=False,
+                     cache=True):
         """
         Performs a query with the plain sparql;
         If you want to store the output of the query in a file, use the
         'destination' field to give the path.
         'host', 'token_url' and 'register_url' can be given to overwrite
         the sap values (if any).
-        Returns the output of the query.
+        'cache' can be set to False to bypass the query cache (if any),
+        e.g. for one-shot reads.
+        Returns the output of the query, as a ColumnarResults if
+        'columnar' is True.
         """
         # perform the query request
         if self.sap is None and host is None:
             raise ValueError("Host parametrization is necessary if no SAPObject is given to SEPA instance")
         sepa_host = self.sap.query_url if (host is None) else host
+        use_cache = cache and (self.query_cache is not None)
+        if use_cache:
+            jresults = self.query_cache.get(sepa_host, sparql)
+            if jresults is not None:
+                if destination is not None:
+                    self._write_results(jresults, destination, sepa_host)
+                return ColumnarResults.from_results(jresults) if columnar else jresults
         protocol = urlparse(sepa_host).scheme
         if protocol == "https":
             if self.sap is None and (token_url is None or register_url is None):
                 raise ValueError("Token and Register URL must not be None if no SAPObject is given to SEPA instance")
             sepa_token = self.sap.tokenRequest_url if (token_url is None) else token_url
             sepa_register = self.sap.registration_url if (register_url is None) else register_url
-            status, results = self.connectionManager.secureRequest(
-                sepa_host, sparql, True, sepa_token, sepa_register)
+            with self.metrics.phase("query", "network", endpoint=sepa_host):
+                status, results = self.connectionManager.secureRequest(
+                    sepa_host, sparql, True, sepa_register, sepa_token, raw=True)
         elif protocol == "http":
-            status, results = self.connectionManager.unsecureRequest(
-                sepa_host, sparql, True)
+            with self.metrics.phase("query", "network", endpoint=sepa_host):
+                status, results = self.connectionManager.unsecureRequest(
+                    sepa_host, sparql, True, raw=True)
         else:
             raise NotImplementedError("Still only http, https, ws, wss protocols are implemented")
+        self.metrics.count(
+            OPERATIONS_TOTAL, operation="query", endpoint=sepa_host, status=status)
         if int(status) == 200:
-            jresults = json.loads(results)
+            with self.metrics.phase("query", "decode", endpoint=sepa_host):
+                jresults = decode(results)
             if "error" in jresults:
-                self.logger.error(jresults["error"]["message"])
+                error_message = jresults["error"]["message"]
+                self.logger.error(error_message)
                 raise ValueError(error_message)
             elif destination is not None:
-                with open(destination, "w") as fileDest:
-                    print(json.dumps(jresults), file=fileDest)
-            return jresults
+                self._write_results(jresults, destination, sepa_host)
+            if use_cache:
+                self._cache_results(
+                    sepa_host, sparql, jresults, len(results),
+                    host, token_url, register_url)
+            return ColumnarResults.from_results(jresults) if columnar else jresults
         else:
             error_message = "Query status code: {}".format(status)
             self.logger.error(error_message)
             raise ValueError(error_message)
 
+    def _write_results(self, jresults, destination, sepa_host):
+        """
+        Writes the query results to the file 'destination', as JSON.
+        """
+        with self.metrics.phase("query", "serialize", endpoint=sepa_host):
+            text = json.dumps(jresults)
+        with open(destination, "w") as fileDest:
+            print(text, file=fileDest)
+
+    def _cache_results(self, sepa_host, sparql, jresults, size,
+                       host, token_url, register_url):
+        """
+        Puts the query results in the cache. In live mode, a subscription
+        to the same sparql keeps them up to date: this is available only
+        when the query is sent to the sap host.
+        """
+        entry = self.query_cache.put(sepa_host, sparql, jresults, size)
+        if not self.query_cache.live or (host is not None) or (self.sap is None):
+            return
+        try:
+            subid = self.sparql_subscribe(
+                sparql, "query_cache", handler=self.query_cache.notifier(entry),
+                token_url=token_url, register_url=register_url)
+        except Exception as e:
+            self.logger.warning("Unable to keep query result live: {}".format(e))
+            self.query_cache.invalidate(sepa_host, sparql)
+            return
+        subscriptions = self.get_subscriptions()
+        if not self.query_cache.make_live(
+                entry, subid, lambda: subid in subscriptions, self.unsubscribe):
+            self.unsubscribe(subid)
+
+    def query_many(self, queries, host=None, token_url=None,
+                   register_url=None, columnar=False, cache=False):
+        """
+        Performs many sap queries concurrently, over the pooled
+        connections. 'queries' is a list of sap entry tags, or of
+        (sapIdentifier, forcedBindings) tuples.
+        Returns the list of the results, in the order of 'queries': the
+        exception raised by a query takes the place of its results.
+        The query cache is not used, unless 'cache' is True: then, with a
+        live cache, each query not cached yet opens a subscription.
+        See query for the other parameters.
+        """
+        futures = []
+        executor = self._get_executor()
+        for query in queries:
+            sapIdentifier, forcedBindings = (
+                (query, {}) if isinstance(query, str) else query)
+            futures.append(executor.submit(
+                self.query, sapIdentifier, forcedBindings, host=host,
+                token_url=token_url, register_url=register_url,
+                columnar=columnar, cache=cache))
+        return _collect(futures)
+
+    def sparql_query_many(self, sparqls, host=None, token_url=None,
+                          register_url=None, columnar=False, cache=False):
+        """
+        Performs many plain sparql queries concurrently (see query_many).
+        """
+        executor = self._get_executor()
+        return _collect([
+            executor.submit(
+                self.sparql_query, sparql, host=host, token_url=token_url,
+                register_url=register_url, columnar=columnar, cache=cache)
+            for sparql in sparqls])
+
+    def query_iter(self, sapIdentifier, forcedBindings={}, destination=None,
+                   host=None, token_url=None, register_url=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Performs a query with the sap entry tag 'sapIdentifier', yielding
+        its bindings while they are received (see sparql_query_iter).
+        """
+        sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
+        return self.sparql_query_iter(
+            sparql, destination=destination, host=host,
+            token_url=token_url, register_url=register_url,
+            chunk_size=chunk_size)
+
+    def sparql_query_iter(self, sparql, destination=None, host=None,
+                          token_url=None, register_url=None,
+                          chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Performs a query with the plain sparql, yielding its bindings
+        while the response is received, 'chunk_size' bytes at a time:
+        memory does not grow with the size of the results.
+        If 'destination' is given, the response is also written there
+        as it is read.
+        'host', 'token_url' and 'register_url' can be given to overwrite
+        the sap values (if any). The query cache is not used.
+        """
+        if self.sap is None and host is None:
+            raise ValueError("Host parametrization is necessary if no SAPObject is given to SEPA instance")
+        sepa_host = self.sap.query_url if (host is None) else host
+        protocol = urlparse(sepa_host).scheme
+        if protocol == "https":
+            if self.sap is None and (token_url is None or register_url is None):
+                raise ValueError("Token and Register URL must not be None if no SAPObject is given to SEPA instance")
+            sepa_token = self.sap.tokenRequest_url if (token_url is None) else token_url
+            sepa_register = self.sap.registration_url if (register_url is None) else register_url
+            status, response = self.connectionManager.secureRequest(
+                sepa_host, sparql, True, sepa_register, sepa_token, stream=True)
+        elif protocol == "http":
+            status, response = self.connectionManager.unsecureRequest(
+                sepa_host, sparql, True, stream=True)
+        else:
+            raise NotImplementedError("Still only http, https, ws, wss protocols are implemented")
+        with response:
+            if int(status) != 200:
+                error_message = "Query status code: {}".format(status)
+                self.logger.error(error_message)
+                raise ValueError(error_message)
+            chunks = response.iter_content(chunk_size=chunk_size)
+            if destination is None:
+                yield from iterBindings(chunks)
+                return
+            with open(destination, "wb") as fileDest:
+                def tee():
+                    for chunk in chunks:
+                        fileDest.write(chunk)
+                        yield chunk
+                    fileDest.write(b"\n")
+                teed = tee()
+                yield from iterBindings(teed)
+                # iterBindings stops at the end of the bindings: the rest
+                # of the response is still to be written
+                for _ in teed:
+                    pass
+
+    def query_pages(self, sapIdentifier, forcedBindings={},
+                    page_size=DEFAULT_PAGE_SIZE, concurrency=4, start_page=0,
+                    order_by=None, host=None, token_url=None, register_url=None):
+        """
+        Performs a query with the sap entry tag 'sapIdentifier' one page
+        at a time (see sparql_query_pages).
+        """
+        sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
+        return self.sparql_query_pages(
+            sparql, page_size=page_size, concurrency=concurrency,
+            start_page=start_page, order_by=order_by, host=host,
+            token_url=token_url, register_url=register_url)
+
+    def sparql_query_pages(self, sparql, page_size=DEFAULT_PAGE_SIZE,
+                           concurrency=4, start_page=0, order_by=None,
+                           host=None, token_url=None, register_url=None):
+        """
+        Performs a query with the plain sparql in pages of 'page_size'
+        bindings, rewriting it as an ordered subquery with LIMIT and
+        OFFSET. Only SELECT queries can be paged: ValueError is raised
+        otherwise. Their FROM and FROM NAMED clauses are kept. Up to 'concurrency' pages are requested at the same time,
+        but they are yielded in order, as (page number, results) pairs:
+        after a failure, the query can be resumed from the next page
+        with 'start_page'.
+        The pages are ordered by the variables in 'order_by' (by default
+        all of the query variables, found with a LIMIT 0 request).
+        'host', 'token_url' and 'register_url' can be given to overwrite
+        the sap values (if any). The query cache is not used.
+        """
+        prologue, body = splitPrologue(sparql)
+        dataset, body = splitDataset(body)
+
+        def request(sparql):
+            # pages are one-shot reads: they are not cached
+            return self.sparql_query(
+                sparql, host=host, token_url=token_url,
+                register_url=register_url, cache=False)
+
+        if order_by is None:
+            order_by = request(
+                pageQuery(prologue, dataset, body, (), 0, 0))["head"]["vars"]
+        executor = self._get_executor()
+        pending = deque()
+        page = start_page
+        try:
+            while True:
+                while len(pending) < concurrency:
+                    sparql = pageQuery(prologue, dataset, body, order_by,
+                                       page_size, page * page_size)
+                    pending.append((page, executor.submit(request, sparql)))
+                    page += 1
+                number, future = pending.popleft()
+                results = future.result()
+                yield number, results
+                if len(results["results"]["bindings"]) < page_size:
+                    return
+        finally:
+            for _, future in pending:
+                future.cancel()
+
     def update(self, sapIdentifier, forcedBindings={},
                host=None, token_url=None, register_url=None):
         """
@@ -131,7 +417,8 @@ class SEPA:
         'host', 'token_url' and 'register_url' can be given to overwrite
         the sap values (if any).
         """
-        sparql = self.sap.getUpdate(sapIdentifier, forcedBindings)
+        with self.metrics.phase("update", "build", sap=sapIdentifier):
+            sparql = self.sap.getUpdate(sapIdentifier, forcedBindings)
         return self.sparql_update(sparql, host=host, token_url=token_url,
                                   register_url=register_url)
 
@@ -152,13 +439,17 @@ class SEPA:
                 raise ValueError("Token and Register URL must not be None if no SAPObject is given to SEPA instance")
             sepa_token = self.sap.tokenRequest_url if (token_url is None) else token_url
             sepa_register = self.sap.registration_url if (register_url is None) else register_url
-            status, results = self.connectionManager.secureRequest(
-                sepa_host, sparql, False, sepa_register, sepa_token)
+            with self.metrics.phase("update", "network", endpoint=sepa_host):
+                status, results = self.connectionManager.secureRequest(
+                    sepa_host, sparql, False, sepa_register, sepa_token)
         elif protocol == "http":
-            status, results = self.connectionManager.unsecureRequest(
-                sepa_host, sparql, False)
+            with self.metrics.phase("update", "network", endpoint=sepa_host):
+                status, results = self.connectionManager.unsecureRequest(
+                    sepa_host, sparql, False)
         else:
             raise NotImplementedError("Still only http, https, ws, wss protocols are implemented")
+        self.metrics.count(
+            OPERATIONS_TOTAL, operation="update", endpoint=sepa_host, status=status)
         # return
         if int(status) == 200:
             return results
@@ -166,6 +457,46 @@ class SEPA:
             self.logger.error(results)
             raise ValueError(results)
 
+    def update_many(self, sapIdentifier, bindingsList,
+                    max_payload=DEFAULT_BATCH_PAYLOAD,
+                    host=None, token_url=None, register_url=None):
+        """
+        Performs the update with the sap entry tag 'sapIdentifier' once
+        for each forcedBindings dict in 'bindingsList', coalescing them
+        in as few requests as possible.
+        See update_batch for the other parameters.
+        Returns the list of the results of each request sent.
+        """
+        return self.update_batch(
+            [(sapIdentifier, bindings) for bindings in bindingsList],
+            max_payload=max_payload, host=host,
+            token_url=token_url, register_url=register_url)
+
+    def update_batch(self, updates, max_payload=DEFAULT_BATCH_PAYLOAD,
+                     host=None, token_url=None, register_url=None):
+        """
+        Performs many sap updates joined with ';' in a single SPARQL
+        Update request. 'updates' is a list of sap entry tags, or of
+        (sapIdentifier, forcedBindings) tuples.
+        The batch is split in more requests, each one of at most
+        'max_payload' bytes.
+        'host', 'token_url' and 'register_url' can be given to overwrite
+        the sap values (if any).
+        Returns the list of the results of each request sent.
+        """
+        sparqls = []
+        for update in updates:
+            if isinstance(update, str):
+                sparqls.append(self.sap.getUpdate(update, prefixes=False))
+            else:
+                sparqls.append(self.sap.getUpdate(
+                    update[0], update[1], prefixes=False))
+        prologue = " ".join(self.sap.get_namespaces(stringList=True))
+        return [
+            self.sparql_update(sparql, host=host, token_url=token_url,
+                               register_url=register_url)
+            for sparql in joinUpdates(sparqls, prologue, max_payload)]
+
     def clear(self, host=None, token_url=None, register_url=None):
         """
         Performs a simple 'delete where {?a ?b ?c}'.
@@ -192,15 +523,20 @@ class SEPA:
 
     def sparql_subscribe(self, sparql, alias, handler=lambda a, r: None,
                          host=None, token_url=None, register_url=None,
-                         default_graph=None, named_graph=None):
+                         default_graph=None, named_graph=None, coalesce=None):
         """
         Subscribes to a specific 'sparql'. The subscription will have its
         own 'alias'. A 'handler' to be triggered when the subscription starts
         can be give.
         'host', 'token_url', 'register_url', 'default_graph' and 'named_graph'
         can be given to overwrite the sap values (if any).
+        If 'coalesce' is given, the notifications received within that
+        many seconds are merged into a single net difference before
+        calling the handler.
         Returns the subscription id.
         """
+        if coalesce is not None:
+            handler = NotificationCoalescer(handler, coalesce)
         subid = None
         if self.sap is None and host is None:
             raise ValueError("Host parametrization is necessary if no SAPObject is given to SEPA instance")
@@ -223,33 +559,75 @@ class SEPA:
                 raise ValueError("Token and Register URL must not be None if no SAPObject is given to SEPA instance")
             sepa_token = self.sap.tokenRequest_url if (token_url is None) else token_url
             sepa_register = self.sap.registration_url if (register_url is None) else register_url
-            subid = self.connectionManager.openSecureWebsocket(
-                sepa_host, sparql, alias, handler, sepa_register, sepa_token,
-                default_graph=def_graph, named_graph=nam_graph)
+            with self.metrics.phase("subscribe", "network", endpoint=sepa_host):
+                subid = self.connectionManager.openSecureWebsocket(
+                    sepa_host, sparql, alias, handler, sepa_register, sepa_token,
+                    default_graph=def_graph, named_graph=nam_graph)
         elif protocol == "ws":
-            subid = self.connectionManager.openUnsecureWebsocket(
-                sepa_host, sparql, alias, handler, default_graph=def_graph,
-                named_graph=nam_graph)
+            with self.metrics.phase("subscribe", "network", endpoint=sepa_host):
+                subid = self.connectionManager.openUnsecureWebsocket(
+                    sepa_host, sparql, alias, handler, default_graph=def_graph,
+                    named_graph=nam_graph)
         else:
             raise NotImplementedError("Still only http, https, ws, wss protocols are implemented")
+        self.metrics.count(OPERATIONS_TOTAL, operation="subscribe", endpoint=sepa_host)
         return subid
 
     def subscribe(self, sapIdentifier, alias, forcedBindings={},
                   handler=lambda a, r: None,
                   host=None, token_url=None, register_url=None,
-                  default_graph=None, named_graph=None):
+                  default_graph=None, named_graph=None, coalesce=None):
         """
         Performs a subscription with the sap identifier tag and its
         forcedBindings; an 'alias' has to be given to the subscription,
         as well as an handler to be called upon notification.
         'host', 'token_url', 'register_url', 'default_graph' and 'named_graph'
         can be given to overwrite the sap values (if any).
+        'coalesce' is the time window to merge notifications (see
+        sparql_subscribe).
         The subscription id is returned.
         """
-        sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
+        with self.metrics.phase("subscribe", "build", sap=sapIdentifier):
+            sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
         return self.sparql_subscribe(
             sparql, alias, handler, host=host,
             token_url=token_url, register_url=register_url,
+            default_graph=default_graph, named_graph=named_graph,
+            coalesce=coalesce)
+
+    def sparql_materialize(self, sparql, alias=None, indexes=(), handler=None,
+                           host=None, token_url=None, register_url=None,
+                           default_graph=None, named_graph=None):
+        """
+        Subscribes to 'sparql' and returns a MaterializedView, holding
+        its current results. 'indexes' are the variables the view is
+        indexed by; 'handler' is called after each notification has been
+        applied to the view. The other parameters are the ones of
+        sparql_subscribe.
+        """
+        view = MaterializedView(indexes=indexes, handler=handler)
+        view.subid = self.sparql_subscribe(
+            sparql, alias if alias is not None else "materialize",
+            handler=view.notify, host=host,
+            token_url=token_url, register_url=register_url,
+            default_graph=default_graph, named_graph=named_graph)
+        view.unsubscribe = self.unsubscribe
+        return view
+
+    def materialize(self, sapIdentifier, forcedBindings={}, alias=None,
+                    indexes=(), handler=None,
+                    host=None, token_url=None, register_url=None,
+                    default_graph=None, named_graph=None):
+        """
+        Same as sparql_materialize, with the sap query tagged
+        'sapIdentifier' and its 'forcedBindings'. The alias defaults to
+        'sapIdentifier'.
+        """
+        sparql = self.sap.getQuery(sapIdentifier, forcedBindings)
+        return self.sparql_materialize(
+            sparql, alias=alias if alias is not None else sapIdentifier,
+            indexes=indexes, handler=handler, host=host,
+            token_url=token_url, register_url=register_url,
             default_graph=default_graph, named_graph=named_graph)
 
     def unsubscribe(self, subid):
@@ -257,3 +635,93 @@ class SEPA:
         Closes the subscription, given the subscription id
         """
         self.connectionManager.closeWebsocket(subid)
+
+
+def joinUpdates(sparqls, prologue="", max_payload=DEFAULT_BATCH_PAYLOAD):
+    """
+    Joins the SPARQL updates in 'sparqls' with ';', after the 'prologue'
+    (i.e. the PREFIX declarations). Yields SPARQL Update requests of at
+    most 'max_payload' bytes: an update that alone exceeds the limit is
+    yielded by itself.
+    """
+    for batch in splitUpdates(sparqls, prologue, max_payload):
+        yield joinBatch(batch, prologue)
+
+
+def splitUpdates(sparqls, prologue="", max_payload=DEFAULT_BATCH_PAYLOAD):
+    """
+    Splits 'sparqls' in lists of consecutive updates that, once joined
+    by joinBatch, are at most 'max_payload' bytes long.
+    """
+    head_size = len(prologue.encode("utf-8")) + 1 if prologue else 0
+    batch = []
+    size = head_size
+    for sparql in sparqls:
+        sparql_size = len(sparql.encode("utf-8")) + 3
+        if batch and (size + sparql_size > max_payload):
+            yield batch
+            batch = []
+            size = head_size
+        batch.append(sparql)
+        size += sparql_size
+    if batch:
+        yield batch
+
+
+def joinBatch(batch, prologue=""):
+    """
+    Joins the list of updates 'batch' in a single SPARQL Update request.
+    """
+    head = prologue + " " if prologue else ""
+    return head + " ; ".join(batch)
+
+
+def _collect(futures):
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def splitPrologue(sparql):
+    """
+    Splits 'sparql' into its prologue (PREFIX and BASE declarations)
+    and the rest of the query.
+    """
+    prologue, body = PROLOGUE.match(sparql).groups()
+    return prologue, body
+
+
+def splitDataset(body):
+    """
+    Splits the SELECT query 'body' (without prologue) into its dataset
+    clauses (FROM and FROM NAMED), that a subquery cannot have, and the
+    rest of the query. Raises ValueError if 'body' is not a SELECT.
+    """
+    if not SELECT.match(body):
+        raise ValueError("Only SELECT queries can be paged")
+    where = body.find("{")
+    if where < 0:
+        raise ValueError("Missing WHERE clause")
+    head = body[:where]
+    dataset = " ".join(DATASET.findall(head))
+    return dataset, DATASET.sub(" ", head) + body[where:]
+
+
+def pageQuery(prologue, dataset, body, order_by, limit, offset):
+    """
+    Returns the query selecting, from the results of the query 'body',
+    'limit' bindings from 'offset' on, sorted by the 'order_by'
+    variables (or expressions). 'dataset' are the FROM and FROM NAMED
+    clauses of the query.
+    """
+    order = " ".join(
+        condition if condition[0] in "?$(" or condition[:3].upper() in ("ASC", "DES")
+        else "?" + condition
+        for condition in order_by)
+    return "{}SELECT *{} WHERE {{ {} }}{} LIMIT {}{}".format(
+        prologue, " " + dataset if dataset else "", body, " ORDER BY " + order if order else "",
+        limit, " OFFSET {}".format(offset) if offset else "")
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  UpdateBuffer.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from .SEPA import DEFAULT_BATCH_PAYLOAD, splitUpdates, joinBatch
+
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+from time import monotonic
+
+import logging
+
+
+class UpdateBuffer:
+    """
+    Write-behind buffer of SPARQL updates on top of SEPA.sparql_update.
+    Updates are enqueued without waiting for SEPA: a background thread
+    sends them joined in batches, as soon as 'max_batch' updates are
+    waiting or the oldest one has been waiting for 'max_latency' seconds.
+    Each enqueued update gets a Future, resolved with the result of the
+    request it has been sent with (or with its exception).
+    """
+    def __init__(self, sepa, max_batch=100, max_latency=0.1, max_queue=10000,
+                 max_payload=DEFAULT_BATCH_PAYLOAD,
+                 host=None, token_url=None, register_url=None):
+        """
+        Constructor of the UpdateBuffer class.
+        'sepa' is the SEPA instance used to send the updates.
+        'max_batch' is the maximum number of updates sent in a request.
+        'max_latency' is the maximum time in seconds an update is kept
+        in the buffer.
+        'max_queue' is the maximum number of updates waiting to be sent:
+        when reached, enqueuing blocks.
+        'max_payload' is the maximum size in bytes of a request.
+        'host', 'token_url' and 'register_url' can be given to overwrite
+        the sap values (if any).
+        """
+        self.logger = logging.getLogger("sepaLogger")
+        self.logger.debug("=== UpdateBuffer::__init__ invoked ===")
+        self.sepa = sepa
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_payload = max_payload
+        self.request_args = dict(
+            host=host, token_url=token_url, register_url=register_url)
+
+        self._queue = Queue(maxsize=max_queue)
+        self._closed = False
+        self._closeLock = Lock()
+        self._flusher = Thread(target=self._run)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def put(self, sparql, timeout=None):
+        """
+        Enqueues the SPARQL update 'sparql', complete with its PREFIX
+        declarations. Blocks for at most 'timeout' seconds if the buffer
+        is full, then raises queue.Full.
+        Returns a Future.
+        """
+        return self._put(sparql, False, timeout)
+
+    def put_update(self, sapIdentifier, forcedBindings={}, timeout=None):
+        """
+        Enqueues the update with the sap entry tag 'sapIdentifier' and
+        its 'forcedBindings'. See put.
+        Returns a Future.
+        """
+        sparql = self.sepa.sap.getUpdate(
+            sapIdentifier, forcedBindings, prefixes=False)
+        return self._put(sparql, True, timeout)
+
+    def _put(self, sparql, needsPrologue, timeout):
+        future = Future()
+        # under the lock, so that nothing is enqueued after close
+        with self._closeLock:
+            if self._closed:
+                raise ValueError("UpdateBuffer is closed")
+            self._queue.put(
+                (monotonic(), sparql, needsPrologue, future), timeout=timeout)
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Sends the updates enqueued so far, and waits for them to be
+        sent. Returns False if 'timeout' expired before.
+        Raises ValueError if the buffer is closed.
+        """
+        done = Event()
+        with self._closeLock:
+            if self._closed:
+                raise ValueError("UpdateBuffer is closed")
+            self._queue.put(done, timeout=timeout)
+        return done.wait(timeout=timeout)
+
+    def close(self):
+        """
+        Sends the updates enqueued so far, and stops the buffer.
+        """
+        with self._closeLock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._flusher.join()
+
+    def _run(self):
+        batch = []
+        while True:
+            item = self._queue.get()
+            if isinstance(item, tuple):
+                batch.append(item)
+                deadline = item[0] + self.max_latency
+                while len(batch) < self.max_batch:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except Empty:
+                        break
+                    if not isinstance(item, tuple):
+                        break
+                    batch.append(item)
+                self._send(batch)
+                batch = []
+            if item is None:
+                return
+            elif isinstance(item, Event):
+                item.set()
+
+    def _send(self, batch):
+        """
+        Sends the updates in 'batch', resolving their futures.
+        """
+        self.logger.debug("Sending {} buffered updates".format(len(batch)))
+        futures = [future for _, _, _, future in batch]
+        try:
+            prologue = ""
+            if any(needsPrologue for _, _, needsPrologue, _ in batch):
+                prologue = " ".join(self.sepa.sap.get_namespaces(stringList=True))
+            sent = 0
+            for chunk in splitUpdates(
+                    [sparql for _, sparql, _, _ in batch], prologue, self.max_payload):
+                chunk_futures = futures[sent:sent+len(chunk)]
+                sent += len(chunk)
+                result = self.sepa.sparql_update(
+                    joinBatch(chunk, prologue), **self.request_args)
+                for future in chunk_futures:
+                    future.set_result(result)
+        except Exception as e:
+            # the futures not resolved yet fail with the request, or
+            # with the error that prevented it
+            self.logger.error("Buffered update failed: {}".format(e))
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
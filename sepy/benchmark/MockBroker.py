@@ -0,0 +1,836 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  MockBroker.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+A small in-process stand-in for a SEPA broker, for tests and benchmarks.
+It serves, on a single port and with the standard library only:
+the SPARQL 1.1 query and update endpoints (/query, /update), the
+SPARQL 1.1 SE subscribe protocol over websocket (/subscribe) and the
+registration and token endpoints (/oauth/register, /oauth/token).
+Requests carrying a bearer token are refused (401) unless the token
+has been given by the broker; requests without one are accepted.
+Data is kept in a tiny in-memory triple store, understanding a subset
+of SPARQL: basic graph patterns (with subqueries), DISTINCT, ORDER BY,
+LIMIT and OFFSET; INSERT DATA, DELETE DATA, DELETE WHERE and
+DELETE/INSERT ... WHERE updates.
+"""
+
+from base64 import b64encode, b64decode
+from collections import Counter
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from uuid import uuid4
+
+import json
+import re
+import struct
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+TOKEN = re.compile(r"""\s*(?:
+    (?P<iri><[^>\s]*>)|
+    (?P<literal>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+        (?:@(?P<lang>[A-Za-z][\w-]*)|\^\^(?P<datatype><[^>\s]*>|[\w-]*:[\w-]*))?|
+    (?P<var>[?$]\w+)|
+    (?P<number>[+-]?\d+(?:\.\d+)?(?![\w:]))|
+    (?P<bnode>_:\w+)|
+    (?P<pname>[A-Za-z_][\w-]*:(?:[\w-]+(?:\.[\w-]+)*)?|:(?:[\w-]+(?:\.[\w-]+)*)?)|
+    (?P<keyword>[A-Za-z]+)|
+    (?P<punct>[{}.;,*()]))""", re.VERBOSE)
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f",
+           '"': '"', "'": "'", "\\": "\\"}
+
+
+class SparqlError(ValueError):
+    pass
+
+
+class Parser:
+    """
+    A recursive descent parser of the supported SPARQL subset.
+    Terms are tuples: ("uri", iri), ("bnode", id),
+    ("literal", value, datatype, lang) and ("var", name).
+    """
+    def __init__(self, sparql):
+        self.tokens = []
+        position = 0
+        sparql = sparql.strip()
+        while position < len(sparql):
+            match = TOKEN.match(sparql, position)
+            if match is None or match.end() == position:
+                raise SparqlError("Unexpected text: {}".format(sparql[position:position+30]))
+            self.tokens.append(match)
+            position = match.end()
+            while position < len(sparql) and sparql[position].isspace():
+                position += 1
+        self.index = 0
+        self.prefixes = {}
+
+    # tokens
+
+    def peek(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None
+
+    def keyword(self, *words):
+        token = self.peek()
+        if (token is not None and token.lastgroup == "keyword"
+                and token.group("keyword").upper() in words):
+            self.index += 1
+            return token.group("keyword").upper()
+        return None
+
+    def punct(self, *chars):
+        token = self.peek()
+        if token is not None and token.lastgroup == "punct" and token.group("punct") in chars:
+            self.index += 1
+            return token.group("punct")
+        return None
+
+    def expect(self, char):
+        if self.punct(char) is None:
+            raise SparqlError("Expected '{}'".format(char))
+
+    def expectKeyword(self, word):
+        if self.keyword(word) is None:
+            raise SparqlError("Expected {}".format(word))
+
+    # grammar
+
+    def prologue(self):
+        while True:
+            if self.keyword("PREFIX"):
+                token = self.next("pname")
+                name = token.group("pname")
+                self.prefixes[name[:name.index(":")]] = self.next("iri").group("iri")[1:-1]
+            elif self.keyword("BASE"):
+                self.next("iri")
+            else:
+                return
+
+    def next(self, group):
+        token = self.peek()
+        if token is None or token.group(group) is None:
+            raise SparqlError("Expected {}".format(group))
+        self.index += 1
+        return token
+
+    def term(self):
+        token = self.peek()
+        if token is None:
+            raise SparqlError("Unexpected end of query")
+        kind = token.lastgroup
+        if kind in ("lang", "datatype"):
+            kind = "literal"
+        self.index += 1
+        if kind == "iri":
+            return ("uri", token.group("iri")[1:-1])
+        if kind == "pname":
+            return ("uri", self.expand(token.group("pname")))
+        if kind == "var":
+            return ("var", token.group("var")[1:])
+        if kind == "bnode":
+            return ("bnode", token.group("bnode")[2:])
+        if kind == "number":
+            number = token.group("number")
+            return ("literal", number, XSD + ("decimal" if "." in number else "integer"), None)
+        if kind == "literal":
+            value = re.sub(r"\\(.)", lambda m: ESCAPES.get(m.group(1), m.group(1)),
+                           token.group("literal")[1:-1])
+            datatype = token.group("datatype")
+            if datatype is not None:
+                datatype = datatype[1:-1] if datatype.startswith("<") else self.expand(datatype)
+            return ("literal", value, datatype, token.group("lang"))
+        if kind == "keyword" and token.group("keyword") == "a":
+            return ("uri", RDF_TYPE)
+        if kind == "keyword" and token.group("keyword").lower() in ("true", "false"):
+            return ("literal", token.group("keyword").lower(), XSD + "boolean", None)
+        raise SparqlError("Unexpected token: {}".format(token.group(0).strip()))
+
+    def expand(self, pname):
+        prefix, local = pname.split(":", 1)
+        if prefix not in self.prefixes:
+            raise SparqlError("Unknown prefix: {}".format(prefix))
+        return self.prefixes[prefix] + local
+
+    def triples(self, end="}"):
+        """
+        Parses a block of triples, with ';' and ',' abbreviations.
+        """
+        triples = []
+        while True:
+            token = self.peek()
+            if token is None or (token.lastgroup == "punct" and token.group("punct") == end):
+                return triples
+            subject = self.term()
+            while True:
+                predicate = self.term()
+                while True:
+                    triples.append((subject, predicate, self.term()))
+                    if not self.punct(","):
+                        break
+                if not self.punct(";"):
+                    break
+                token = self.peek()
+                if token is not None and token.lastgroup == "punct" and token.group("punct") in ".}":
+                    break
+            self.punct(".")
+
+    def group(self):
+        """
+        Parses a group graph pattern: a list of triple patterns, or a
+        subquery.
+        """
+        self.expect("{")
+        token = self.peek()
+        if token is not None and token.lastgroup == "keyword" and token.group("keyword").upper() == "SELECT":
+            pattern = self.select()
+        else:
+            pattern = self.triples()
+        self.expect("}")
+        return pattern
+
+    def select(self):
+        self.expectKeyword("SELECT")
+        distinct = self.keyword("DISTINCT", "REDUCED") == "DISTINCT"
+        projection = None
+        if not self.punct("*"):
+            projection = []
+            while self.peek() is not None and self.peek().lastgroup == "var":
+                projection.append(self.term()[1])
+        self.keyword("WHERE")
+        pattern = self.group()
+        order = []
+        if self.keyword("ORDER"):
+            self.expectKeyword("BY")
+            while True:
+                direction = self.keyword("ASC", "DESC")
+                if direction:
+                    self.expect("(")
+                    order.append((self.term()[1], direction == "DESC"))
+                    self.expect(")")
+                elif self.peek() is not None and self.peek().lastgroup == "var":
+                    order.append((self.term()[1], False))
+                else:
+                    break
+        limit = offset = None
+        while True:
+            if self.keyword("LIMIT"):
+                limit = int(self.next("number").group("number"))
+            elif self.keyword("OFFSET"):
+                offset = int(self.next("number").group("number"))
+            else:
+                break
+        return Select(projection, distinct, pattern, order, limit, offset)
+
+    def query(self):
+        self.prologue()
+        select = self.select()
+        if self.peek() is not None:
+            raise SparqlError("Unexpected token: {}".format(self.peek().group(0).strip()))
+        return select
+
+    def update(self):
+        operations = []
+        while True:
+            self.prologue()
+            if self.peek() is None:
+                return operations
+            if self.keyword("INSERT"):
+                if self.keyword("DATA"):
+                    operations.append(([], self.data(), []))
+                else:
+                    insert = self.template()
+                    self.expectKeyword("WHERE")
+                    operations.append(([], insert, self.group()))
+            elif self.keyword("DELETE"):
+                if self.keyword("DATA"):
+                    operations.append((self.data(), [], []))
+                elif self.keyword("WHERE"):
+                    pattern = self.group()
+                    operations.append((pattern, [], pattern))
+                else:
+                    delete = self.template()
+                    insert = []
+                    if self.keyword("INSERT"):
+                        insert = self.template()
+                    self.expectKeyword("WHERE")
+                    operations.append((delete, insert, self.group()))
+            else:
+                raise SparqlError("Unsupported update: {}".format(self.peek().group(0).strip()))
+            if not self.punct(";"):
+                if self.peek() is not None:
+                    raise SparqlError("Expected ';'")
+                return operations
+
+    def template(self):
+        self.expect("{")
+        triples = self.triples()
+        self.expect("}")
+        return triples
+
+    def data(self):
+        triples = self.template()
+        for triple in triples:
+            if any(term[0] == "var" for term in triple):
+                raise SparqlError("Variables are not allowed in DATA blocks")
+        return triples
+
+
+class Select:
+    __slots__ = ("projection", "distinct", "pattern", "order", "limit", "offset")
+
+    def __init__(self, projection, distinct, pattern, order, limit, offset):
+        self.projection = projection
+        self.distinct = distinct
+        self.pattern = pattern
+        self.order = order
+        self.limit = limit
+        self.offset = offset
+
+
+def termOrder(term):
+    if term is None:
+        return (0, "")
+    rank = {"bnode": 1, "uri": 2, "literal": 3}[term[0]]
+    if term[0] == "literal" and term[2] is not None and term[2].startswith(XSD) and \
+            term[2][len(XSD):] in ("integer", "decimal", "double", "float", "int", "long"):
+        try:
+            return (rank, "", float(term[1]))
+        except ValueError:
+            pass
+    return (rank, term[1])
+
+
+def jsonTerm(term):
+    if term[0] == "literal":
+        result = {"type": "literal", "value": term[1]}
+        if term[2] is not None:
+            result["datatype"] = term[2]
+        if term[3] is not None:
+            result["xml:lang"] = term[3]
+        return result
+    return {"type": term[0], "value": term[1]}
+
+
+class TripleStore:
+    """
+    A set of triples, indexed by subject and by predicate.
+    """
+    def __init__(self):
+        self.triples = set()
+        self._subjects = {}
+        self._predicates = {}
+
+    def __len__(self):
+        return len(self.triples)
+
+    def add(self, triple):
+        if triple not in self.triples:
+            self.triples.add(triple)
+            self._subjects.setdefault(triple[0], set()).add(triple)
+            self._predicates.setdefault(triple[1], set()).add(triple)
+
+    def discard(self, triple):
+        if triple in self.triples:
+            self.triples.discard(triple)
+            self._subjects[triple[0]].discard(triple)
+            self._predicates[triple[1]].discard(triple)
+
+    def match(self, subject, predicate, obj):
+        if subject is not None:
+            candidates = self._subjects.get(subject, ())
+        elif predicate is not None:
+            candidates = self._predicates.get(predicate, ())
+        else:
+            candidates = self.triples
+        for triple in list(candidates):
+            if ((predicate is None or triple[1] == predicate)
+                    and (obj is None or triple[2] == obj)):
+                yield triple
+
+    def solve(self, pattern, solution=None):
+        """
+        Yields the solutions (dicts variable -> term) of a list of
+        triple patterns, or of a subquery.
+        """
+        if isinstance(pattern, Select):
+            yield from self.select(pattern)
+            return
+        solution = solution or {}
+        if not pattern:
+            yield solution
+            return
+        first, rest = pattern[0], pattern[1:]
+        bound = [
+            (solution.get(term[1]) if term[0] == "var" else term)
+            for term in first]
+        for triple in self.match(*bound):
+            extended = dict(solution)
+            consistent = True
+            for term, value in zip(first, triple):
+                if term[0] == "var":
+                    if extended.setdefault(term[1], value) != value:
+                        consistent = False
+                        break
+            if consistent:
+                yield from self.solve(rest, extended)
+
+    def select(self, select):
+        solutions = list(self.solve(select.pattern))
+        for var, descending in reversed(select.order):
+            solutions.sort(key=lambda s: termOrder(s.get(var)), reverse=descending)
+        variables = self.variables(select)
+        if select.projection is not None:
+            solutions = [
+                {var: s[var] for var in variables if var in s} for s in solutions]
+        if select.distinct:
+            seen = set()
+            unique = []
+            for s in solutions:
+                key = tuple(sorted(s.items()))
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(s)
+            solutions = unique
+        start = select.offset or 0
+        end = None if select.limit is None else start + select.limit
+        return solutions[start:end]
+
+    def variables(self, select):
+        if select.projection is not None:
+            return select.projection
+        if isinstance(select.pattern, Select):
+            return self.variables(select.pattern)
+        variables = []
+        for triple in select.pattern:
+            for term in triple:
+                if term[0] == "var" and term[1] not in variables:
+                    variables.append(term[1])
+        return variables
+
+    def query(self, sparql):
+        """
+        Returns the SPARQL JSON results of the SELECT query 'sparql'.
+        """
+        select = Parser(sparql).query()
+        variables = self.variables(select)
+        return {
+            "head": {"vars": variables},
+            "results": {"bindings": [
+                {var: jsonTerm(term) for var, term in solution.items()}
+                for solution in self.select(select)]}}
+
+    def update(self, sparql):
+        """
+        Applies the SPARQL Update 'sparql'. Returns the number of
+        triples added and removed.
+        """
+        changed = 0
+        for delete, insert, where in Parser(sparql).update():
+            solutions = list(self.solve(where)) if where else [{}]
+            removed = [triple for s in solutions for triple in instantiate(delete, s)]
+            added = [triple for s in solutions for triple in instantiate(insert, s)]
+            for triple in removed:
+                if triple in self.triples:
+                    self.discard(triple)
+                    changed += 1
+            for triple in added:
+                if triple not in self.triples:
+                    self.add(triple)
+                    changed += 1
+        return changed
+
+
+def instantiate(template, solution):
+    for triple in template:
+        terms = []
+        for term in triple:
+            if term[0] == "var":
+                term = solution.get(term[1])
+                if term is None:
+                    break
+            terms.append(term)
+        else:
+            yield tuple(terms)
+
+
+class BrokerSubscription:
+    __slots__ = ("spuid", "alias", "sparql", "connection", "sequence", "results")
+
+    def __init__(self, spuid, alias, sparql, connection):
+        self.spuid = spuid
+        self.alias = alias
+        self.sparql = sparql
+        self.connection = connection
+        self.sequence = 0
+        self.results = Counter()
+
+
+def bindingTuple(binding):
+    return tuple(sorted((var, tuple(sorted(term.items()))) for var, term in binding.items()))
+
+
+class MockBroker:
+    """
+    The stand-in broker. Use start() and stop(), or a with block:
+
+        with MockBroker() as broker:
+            sc = SEPA(SAPObject(broker.sap()))
+    """
+    def __init__(self, host="127.0.0.1", port=0, token_expiry=3600):
+        self.store = TripleStore()
+        self.token_expiry = token_expiry
+        self.subscriptions = {}
+        self.connections = set()
+        self.clients = {}
+        self.tokens = set()
+        self.lock = Lock()
+        self.requests = Counter()
+        self.server = ThreadingHTTPServer((host, port), BrokerRequestHandler)
+        self.server.daemon_threads = True
+        self.server.broker = self
+        self.host, self.port = self.server.server_address[:2]
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        self._thread = Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.disconnect()
+
+    def url(self, protocol, path):
+        return "{}://{}:{}{}".format(protocol, self.host, self.port, path)
+
+    def sap(self, queries={}, updates={}, namespaces={}):
+        """
+        Returns a sap dict pointing to this broker.
+        """
+        return {
+            "host": self.host,
+            "oauth": {
+                "enable": False,
+                "register": self.url("http", "/oauth/register"),
+                "tokenRequest": self.url("http", "/oauth/token")},
+            "sparql11protocol": {
+                "protocol": "http", "port": self.port,
+                "query": {"path": "/query", "method": "POST", "format": "JSON"},
+                "update": {"path": "/update", "method": "POST", "format": "JSON"}},
+            "sparql11seprotocol": {
+                "protocol": "ws",
+                "availableProtocols": {"ws": {"port": self.port, "path": "/subscribe"}}},
+            "namespaces": dict(namespaces),
+            "queries": dict(queries),
+            "updates": dict(updates)}
+
+    # SPARQL
+
+    def query(self, sparql):
+        with self.lock:
+            return self.store.query(sparql)
+
+    def update(self, sparql):
+        with self.lock:
+            changed = self.store.update(sparql)
+            if changed:
+                for subscription in list(self.subscriptions.values()):
+                    self._notify(subscription)
+
+    def _notify(self, subscription):
+        results = self.store.query(subscription.sparql)
+        current = Counter()
+        bindings = {}
+        for binding in results["results"]["bindings"]:
+            key = bindingTuple(binding)
+            current[key] += 1
+            bindings[key] = binding
+        previous = subscription.results
+        added = []
+        for key, count in (current - previous).items():
+            added += [bindings[key]] * count
+        removed = []
+        for key, count in (previous - current).items():
+            removed += [{var: dict(term) for var, term in key}] * count
+        subscription.results = current
+        if added or removed or subscription.sequence == 0:
+            self._send(subscription, results["head"], added, removed)
+
+    def _send(self, subscription, head, added, removed):
+        message = {"notification": {
+            "spuid": subscription.spuid,
+            "alias": subscription.alias,
+            "sequence": subscription.sequence,
+            "addedResults": {"head": head, "results": {"bindings": added}},
+            "removedResults": {"head": head, "results": {"bindings": removed}}}}
+        subscription.sequence += 1
+        subscription.connection.send(json.dumps(message))
+
+    def subscribe(self, connection, request):
+        spuid = "sepa://subscription/{}".format(uuid4())
+        subscription = BrokerSubscription(
+            spuid, request.get("alias"), request["sparql"], connection)
+        with self.lock:
+            self.subscriptions[spuid] = subscription
+            try:
+                self._notify(subscription)
+            except SparqlError as e:
+                del self.subscriptions[spuid]
+                connection.send(json.dumps({"error": {"message": str(e)}}))
+
+    def unsubscribe(self, connection, request):
+        spuid = request["spuid"]
+        with self.lock:
+            self.subscriptions.pop(spuid, None)
+        connection.send(json.dumps({"unsubscribed": {"spuid": spuid}}))
+
+    def connected(self, connection):
+        with self.lock:
+            self.connections.add(connection)
+
+    def disconnect(self):
+        """
+        Closes all the websockets, as a broker restart would do: their
+        subscriptions are forgotten.
+        """
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+
+    def disconnected(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+            for spuid, subscription in list(self.subscriptions.items()):
+                if subscription.connection is connection:
+                    del self.subscriptions[spuid]
+
+    # OAuth
+
+    def register(self, client_id):
+        secret = str(uuid4())
+        with self.lock:
+            self.clients[client_id] = secret
+        return {"credentials": {"client_id": client_id, "client_secret": secret}}
+
+    def token(self, authorization):
+        """
+        Returns a new token, or None if 'authorization' does not hold
+        the credentials of a registered client.
+        """
+        try:
+            scheme, credentials = authorization.split(" ", 1)
+            client_id, secret = b64decode(credentials).decode("utf-8").split(":", 1)
+        except (AttributeError, ValueError):
+            return None
+        token = str(uuid4())
+        with self.lock:
+            if (scheme != "Basic") or (self.clients.get(client_id) != secret):
+                return None
+            self.tokens.add(token)
+        return {"token": {"access_token": token, "token_type": "bearer",
+                          "expires_in": self.token_expiry}}
+
+    def authorized(self, authorization):
+        """
+        Tells whether a request with the 'authorization' header is
+        accepted.
+        """
+        if not authorization or not authorization.startswith("Bearer "):
+            return True
+        with self.lock:
+            return authorization[len("Bearer "):] in self.tokens
+
+    def revoke(self):
+        """
+        Invalidates all the tokens given so far, as if they expired.
+        """
+        with self.lock:
+            self.tokens.clear()
+
+
+class BrokerRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b"", content_type="application/json"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        broker = self.server.broker
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        path = self.path.split("?")[0]
+        broker.requests[path] += 1
+        try:
+            if (path in ("/query", "/update")) and not broker.authorized(
+                    self.headers.get("Authorization")):
+                self.reply(401, json.dumps({"error": {"message": "Unauthorized"}}))
+            elif path == "/query":
+                self.reply(200, json.dumps(broker.query(body)))
+            elif path == "/update":
+                broker.update(body)
+                self.reply(200, json.dumps({"status": 200}))
+            elif path == "/oauth/register":
+                client_id = json.loads(body)["register"]["client_identity"]
+                self.reply(201, json.dumps(broker.register(client_id)))
+            elif path == "/oauth/token":
+                token = broker.token(self.headers.get("Authorization"))
+                if token is None:
+                    self.reply(401, json.dumps({"error": {"message": "Unauthorized"}}))
+                else:
+                    self.reply(201, json.dumps(token))
+            else:
+                self.reply(404, json.dumps({"error": {"message": "Not found"}}))
+        except SparqlError as e:
+            self.reply(400, json.dumps({"error": {"message": str(e)}}))
+
+    def do_GET(self):
+        if (self.path.split("?")[0] != "/subscribe"
+                or self.headers.get("Upgrade", "").lower() != "websocket"):
+            self.reply(404, json.dumps({"error": {"message": "Not found"}}))
+            return
+        key = self.headers["Sec-WebSocket-Key"]
+        accept = b64encode(sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        broker = self.server.broker
+        broker.requests["/subscribe"] += 1
+        connection = WebSocketConnection(self.rfile, self.wfile)
+        broker.connected(connection)
+        try:
+            for message in connection:
+                request = json.loads(message)
+                if "subscribe" in request:
+                    broker.subscribe(connection, request["subscribe"])
+                elif "unsubscribe" in request:
+                    broker.unsubscribe(connection, request["unsubscribe"])
+        finally:
+            broker.disconnected(connection)
+        self.close_connection = True
+
+
+class WebSocketConnection:
+    """
+    The server side of a websocket (RFC 6455): iterating it yields the
+    text messages received, until the connection is closed.
+    """
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.closed = False
+        self._lock = Lock()
+
+    def _read(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise EOFError
+        return data
+
+    def _frame(self):
+        first, second = self._read(2)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._read(8))[0]
+        mask = self._read(4) if second & 0x80 else None
+        payload = self._read(length)
+        if mask is not None:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return bool(first & 0x80), opcode, payload
+
+    def __iter__(self):
+        fragments = []
+        try:
+            while not self.closed:
+                fin, opcode, payload = self._frame()
+                if opcode == 0x8:
+                    self._write(0x8, payload[:2])
+                    return
+                if opcode == 0x9:
+                    self._write(0xA, payload)
+                    continue
+                if opcode in (0x0, 0x1, 0x2):
+                    fragments.append(payload)
+                    if fin:
+                        message = b"".join(fragments)
+                        fragments = []
+                        yield message.decode("utf-8")
+        except (EOFError, OSError, ValueError):
+            return
+        finally:
+            self.closed = True
+
+    def _write(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([length])
+        elif length < 65536:
+            header += bytes([126]) + struct.pack("!H", length)
+        else:
+            header += bytes([127]) + struct.pack("!Q", length)
+        with self._lock:
+            try:
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                self.closed = True
+
+    def send(self, message):
+        if not self.closed:
+            self._write(0x1, message.encode("utf-8"))
+
+    def close(self):
+        if not self.closed:
+            self._write(0x8, struct.pack("!H", 1000))
+            self.closed = True
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Scenarios.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+Benchmark scenarios, run against a MockBroker. Each scenario returns
+a dict of measures; sizes are given by the params of each scenario.
+"""
+
+from ..SEPA import SEPA
+from ..SAPObject import SAPObject
+from .MockBroker import MockBroker
+
+from threading import Condition
+from time import monotonic, perf_counter, sleep
+
+import logging
+
+NAMESPACES = {"bench": "http://bench.org/"}
+
+QUERIES = {
+    "READINGS": {
+        "sparql": "select * where {?sensor bench:value ?value}"},
+    "SENSOR": {
+        "sparql": "select ?value where {?sensor bench:value ?value}",
+        "forcedBindings": {"sensor": {"type": "uri", "value": ""}}}}
+
+UPDATES = {
+    "INSERT_READING": {
+        "sparql": "insert data {?sensor bench:value ?value}",
+        "forcedBindings": {
+            "sensor": {"type": "uri", "value": ""},
+            "value": {"type": "literal", "value": ""}}}}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def latencies(samples):
+    """
+    Summary, in milliseconds, of the 'samples' in seconds.
+    """
+    return {
+        "mean_ms": 1000 * sum(samples) / len(samples),
+        "p50_ms": 1000 * percentile(samples, 0.5),
+        "p95_ms": 1000 * percentile(samples, 0.95),
+        "p99_ms": 1000 * percentile(samples, 0.99)}
+
+
+class Waiter:
+    """
+    Counts the notifications received, to wait for a number of them.
+    """
+    def __init__(self):
+        self.count = 0
+        self._condition = Condition()
+
+    def __call__(self, added, removed):
+        with self._condition:
+            self.count += 1
+            self._condition.notify_all()
+
+    def wait(self, count, timeout=60):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.count >= count, timeout):
+                raise TimeoutError("{} of {} notifications received".format(
+                    self.count, count))
+
+
+def closed(broker, timeout=60):
+    """
+    Waits for the client websockets to 'broker' to be closed: they are
+    once all the unsubscriptions are confirmed.
+    """
+    deadline = monotonic() + timeout
+    while broker.connections:
+        if monotonic() > deadline:
+            raise TimeoutError("{} websockets still open".format(len(broker.connections)))
+        sleep(0.01)
+
+
+def client(broker):
+    sap = SAPObject(broker.sap(QUERIES, UPDATES, NAMESPACES), log=logging.ERROR)
+    return SEPA(sap, logLevel=logging.ERROR)
+
+
+def reading(i):
+    return {"sensor": "bench:sensor{}".format(i), "value": str(i)}
+
+
+def sparql_build(iterations=20000):
+    """
+    SPARQL generation from sap entries with forced bindings.
+    """
+    sap = SAPObject({
+        "namespaces": NAMESPACES, "queries": QUERIES, "updates": UPDATES},
+        log=logging.ERROR)
+    start = perf_counter()
+    for i in range(iterations):
+        sap.getUpdate("INSERT_READING", reading(i))
+    updates = perf_counter() - start
+    start = perf_counter()
+    for i in range(iterations):
+        sap.getQuery("SENSOR", {"sensor": "bench:sensor{}".format(i)})
+    queries = perf_counter() - start
+    return {
+        "update_us": 1e6 * updates / iterations,
+        "query_us": 1e6 * queries / iterations}
+
+
+def update_throughput(updates=1000):
+    """
+    Updates per second, sent one by one and batched.
+    """
+    with MockBroker() as broker:
+        sc = client(broker)
+        start = perf_counter()
+        for i in range(updates):
+            sc.update("INSERT_READING", reading(i))
+        single = perf_counter() - start
+        sc.clear()
+        start = perf_counter()
+        sc.update_many("INSERT_READING", [reading(i) for i in range(updates)])
+        batched = perf_counter() - start
+        sc.close()
+    return {
+        "single_per_s": updates / single,
+        "batched_per_s": updates / batched}
+
+
+def query_latency(triples=1000, queries=500):
+    """
+    Latency of queries towards a store of 'triples' readings.
+    """
+    with MockBroker() as broker:
+        sc = client(broker)
+        sc.update_many("INSERT_READING", [reading(i) for i in range(triples)])
+        samples = []
+        for i in range(queries):
+            start = perf_counter()
+            sc.query("SENSOR", {"sensor": "bench:sensor{}".format(i % triples)})
+            samples.append(perf_counter() - start)
+        full = []
+        for i in range(max(1, queries // 50)):
+            start = perf_counter()
+            sc.query("READINGS")
+            full.append(perf_counter() - start)
+        sc.close()
+    result = latencies(samples)
+    result["full_scan_ms"] = 1000 * sum(full) / len(full)
+    return result
+
+
+def subscription_scaling(counts=(1, 10, 50, 100)):
+    """
+    Time to open 'count' subscriptions, and to deliver an update to
+    all of them, for each count.
+    """
+    result = {}
+    for count in counts:
+        with MockBroker() as broker:
+            sc = client(broker)
+            waiter = Waiter()
+            start = perf_counter()
+            subids = [
+                sc.subscribe("READINGS", "readings{}".format(i), handler=waiter)
+                for i in range(count)]
+            subscribe = perf_counter() - start
+            waiter.wait(count)
+            start = perf_counter()
+            sc.update("INSERT_READING", reading(0))
+            waiter.wait(2 * count)
+            fanout = perf_counter() - start
+            for subid in subids:
+                sc.unsubscribe(subid)
+            # closing the websocket while confirmations arrive would
+            # cut them short
+            closed(broker)
+            sc.close()
+        result[str(count)] = {
+            "subscribe_ms": 1000 * subscribe / count,
+            "fanout_ms": 1000 * fanout}
+    return result
+
+
+def notification_fanin(subscriptions=10, updates=200):
+    """
+    Notifications per second received by a client, when 'updates'
+    updates each notify all the 'subscriptions'.
+    """
+    with MockBroker() as broker:
+        sc = client(broker)
+        waiter = Waiter()
+        for i in range(subscriptions):
+            sc.subscribe("READINGS", "readings{}".format(i), handler=waiter)
+        waiter.wait(subscriptions)
+        producer = client(broker)
+        start = perf_counter()
+        for i in range(updates):
+            producer.update("INSERT_READING", reading(i))
+        waiter.wait(subscriptions * (updates + 1))
+        elapsed = perf_counter() - start
+        producer.close()
+        sc.close()
+    return {"notifications_per_s": subscriptions * updates / elapsed}
+
+
+SCENARIOS = {
+    "sparql_build": sparql_build,
+    "update_throughput": update_throughput,
+    "query_latency": query_latency,
+    "subscription_scaling": subscription_scaling,
+    "notification_fanin": notification_fanin}
+
+# reduced sizes, for a quick run
+QUICK = {
+    "sparql_build": {"iterations": 2000},
+    "update_throughput": {"updates": 100},
+    "query_latency": {"triples": 100, "queries": 50},
+    "subscription_scaling": {"counts": (1, 10)},
+    "notification_fanin": {"subscriptions": 5, "updates": 20}}
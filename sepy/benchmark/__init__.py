@@ -0,0 +1,4 @@
+"""
+Benchmarks of the sepy client, against a local stand-in SEPA broker.
+Run them with: python3 -m sepy.benchmark
+"""
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  __main__.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+Runs the benchmarks against a local MockBroker, printing one JSON
+object per scenario:
+
+    python3 -m sepy.benchmark [--quick] [--output results.jsonl] [scenario ...]
+"""
+
+from .. import __version__
+from .Scenarios import SCENARIOS, QUICK
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python3 -m sepy.benchmark")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="scenarios to run (default: all): {}".format(
+                            ", ".join(sorted(SCENARIOS))))
+    parser.add_argument("--quick", action="store_true", help="reduced sizes")
+    parser.add_argument("--output", help="file to append the results to")
+    args = parser.parse_args(args)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenarios: {}".format(", ".join(unknown)))
+
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for name in args.scenarios or sorted(SCENARIOS):
+            params = QUICK[name] if args.quick else {}
+            results = SCENARIOS[name](**params)
+            print(json.dumps({
+                "benchmark": name,
+                "params": params,
+                "results": results,
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "sepy": __version__}), file=output, flush=True)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -26,13 +26,27 @@
 #    \__\__,_|_.__/|_|\__,_/___\___|
 #
 
-import prettytable
+from .Results import BINDINGS_START, iterBindings
+
+from codecs import getincrementaldecoder
+from io import StringIO
+from os.path import isfile
+from unicodedata import east_asian_width, combining
+
 import json
 import re
 import sys
 import argparse
 
-from os.path import isfile
+PREFIX = re.compile(r"(prefix|PREFIX)\s+([a-zA-Z]+):\s+<(.+)>")
+VARS = re.compile(r'"vars"\s*:\s*(\[[^\]]*\])')
+
+# bytes read at a time from json files
+CHUNK_SIZE = 65536
+# rows written to the destination at a time
+WRITE_BATCH = 1000
+# end of the cells cut to a fixed width
+ELLIPSIS = "..."
 
 
 def tablify(input_json, prefix_file=None, destination=sys.stdout):
@@ -60,56 +74,239 @@ def check_table_equivalence(result, expected, prefixes):
     return (ex == table)
 
 
-def main(args):
-    # builds prefix dictionary
+def readPrefixes(prefix_file):
+    """
+    Returns the {prefix: uri} dictionary of 'prefix_file', a path to a
+    file of PREFIX declarations or a list of PREFIX strings.
+    """
     prefixes = {}
-    if ((args["prefixes"] is not None) and (args["prefixes"] != "")):
-        try:
-            # this is when args["prefixes"] is a path to file
-            with open(args["prefixes"], "r") as prefix_file:
-                lines = prefix_file.readlines()
-        except TypeError:
-            # this is when it's a list of strings
-            lines = args["prefixes"]
-            for line in lines:
-                # here we parse the prefixes
-                m = re.match(r"(prefix|PREFIX)\s+([a-zA-Z]+):\s+<(.+)>", line)
-                prefixes[m.groups()[1]] = m.groups()[2]
+    if (prefix_file is None) or (prefix_file == ""):
+        return prefixes
     try:
-        json_output = args["file"]
-        variables = json_output["head"]["vars"]
+        # this is when prefix_file is a path to file
+        with open(prefix_file, "r") as prefix_lines:
+            lines = prefix_lines.readlines()
     except TypeError:
-        # loads the json from a file, or tries from the command line argument
-        if isfile(args["file"]):
-            with open(args["file"], "r") as bz_output:
-                json_output = json.load(bz_output)
+        # this is when it's a list of strings
+        lines = prefix_file
+    for line in lines:
+        m = PREFIX.match(line.strip())
+        if m is not None:
+            prefixes[m.groups()[1]] = m.groups()[2]
+    return prefixes
+
+
+def compilePrefixes(prefixes):
+    """
+    Returns a function replacing, in a single pass, the uris of the
+    'prefixes' dictionary with their prefix: where many uris match,
+    the longest one is used.
+    """
+    if not prefixes:
+        return lambda value: value
+    names = {uri: key + ":" for key, uri in prefixes.items()}
+    pattern = re.compile("|".join(
+        re.escape(uri) for uri in sorted(names, key=len, reverse=True)))
+    replacement = lambda match: names[match.group(0)]
+    return lambda value: pattern.sub(replacement, value)
+
+
+def formatCell(binding, shorten):
+    """
+    Formats a binding as a table cell, as "(type) value"
+    """
+    if binding is None:
+        # special case: absent binding
+        return ""
+    nice_value = binding["value"]
+    if nice_value == "":
+        return ""
+    if binding["type"] != "literal":
+        nice_value = shorten(nice_value)
+    return "({}) {}".format(binding["type"], nice_value)
+
+
+def textWidth(text):
+    """
+    The width of 'text' on a terminal, wide characters taking two
+    columns and combining characters none.
+    """
+    if text.isascii():
+        return len(text)
+    width = 0
+    for c in text:
+        if combining(c):
+            continue
+        width += 2 if east_asian_width(c) in "WF" else 1
+    return width
+
+
+def center(text, width):
+    # as str.center, counting the columns of text
+    if text.isascii():
+        return text.center(width)
+    pad = width - textWidth(text)
+    left = pad // 2 + (pad & width & 1)
+    return " " * left + text + " " * (pad - left)
+
+
+def truncate(text, width):
+    if textWidth(text) <= width:
+        return text
+    width -= len(ELLIPSIS)
+    if text.isascii():
+        return text[:width] + ELLIPSIS
+    while textWidth(text) > width:
+        text = text[:-1]
+    return text + ELLIPSIS
+
+
+class TableWriter:
+    """
+    Writes a table row by row, in the format of prettytable, given the
+    width of each column. Longer cells are cut to the column width.
+    """
+    def __init__(self, variables, widths, destination):
+        self.variables = variables
+        self.widths = widths
+        self.destination = destination
+        self.border = "+" + "+".join("-" * (w + 2) for w in self.widths) + "+\n"
+        self.count = 0
+        self._lines = []
+
+    def _add(self, cells):
+        if not any("\n" in cell for cell in cells):
+            self._lines.append("| " + " | ".join(
+                center(truncate(cell, width), width)
+                for cell, width in zip(cells, self.widths)) + " |\n")
+            return
+        cells = [cell.split("\n") for cell in cells]
+        for i in range(max(len(lines) for lines in cells)):
+            self._lines.append("| " + " | ".join(
+                center(truncate(lines[i], width) if i < len(lines) else "", width)
+                for lines, width in zip(cells, self.widths)) + " |\n")
+
+    def header(self):
+        self._lines.append(self.border)
+        self._add(self.variables)
+        self._lines.append(self.border)
+        self.flush()
+
+    def row(self, cells):
+        self._add(cells)
+        self.count += 1
+        if self.count % WRITE_BATCH == 0:
+            self.flush()
+
+    def footer(self):
+        self._lines.append(self.border)
+        self._lines.append("{} result(s)\n".format(self.count))
+        self.flush()
+
+    def flush(self):
+        self.destination.write("".join(self._lines))
+        self._lines = []
+
+
+def cellWidth(cell):
+    return max(textWidth(line) for line in cell.split("\n"))
+
+
+def openResults(input_json):
+    """
+    Returns the variables of a SPARQL JSON result, and a function giving
+    an iterator over its bindings each time it is called.
+    input_json is given as in tablify; json files are parsed
+    incrementally, 'stdin' reads the standard input.
+    """
+    if isinstance(input_json, dict):
+        json_output = input_json
+    elif input_json == "stdin":
+        json_output = json.load(sys.stdin)
+    elif isfile(input_json):
+        variables = _fileVariables(input_json)
+        if variables is not None:
+            def bindings():
+                with open(input_json, "rb") as results:
+                    yield from iterBindings(iter(lambda: results.read(CHUNK_SIZE), b""))
+            return variables, bindings
+        with open(input_json, "r") as results:
+            json_output = json.load(results)
+    else:
+        json_output = json.loads(input_json)
+    return (json_output["head"]["vars"],
+            lambda: iter(json_output["results"]["bindings"]))
+
+
+def _fileVariables(path):
+    # the vars of a json results file, if they come before its bindings
+    head = ""
+    utf8 = getincrementaldecoder("utf-8")()
+    with open(path, "rb") as results:
+        match = None
+        while match is None:
+            chunk = results.read(CHUNK_SIZE)
+            if not chunk:
+                return None
+            head += utf8.decode(chunk)
+            match = BINDINGS_START.search(head)
+    m = VARS.search(head, 0, match.start())
+    return None if m is None else json.loads(m.group(1))
+
+
+def stream(input_json, prefix_file=None, destination=sys.stdout,
+           width=None, sample=None):
+    """
+    Writes the table of input_json (as in tablify) to destination row
+    by row, and returns the number of rows. The column widths are
+    - the same 'width' for all the columns, when given, or a list of
+      widths, one per variable;
+    - computed on the first 'sample' rows, if given;
+    - computed in a first pass on all the rows, otherwise: json files
+      are read twice, and never loaded as a whole.
+    With 'width' or 'sample', longer cells are cut.
+    """
+    shorten = compilePrefixes(readPrefixes(prefix_file))
+    variables, bindings = openResults(input_json)
+
+    def rows():
+        for binding in bindings():
+            yield [formatCell(binding.get(v), shorten) for v in variables]
+
+    buffered = []
+    if width is not None:
+        widths = [width] * len(variables) if isinstance(width, int) else list(width)
+        widths = [max(w, len(ELLIPSIS)) for w in widths]
+        table = rows()
+    else:
+        widths = [cellWidth(v) for v in variables]
+        table = rows()
+        if sample is not None:
+            for cells in table:
+                buffered.append(cells)
+                if len(buffered) >= sample:
+                    break
+            measured = buffered
         else:
-            json_output = json.loads(json.dumps(args["file"]))
-        variables = json_output["head"]["vars"]
-    
-    # setup the table which will be given in output
-    pretty = prettytable.PrettyTable(variables)
-    
-    # fills up the table: one line per binding
-    for binding in json_output["results"]["bindings"]:
-        tableLine = []
-        for v in variables:
-            if v in binding:
-                nice_value = binding[v]["value"]
-                if binding[v]["type"] != "literal":
-                    for key in prefixes.keys():
-                        # prefix substitution
-                        nice_value = nice_value.replace(prefixes[key], key+":")
-                if nice_value != "":
-                    tableLine.append("({}) {}".format(binding[v]["type"],
-                                     nice_value))
-                else:
-                    tableLine.append("")
-            else:
-                # special case: absent binding
-                tableLine.append("")
-        pretty.add_row(tableLine)
-    output = str(pretty) + "\n{} result(s)".format(len(json_output["results"]["bindings"]))
+            measured, table = table, rows()
+        for cells in measured:
+            widths = [max(w, cellWidth(cell)) for w, cell in zip(widths, cells)]
+
+    writer = TableWriter(variables, widths, destination)
+    writer.header()
+    for cells in buffered:
+        writer.row(cells)
+    for cells in table:
+        writer.row(cells)
+    writer.footer()
+    return writer.count
+
+
+def main(args):
+    output = StringIO()
+    stream(args["file"], prefix_file=args["prefixes"], destination=output)
+    # the table without the final newline
+    output = output.getvalue()[:-1]
     if args["destination"] is not None:
         print(output, file=args["destination"])
     return output
@@ -124,5 +321,12 @@ if __name__ == '__main__':
     parser.add_argument(
         "-prefixes", default="",
         help="Optional file containing prefixes to be replaced into the table")
-    args = vars(parser.parse_args())
-    sys.exit(main(args))
+    parser.add_argument(
+        "-width", type=int, default=None,
+        help="Optional fixed width of the columns: longer cells are cut")
+    parser.add_argument(
+        "-sample", type=int, default=None,
+        help="Optional number of rows the column widths are computed on")
+    args = parser.parse_args()
+    stream(args.file, prefix_file=args.prefixes, destination=sys.stdout,
+           width=args.width, sample=args.sample)
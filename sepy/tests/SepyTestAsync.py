@@ -0,0 +1,145 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestAsync.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from importlib.util import find_spec
+
+import unittest
+
+import asyncio
+import logging
+import warnings
+from sepy.Exceptions import SubscriptionFailedException
+from sepy.SAPObject import SAPObject
+from sepy.benchmark.MockBroker import MockBroker
+from sepy.benchmark.Scenarios import QUERIES, UPDATES, NAMESPACES
+
+
+@unittest.skipUnless(find_spec("aiohttp"), "aiohttp is not installed")
+class SepyTestAsync(unittest.IsolatedAsyncioTestCase):
+    """
+    AsyncSEPA tests against the local MockBroker.
+    """
+    def setUp(self):
+        self.broker = MockBroker().start()
+        self.sap = SAPObject(
+            self.broker.sap(QUERIES, UPDATES, NAMESPACES), log=logging.ERROR)
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def client(self):
+        from sepy.AsyncSEPA import AsyncSEPA
+        return AsyncSEPA(self.sap, logLevel=logging.ERROR)
+
+    async def test_0(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", DeprecationWarning)
+            async with self.client() as sc:
+                await sc.update("INSERT_READING", {"sensor": "bench:s1", "value": "1"})
+                await sc.update("INSERT_READING", {"sensor": "bench:s2", "value": "2"})
+                results = await sc.query("SENSOR", {"sensor": "bench:s2"})
+                self.assertEqual(results["results"]["bindings"],
+                                 [{"value": {"type": "literal", "value": "2"}}])
+                results = await sc.query("READINGS")
+                self.assertEqual(len(results["results"]["bindings"]), 2)
+                await sc.clear()
+                results = await sc.query_all()
+                self.assertEqual(results["results"]["bindings"], [])
+
+    async def test_1(self):
+        notifications = asyncio.Queue()
+
+        async def handler(added, removed):
+            await notifications.put((added, removed))
+
+        async with self.client() as sc:
+            subid = await sc.subscribe("READINGS", "readings", handler=handler)
+            self.assertIn(subid, sc.get_subscriptions())
+            self.assertEqual(
+                await asyncio.wait_for(notifications.get(), 10), ([], []))
+            await sc.update("INSERT_READING", {"sensor": "bench:s1", "value": "1"})
+            added, removed = await asyncio.wait_for(notifications.get(), 10)
+            self.assertEqual(added[0]["value"]["value"], "1")
+            self.assertEqual(removed, [])
+            socket = sc.connectionManager._sockets[self.sap.subscribe_url]
+            await sc.unsubscribe(subid)
+            self.assertEqual(sc.get_subscriptions(), {})
+            # the websocket is closed once the unsubscription is confirmed
+            await asyncio.wait_for(socket.reader, 10)
+            self.assertEqual(self.broker.subscriptions, {})
+            self.assertTrue(notifications.empty())
+
+    async def test_2(self):
+        # the subscriptions share one websocket, closed after the last
+        # unsubscription is confirmed
+        async with self.client() as sc:
+            subids = await asyncio.gather(*[
+                sc.subscribe("READINGS", "readings{}".format(i))
+                for i in range(20)])
+            self.assertEqual(len(set(subids)), 20)
+            self.assertEqual(len(self.broker.connections), 1)
+            manager = sc.connectionManager
+            socket = manager._sockets[self.sap.subscribe_url]
+            for subid in subids:
+                await sc.unsubscribe(subid)
+            await asyncio.wait_for(socket.reader, 10)
+            self.assertEqual(manager._sockets, {})
+            self.assertEqual(socket.unsubscribing, 0)
+            self.assertTrue(socket.ws.closed)
+            self.assertEqual(self.broker.subscriptions, {})
+
+    async def test_3(self):
+        # a subscription refused by SEPA fails at once, and the others
+        # on the same websocket go on
+        notifications = asyncio.Queue()
+        async with self.client() as sc:
+            await sc.subscribe("READINGS", "readings",
+                               handler=lambda a, r: notifications.put_nowait(a))
+            await asyncio.wait_for(notifications.get(), 10)
+            with self.assertRaises(SubscriptionFailedException):
+                await asyncio.wait_for(sc.sparql_subscribe(
+                    "select where", "broken", host=self.sap.subscribe_url), 5)
+            await sc.update("INSERT_READING", {"sensor": "bench:s1", "value": "1"})
+            added = await asyncio.wait_for(notifications.get(), 10)
+            self.assertEqual(added[0]["value"]["value"], "1")
+            self.assertEqual(len(self.broker.connections), 1)
+
+    async def test_4(self):
+        # tokens shorter than the renewal margin are still reused
+        from sepy.AsyncConnectionHandler import AsyncConnectionHandler
+        broker = MockBroker(token_expiry=5).start()
+        self.addCleanup(broker.stop)
+        sap = SAPObject(broker.sap(), log=logging.ERROR)
+        handler = AsyncConnectionHandler(logLevel=logging.ERROR)
+        try:
+            for _ in range(10):
+                status, _ = await handler.secureRequest(
+                    sap.query_url, "select * where {?a ?b ?c}", True,
+                    sap.registration_url, sap.tokenRequest_url)
+                self.assertEqual(status, 200)
+        finally:
+            await handler.close()
+        self.assertEqual(broker.requests["/oauth/token"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
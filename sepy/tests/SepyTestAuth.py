@@ -0,0 +1,167 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestAuth.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+
+import unittest
+
+import json
+import logging
+import os
+import stat
+from sepy.ConnectionHandler import ConnectionHandler
+from sepy.Exceptions import TokenExpiredException
+from sepy.SAPObject import SAPObject
+from sepy.benchmark.MockBroker import MockBroker
+
+QUERY = "select * where {?a ?b ?c}"
+
+
+class SepyTestAuth(unittest.TestCase):
+    """
+    Registration, JWT handling and secure requests, against the local
+    MockBroker.
+    """
+    def setUp(self):
+        self.broker = self.start()
+
+    def start(self, **kwargs):
+        broker = MockBroker(**kwargs).start()
+        self.addCleanup(broker.stop)
+        return broker
+
+    def handler(self, **kwargs):
+        kwargs.setdefault("token_refresh", False)
+        handler = ConnectionHandler(logLevel=logging.ERROR, **kwargs)
+        self.addCleanup(handler.close)
+        return handler
+
+    def request(self, handler, broker=None):
+        sap = SAPObject((broker or self.broker).sap(), log=logging.ERROR)
+        return handler.secureRequest(
+            sap.query_url, QUERY, True, sap.registration_url, sap.tokenRequest_url)
+
+    def test_0(self):
+        # a refused token is renewed, and the request sent again once
+        handler = self.handler()
+        self.assertEqual(self.request(handler)[0], 200)
+        token = handler.token
+        self.broker.revoke()
+        self.assertEqual(self.request(handler)[0], 200)
+        self.assertNotEqual(handler.token, token)
+        requests = self.broker.requests
+        self.assertEqual((requests["/query"], requests["/oauth/token"], requests["/oauth/register"]),
+                         (3, 2, 1))
+
+    def test_1(self):
+        # ... but only once
+        handler = self.handler()
+        self.broker.authorized = lambda authorization: False
+        self.assertRaises(TokenExpiredException, self.request, handler)
+        self.assertIsNone(handler.token)
+        self.assertEqual(self.broker.requests["/query"], 2)
+
+    def test_2(self):
+        # concurrent requests wait for a single registration and token
+        handler = self.handler()
+
+        def run(results):
+            threads = [Thread(target=lambda: results.append(self.request(handler)[0]))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+
+        results = []
+        run(results)
+        self.assertEqual(results, [200] * 8)
+        self.assertEqual(self.broker.requests["/oauth/register"], 1)
+        self.assertEqual(self.broker.requests["/oauth/token"], 1)
+        # and for a single renewal of the refused token
+        self.broker.revoke()
+        results = []
+        run(results)
+        self.assertEqual(results, [200] * 8)
+        self.assertEqual(self.broker.requests["/oauth/token"], 2)
+
+    def test_3(self):
+        # client credentials are stored, readable by the user only, and
+        # reused by the next handler
+        with TemporaryDirectory() as directory:
+            path = join(directory, "credentials.json")
+            first = self.handler(credentials_file=path)
+            self.request(first)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            with open(path) as credentials:
+                self.assertEqual(json.load(credentials)["client_id"], first.client_id)
+
+            second = self.handler(credentials_file=path)
+            self.assertEqual(second.client_id, first.client_id)
+            self.assertEqual(self.request(second)[0], 200)
+            self.assertEqual(self.broker.requests["/oauth/register"], 1)
+            self.assertEqual(self.broker.requests["/oauth/token"], 2)
+
+            # credentials unknown to the broker: the client registers again
+            broker = self.start()
+            third = self.handler(credentials_file=path)
+            self.assertEqual(self.request(third, broker)[0], 200)
+            self.assertEqual(broker.requests["/oauth/register"], 1)
+            with open(path) as credentials:
+                self.assertEqual(json.load(credentials)["client_secret"], third.client_secret)
+
+    def test_4(self):
+        # the token is renewed in background before it expires
+        broker = self.start(token_expiry=2)
+        handler = self.handler(token_refresh=True)
+        renewed = Event()
+        requestToken = handler.requestToken
+
+        def renew(tokenURI):
+            requestToken(tokenURI)
+            renewed.set()
+
+        self.request(handler, broker)
+        token = handler.token
+        handler.requestToken = renew
+        self.assertTrue(renewed.wait(timeout=10))
+        self.assertNotEqual(handler.token, token)
+        self.assertEqual(broker.requests["/oauth/token"], 2)
+        # until the handler is closed
+        timer = handler._refresh_timer
+        handler.close()
+        timer.join(timeout=10)
+        self.assertFalse(timer.is_alive())
+        self.assertEqual(broker.requests["/oauth/token"], 2)
+
+    def test_5(self):
+        # tokens shorter than the renewal margin are still reused
+        broker = self.start(token_expiry=5)
+        handler = self.handler()
+        for _ in range(10):
+            self.assertEqual(self.request(handler, broker)[0], 200)
+        self.assertEqual(broker.requests["/oauth/token"], 1)
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
@@ -0,0 +1,106 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestConnectionPool.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from threading import Thread
+
+import unittest
+
+import logging
+from sepy.ConnectionHandler import ConnectionHandler
+from sepy.SAPObject import SAPObject
+from sepy.benchmark.MockBroker import MockBroker
+
+QUERY = "select * where {?a ?b ?c}"
+
+
+class SepyTestConnectionPool(unittest.TestCase):
+    """
+    Keep-alive connection pools, against the local MockBroker.
+    """
+    def start(self):
+        broker = MockBroker().start()
+        self.addCleanup(broker.stop)
+        return SAPObject(broker.sap(), log=logging.ERROR).query_url
+
+    def handler(self, **kwargs):
+        handler = ConnectionHandler(logLevel=logging.ERROR, **kwargs)
+        self.addCleanup(handler.close)
+        return handler
+
+    def prefix(self, url):
+        return url.rsplit("/", 1)[0]
+
+    def age(self, handler, url, seconds):
+        # as if the pool of 'url' had not been used for 'seconds'
+        handler._pools[self.prefix(url)] -= seconds
+
+    def test_0(self):
+        # one pool per host, of 'pool_maxsize' connections
+        first, second = self.start(), self.start()
+        handler = self.handler(pool_maxsize=3)
+        results = []
+        threads = [Thread(target=lambda url=url: results.append(
+                       handler.unsecureRequest(url, QUERY, True)[0]))
+                   for url in (first, second) * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        self.assertEqual(results, [200] * 8)
+        self.assertEqual(sorted(handler._pools), sorted(map(self.prefix, (first, second))))
+        for url in (first, second):
+            adapter = handler.session.get_adapter(url)
+            self.assertEqual(adapter._pool_maxsize, 3)
+            self.assertEqual(adapter.poolmanager.connection_pool_kw["maxsize"], 3)
+            self.assertEqual(handler._inflight[self.prefix(url)], 0)
+
+    def test_1(self):
+        # the idle pool of the requested host is replaced before reuse
+        url = self.start()
+        handler = self.handler(idle_timeout=60)
+        handler.unsecureRequest(url, QUERY, True)
+        adapter = handler.session.get_adapter(url)
+        handler.unsecureRequest(url, QUERY, True)
+        self.assertIs(handler.session.get_adapter(url), adapter)
+        self.age(handler, url, 120)
+        self.assertEqual(handler.unsecureRequest(url, QUERY, True)[0], 200)
+        self.assertIsNot(handler.session.get_adapter(url), adapter)
+        self.assertEqual(len(adapter.poolmanager.pools), 0)
+
+    def test_2(self):
+        # idle pools of other hosts are closed, unless they are in use
+        first, second = self.start(), self.start()
+        handler = self.handler(idle_timeout=60)
+        handler.unsecureRequest(first, QUERY, True)
+        handler.unsecureRequest(second, QUERY, True)
+        self.age(handler, first, 120)
+        handler._inflight[self.prefix(first)] += 1
+        handler.unsecureRequest(second, QUERY, True)
+        self.assertIn(self.prefix(first), handler._pools)
+        handler._inflight[self.prefix(first)] -= 1
+        handler.unsecureRequest(second, QUERY, True)
+        self.assertEqual(list(handler._pools), [self.prefix(second)])
+        self.assertNotIn(self.prefix(first), handler.session.adapters)
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
@@ -0,0 +1,221 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestDispatcher.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import unittest
+
+import random
+import time
+from threading import Condition, Event, Lock, Thread
+from sepy.Dispatcher import (
+    NotificationDispatcher, NotificationCoalescer, BLOCK, DROP_OLDEST, COALESCE)
+
+
+def binding(value):
+    return {"v": {"type": "literal", "value": str(value)}}
+
+
+def notification(value):
+    return [binding(value)], []
+
+
+class GatedHandler:
+    """
+    A handler recording the values it is given, that does not return
+    until the gate is opened.
+    """
+    def __init__(self):
+        self.values = []
+        self.gate = Event()
+        self.started = Event()
+
+    def __call__(self, added, removed):
+        self.started.set()
+        self.gate.wait(timeout=10)
+        self.values.append(
+            ([b["v"]["value"] for b in added], [b["v"]["value"] for b in removed]))
+
+
+class WatchedCondition(Condition):
+    """
+    A Condition telling when somebody waits on it.
+    """
+    def __init__(self):
+        super().__init__()
+        self.waiting = Event()
+
+    def wait(self, timeout=None):
+        self.waiting.set()
+        return super().wait(timeout)
+
+
+class SepyTestDispatcher(unittest.TestCase):
+    """
+    NotificationDispatcher tests, that do not need a SEPA instance.
+    """
+    def setUp(self):
+        self.dispatcher = None
+
+    def tearDown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+
+    def fill(self, overflow, notifications=4):
+        # the first notification keeps the handler busy, the others
+        # fill the queue of size 2
+        self.dispatcher = NotificationDispatcher(max_queue=2, overflow=overflow)
+        handler = GatedHandler()
+        queue = self.dispatcher.wrap(handler)
+        self.dispatcher.register("sub", queue)
+        queue(*notification(0))
+        self.assertTrue(handler.started.wait(timeout=10))
+        for i in range(1, notifications - 1):
+            queue(*notification(i))
+        return handler, queue
+
+    def drain(self, queue):
+        deadline = time.monotonic() + 10
+        while queue.depth or queue._scheduled:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def endWindow(self, coalescer):
+        timer = coalescer._timer
+        self.assertIsNotNone(timer)
+        timer.join(timeout=10)
+        self.assertFalse(timer.is_alive())
+
+    def test_0(self):
+        # BLOCK: the producer waits for room in the queue
+        handler, queue = self.fill(BLOCK)
+        queue._condition = condition = WatchedCondition()
+        producer = Thread(target=queue, args=notification(3))
+        producer.start()
+        self.assertTrue(condition.waiting.wait(timeout=10))
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(queue.depth, 2)
+        handler.gate.set()
+        producer.join(timeout=10)
+        self.drain(queue)
+        self.assertEqual(handler.values, [([str(i)], []) for i in range(4)])
+        stats = self.dispatcher.stats()["sub"]
+        self.assertEqual((stats["handled"], stats["dropped"], stats["coalesced"], stats["depth"]),
+                         (4, 0, 0, 0))
+
+    def test_1(self):
+        # DROP_OLDEST: the oldest queued notification is discarded
+        handler, queue = self.fill(DROP_OLDEST)
+        queue(*notification(3))
+        handler.gate.set()
+        self.drain(queue)
+        self.assertEqual(handler.values, [(["0"], []), (["2"], []), (["3"], [])])
+        stats = self.dispatcher.stats()["sub"]
+        self.assertEqual((stats["handled"], stats["dropped"]), (3, 1))
+
+    def test_2(self):
+        # COALESCE: the new notification is merged into the last queued
+        handler, queue = self.fill(COALESCE)
+        queue([binding(3)], [binding(2)])
+        handler.gate.set()
+        self.drain(queue)
+        self.assertEqual(handler.values, [(["0"], []), (["1"], []), (["3"], [])])
+        stats = self.dispatcher.stats()["sub"]
+        self.assertEqual((stats["handled"], stats["coalesced"]), (3, 1))
+
+    def test_3(self):
+        # notifications are handled in order for each subscription, by
+        # one worker at a time, while subscriptions run concurrently
+        self.dispatcher = NotificationDispatcher(workers=4, max_queue=5)
+        received = {}
+        running = {}
+        overlaps = []
+        lock = Lock()
+
+        def handler(subid):
+            def handle(added, removed):
+                with lock:
+                    if running.get(subid):
+                        overlaps.append(subid)
+                    running[subid] = True
+                time.sleep(random.random() * 0.001)
+                received.setdefault(subid, []).append(int(added[0]["v"]["value"]))
+                with lock:
+                    running[subid] = False
+            return handle
+
+        queues = {}
+        for subid in ("a", "b", "c"):
+            queues[subid] = self.dispatcher.wrap(handler(subid))
+            self.dispatcher.register(subid, queues[subid])
+        producers = [
+            Thread(target=lambda q=q: [q(*notification(i)) for i in range(100)])
+            for q in queues.values()]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join(timeout=10)
+        for queue in queues.values():
+            self.drain(queue)
+        self.assertEqual(received, {subid: list(range(100)) for subid in queues})
+        self.assertEqual(overlaps, [])
+        stats = self.dispatcher.stats()
+        self.assertEqual(sorted(stats), ["a", "b", "c"])
+        self.assertTrue(all(s["handled"] == 100 and s["depth"] == 0 for s in stats.values()))
+        self.dispatcher.unregister("a")
+        self.assertEqual(sorted(self.dispatcher.stats()), ["b", "c"])
+
+    def test_4(self):
+        # the coalescer gives the initial results at once, then the net
+        # difference of each window: bindings added and removed within
+        # it never reach the handler
+        handler = GatedHandler()
+        handler.gate.set()
+        coalescer = NotificationCoalescer(handler, 0.1)
+        coalescer(*notification(0))
+        self.assertEqual(handler.values, [(["0"], [])])
+        coalescer([binding(1)], [])
+        coalescer([binding(2)], [binding(1)])
+        coalescer([], [binding(0)])
+        self.assertEqual(len(handler.values), 1)
+        self.endWindow(coalescer)
+        self.assertEqual(handler.values[1:], [(["2"], ["0"])])
+        # a window whose changes cancel out is not notified
+        coalescer([binding(3)], [])
+        coalescer([], [binding(3)])
+        self.endWindow(coalescer)
+        self.assertEqual(len(handler.values), 2)
+        # flush does not wait for the end of the window
+        coalescer([binding(4)], [])
+        coalescer.flush()
+        self.assertEqual(handler.values[2:], [(["4"], [])])
+
+    def test_5(self):
+        # a flush before the initial results does not hold them back
+        handler = GatedHandler()
+        handler.gate.set()
+        coalescer = NotificationCoalescer(handler, 10)
+        coalescer.flush()
+        coalescer(*notification(0))
+        self.assertEqual(handler.values, [(["0"], [])])
+        self.assertIsNone(coalescer._timer)
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
@@ -0,0 +1,62 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestImport.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from os.path import dirname, abspath
+
+import unittest
+
+import json
+import os
+import subprocess
+import sys
+
+# seconds allowed to 'import sepy.SEPA' in a fresh interpreter
+IMPORT_BUDGET = 0.5
+
+# dependencies to be imported only when the feature needing them is used
+LAZY_MODULES = ["requests", "websocket", "jinja2", "pkg_resources", "aiohttp", "numpy"]
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import sepy.SEPA
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+class SepyTestImport(unittest.TestCase):
+    def test_0(self):
+        env = dict(os.environ)
+        root = dirname(dirname(dirname(abspath(__file__))))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+        output = subprocess.run(
+            [sys.executable, "-c", SCRIPT], env=env, check=True,
+            stdout=subprocess.PIPE).stdout
+        result = json.loads(output.decode("utf-8").splitlines()[-1])
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, result["modules"])
+        self.assertLess(result["elapsed"], IMPORT_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
@@ -0,0 +1,99 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestMaterializedView.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import unittest
+
+import logging
+import time
+from sepy.SEPA import SEPA
+from sepy.SAPObject import SAPObject
+from sepy.benchmark.MockBroker import MockBroker
+from sepy.benchmark.Scenarios import QUERIES, UPDATES, NAMESPACES
+
+SENSOR = "http://bench.org/s{}"
+
+
+class SepyTestMaterializedView(unittest.TestCase):
+    """
+    MaterializedView tests, against the local MockBroker.
+    """
+    def setUp(self):
+        self.broker = MockBroker().start()
+        self.sap = SAPObject(
+            self.broker.sap(QUERIES, UPDATES, NAMESPACES), log=logging.ERROR)
+        self.sc = SEPA(self.sap, logLevel=logging.ERROR)
+
+    def tearDown(self):
+        self.sc.close()
+        self.broker.stop()
+
+    def insert(self, i, value):
+        self.sc.update("INSERT_READING", {"sensor": "bench:s{}".format(i), "value": value})
+
+    def delete(self, i, value):
+        self.sc.sparql_update(self.sap.prefix_block() + "delete data {{bench:s{} bench:value '{}'}}".format(i, value))
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condition not met in {}s".format(timeout))
+            time.sleep(0.01)
+
+    def test_0(self):
+        self.insert(1, "10")
+        self.insert(2, "20")
+        notifications = []
+        view = self.sc.materialize(
+            "READINGS", indexes=["sensor"],
+            handler=lambda added, removed: notifications.append((added, removed)))
+        self.assertTrue(view.wait(timeout=10))
+        self.assertEqual(len(view), 2)
+        self.assertEqual(view.get("sensor", SENSOR.format(1), "value"), "10")
+
+        # the view, and its index, follow the notifications
+        self.delete(1, "10")
+        self.insert(1, "11")
+        self.insert(3, "30")
+        self.wait_for(lambda: len(view) == 3 and len(notifications) == 4)
+        self.assertEqual(view.get("sensor", SENSOR.format(1), "value"), "11")
+        self.assertEqual(len(view.lookup("sensor", SENSOR.format(1))), 1)
+        self.assertEqual(view.get("sensor", SENSOR.format(3), "value"), "30")
+        self.delete(2, "20")
+        self.wait_for(lambda: len(view) == 2)
+        self.assertEqual(view.lookup("sensor", SENSOR.format(2)), [])
+        self.assertEqual(view._indexes["sensor"].keys(),
+                         {SENSOR.format(1), SENSOR.format(3)})
+
+        # lookups on variables that are not indexed scan the bindings
+        self.assertEqual(view.get("value", "30", "sensor"), SENSOR.format(3))
+        self.assertIn({"sensor": {"type": "uri", "value": SENSOR.format(3)},
+                       "value": {"type": "literal", "value": "30"}}, view)
+        self.assertEqual(len(view.snapshot()), 2)
+
+        view.close()
+        self.assertEqual(self.sc.get_subscriptions(), {})
+        self.wait_for(lambda: not self.broker.subscriptions)
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
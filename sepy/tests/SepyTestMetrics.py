@@ -0,0 +1,98 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestMetrics.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import current_thread
+
+import unittest
+
+import logging
+from sepy.Dispatcher import NotificationDispatcher
+from sepy.Metrics import Metrics, NULL_METRICS, OPERATIONS_TOTAL
+from sepy.SEPA import SEPA
+from sepy.SAPObject import SAPObject
+from sepy.benchmark.MockBroker import MockBroker
+from sepy.benchmark.Scenarios import QUERIES, UPDATES, NAMESPACES, Waiter
+
+
+class SepyTestMetrics(unittest.TestCase):
+    def test_0(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.count(OPERATIONS_TOTAL, operation="query", status=200)
+        metrics.count(OPERATIONS_TOTAL, operation="query", status=200)
+        metrics.observe("latency", 0.1, operation="query")
+        metrics.observe("latency", 0.5, operation="query")
+        metrics.observe("latency", 5, operation="query")
+        text = metrics.prometheus()
+        self.assertIn('sepy_operations_total{operation="query",status="200"} 2', text)
+        self.assertIn('latency_bucket{le="0.1",operation="query"} 1', text)
+        self.assertIn('latency_bucket{le="1.0",operation="query"} 2', text)
+        self.assertIn('latency_bucket{le="+Inf",operation="query"} 3', text)
+        self.assertIn('latency_count{operation="query"} 3', text)
+
+    def test_1(self):
+        recorded = []
+        metrics = Metrics(callback=lambda *args: recorded.append(args))
+        with metrics.phase("update", "network", endpoint="http://a.org"):
+            pass
+        kind, name, value, labels = recorded[0]
+        self.assertEqual(kind, "histogram")
+        self.assertEqual(labels["phase"], "network")
+        with NULL_METRICS.phase("update", "network"):
+            pass
+
+    def test_2(self):
+        # phases of the operations towards the local MockBroker: with a
+        # dispatcher, handlers are timed on its workers
+        broker = MockBroker().start()
+        self.addCleanup(broker.stop)
+        sap = SAPObject(broker.sap(QUERIES, UPDATES, NAMESPACES), log=logging.ERROR)
+        phases = []
+
+        def callback(kind, name, value, labels):
+            if "phase" in labels:
+                phases.append((labels["operation"], labels["phase"], current_thread().name))
+
+        dispatcher = NotificationDispatcher()
+        sc = SEPA(sap, logLevel=logging.ERROR, dispatcher=dispatcher,
+                  metrics=Metrics(callback=callback))
+        self.addCleanup(dispatcher.close)
+        self.addCleanup(sc.close)
+        waiter = Waiter()
+        sc.subscribe("READINGS", "readings", handler=waiter)
+        waiter.wait(1, timeout=10)
+        with TemporaryDirectory() as directory:
+            sc.query("READINGS", destination=join(directory, "results.json"))
+        # the handlers are over
+        dispatcher.close()
+        found = {(operation, phase) for operation, phase, _ in phases}
+        for phase in (("subscribe", "serialize"), ("query", "serialize"),
+                      ("notification", "enqueue"), ("notification", "handler")):
+            self.assertIn(phase, found)
+        self.assertTrue(all(thread.startswith("sepy-dispatcher")
+                            for operation, phase, thread in phases
+                            if (operation, phase) == ("notification", "handler")))
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
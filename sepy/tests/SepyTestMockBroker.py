@@ -0,0 +1,248 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestMockBroker.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import unittest
+
+import json
+import logging
+import time
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from sepy.SEPA import SEPA, joinUpdates, splitUpdates, splitDataset, pageQuery
+from sepy.Exceptions import SubscriptionFailedException
+from sepy.UpdateBuffer import UpdateBuffer
+from sepy.QueryCache import QueryCache
+from sepy.SAPObject import SAPObject
+from sepy.benchmark.MockBroker import MockBroker
+from sepy.benchmark.Scenarios import QUERIES, UPDATES, NAMESPACES, Waiter
+
+
+class SepyTestMockBroker(unittest.TestCase):
+    """
+    SEPA client tests against the local MockBroker.
+    """
+    def setUp(self):
+        self.broker = MockBroker().start()
+        self.sap = SAPObject(
+            self.broker.sap(QUERIES, UPDATES, NAMESPACES), log=logging.ERROR)
+        self.sc = SEPA(self.sap, logLevel=logging.ERROR)
+
+    def tearDown(self):
+        self.sc.close()
+        self.broker.stop()
+
+    def test_0(self):
+        self.sc.update("INSERT_READING", {"sensor": "bench:s1", "value": "1"})
+        self.sc.update_many("INSERT_READING", [
+            {"sensor": "bench:s2", "value": "2"},
+            {"sensor": "bench:s3", "value": "3"}])
+        results = self.sc.query("SENSOR", {"sensor": "bench:s2"})
+        self.assertEqual(results["results"]["bindings"],
+                         [{"value": {"type": "literal", "value": "2"}}])
+        self.assertEqual(len(self.sc.query("READINGS")["results"]["bindings"]), 3)
+        self.sc.clear()
+        self.assertEqual(self.sc.query_all()["results"]["bindings"], [])
+
+    def test_1(self):
+        notifications = []
+        waiter = Waiter()
+
+        def handler(added, removed):
+            notifications.append((added, removed))
+            waiter(added, removed)
+
+        subid = self.sc.subscribe("READINGS", "readings", handler=handler)
+        waiter.wait(1, timeout=10)
+        self.sc.update("INSERT_READING", {"sensor": "bench:s1", "value": "1"})
+        waiter.wait(2, timeout=10)
+        self.assertEqual(notifications[0], ([], []))
+        self.assertEqual(notifications[1][0][0]["value"]["value"], "1")
+        self.sc.unsubscribe(subid)
+
+    def test_2(self):
+        handler = self.sc.connectionManager
+        handler.register(self.sap.registration_url)
+        handler.requestToken(self.sap.tokenRequest_url)
+        self.assertIsNotNone(handler.token)
+
+    def test_3(self):
+        # a subscription refused by the broker fails at once, and the
+        # shared websocket keeps serving the others
+        waiter = Waiter()
+        self.sc.subscribe("READINGS", "first", handler=waiter)
+        other = Thread(target=self.sc.subscribe, args=("READINGS", "second"),
+                       kwargs={"handler": waiter})
+        start = time.monotonic()
+        other.start()
+        self.assertRaises(
+            SubscriptionFailedException, self.sc.sparql_subscribe,
+            "select where", "broken", host=self.sap.subscribe_url)
+        other.join(timeout=10)
+        self.assertLess(time.monotonic() - start, 5)
+        waiter.wait(2, timeout=10)
+        self.sc.update("INSERT_READING", {"sensor": "bench:s1", "value": "1"})
+        waiter.wait(4, timeout=10)
+
+    def test_4(self):
+        # the shared websocket is closed after the last unsubscription
+        # is confirmed
+        subids = [self.sc.subscribe("READINGS", "readings{}".format(i))
+                  for i in range(20)]
+        manager = self.sc.connectionManager
+        socket = manager._sockets[self.sap.subscribe_url]
+        with self.assertNoLogs("websocket", logging.ERROR):
+            for subid in subids:
+                self.sc.unsubscribe(subid)
+            socket.thread.join(timeout=10)
+        self.assertFalse(socket.thread.is_alive())
+        self.assertEqual(manager._sockets, {})
+        self.assertEqual(socket.unsubscribing, 0)
+        self.assertEqual(self.broker.subscriptions, {})
+
+    def test_5(self):
+        # the whole response is written to the destination, wherever
+        # the chunks end
+        self.sc.update_many("INSERT_READING", [
+            {"sensor": "bench:s{}".format(i), "value": str(i)} for i in range(3)])
+        sparql = self.sap.getQuery("READINGS")
+        expected = self.sc.sparql_query(sparql)
+        with TemporaryDirectory() as directory:
+            path = join(directory, "results.json")
+            for chunk_size in (1, 2, 5, 10, 19, 31, 4096):
+                bindings = list(self.sc.sparql_query_iter(
+                    sparql, destination=path, chunk_size=chunk_size))
+                self.assertEqual(bindings, expected["results"]["bindings"])
+                with open(path) as results:
+                    self.assertEqual(json.load(results), expected)
+
+    def test_6(self):
+        with UpdateBuffer(self.sc, max_batch=10, max_latency=0.01) as buffer:
+            futures = [
+                buffer.put_update("INSERT_READING", {"sensor": "bench:s{}".format(i), "value": str(i)})
+                for i in range(25)]
+            self.assertTrue(buffer.flush(timeout=10))
+            self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(len(self.sc.query("READINGS")["results"]["bindings"]), 25)
+        # a closed buffer refuses updates and flushes, instead of blocking
+        self.assertRaises(ValueError, buffer.flush)
+        self.assertRaises(ValueError, buffer.put, "insert data {}")
+
+    def test_7(self):
+        # paged reads do not go through the query cache
+        sc = SEPA(self.sap, logLevel=logging.ERROR,
+                  query_cache=QueryCache(live=True))
+        sc.update_many("INSERT_READING", [
+            {"sensor": "bench:s{}".format(i), "value": str(i)} for i in range(10)])
+        pages = list(sc.query_pages("READINGS", page_size=3))
+        self.assertEqual(sum(len(results["results"]["bindings"]) for _, results in pages), 10)
+        self.assertEqual(sc.get_subscriptions(), {})
+        self.assertEqual(len(sc.query_cache), 0)
+        # nor do fanned-out ones, unless asked to
+        results = sc.query_many(["READINGS"] * 5)
+        self.assertEqual([len(r["results"]["bindings"]) for r in results], [10] * 5)
+        self.assertEqual(sc.get_subscriptions(), {})
+        sc.query_many(["READINGS"], cache=True)
+        self.assertEqual(len(sc.get_subscriptions()), 1)
+        sc.close()
+
+    def test_8(self):
+        # batches are split at max_payload bytes, in order; an update
+        # longer than that is sent alone
+        prologue = self.sap.prefix_block().strip()
+        sparqls = ["insert data {{bench:s{} bench:value '{}'}}".format(i, "x" * i)
+                   for i in range(40)]
+        for max_payload in (100, 200, 500):
+            requests = list(joinUpdates(sparqls, prologue, max_payload))
+            batches = list(splitUpdates(sparqls, prologue, max_payload))
+            self.assertEqual(sum(batches, []), sparqls)
+            for request, batch in zip(requests, batches):
+                self.assertTrue(len(request.encode("utf-8")) <= max_payload or len(batch) == 1)
+        long = "insert data {bench:s bench:value '" + "y" * 200 + "'}"
+        self.assertEqual(list(splitUpdates(sparqls[:2] + [long] + sparqls[:1], prologue, 150)),
+                         [sparqls[:2], [long], sparqls[:1]])
+
+        results = self.sc.update_many(
+            "INSERT_READING",
+            [{"sensor": "bench:s{}".format(i), "value": str(i)} for i in range(50)],
+            max_payload=500)
+        self.assertGreater(len(results), 1)
+        self.assertEqual(self.broker.requests["/update"], len(results))
+        self.assertEqual(len(self.sc.query("READINGS")["results"]["bindings"]), 50)
+
+    def test_9(self):
+        # a handler can subscribe to the url of its own websocket
+        nested = []
+        subscribed = Event()
+        waiter = Waiter()
+
+        def handler(added, removed):
+            if not subscribed.is_set():
+                start = time.monotonic()
+                subid = self.sc.subscribe("READINGS", "nested", handler=waiter)
+                nested.extend([subid, time.monotonic() - start])
+                subscribed.set()
+
+        self.sc.subscribe("READINGS", "readings", handler=handler)
+        self.assertTrue(subscribed.wait(timeout=20))
+        self.assertLess(nested[1], 5)
+        waiter.wait(1, timeout=10)
+        self.sc.update("INSERT_READING", {"sensor": "bench:s1", "value": "1"})
+        waiter.wait(2, timeout=10)
+        self.sc.unsubscribe(nested[0])
+
+    def test_10(self):
+        # a batch that cannot be built fails its futures, and the buffer
+        # goes on with the next ones
+        get_namespaces = self.sap.get_namespaces
+
+        def broken(stringList=False):
+            raise RuntimeError("broken sap")
+
+        with UpdateBuffer(self.sc, max_latency=0.01) as buffer:
+            self.sap.get_namespaces = broken
+            future = buffer.put_update("INSERT_READING", {"sensor": "bench:s1", "value": "1"})
+            self.assertIsInstance(future.exception(timeout=10), RuntimeError)
+            self.sap.get_namespaces = get_namespaces
+            future = buffer.put_update("INSERT_READING", {"sensor": "bench:s2", "value": "2"})
+            future.result(timeout=10)
+        self.assertEqual(len(self.sc.query("READINGS")["results"]["bindings"]), 1)
+
+    def test_11(self):
+        # the dataset clauses of a paged query stay out of the subquery
+        dataset, body = splitDataset(
+            "SELECT ?s (COUNT(?o) AS ?from) FROM <http://g> FROM NAMED bench:h "
+            "WHERE { GRAPH ?g { ?s ?p ?o } } GROUP BY ?s")
+        self.assertEqual(dataset, "FROM <http://g> FROM NAMED bench:h")
+        self.assertEqual(
+            " ".join(pageQuery("", dataset, body, ["s"], 10, 20).split()),
+            "SELECT * FROM <http://g> FROM NAMED bench:h WHERE { SELECT ?s "
+            "(COUNT(?o) AS ?from) WHERE { GRAPH ?g { ?s ?p ?o } } GROUP BY ?s } "
+            "ORDER BY ?s LIMIT 10 OFFSET 20")
+        # queries that are not SELECTs cannot be paged
+        self.assertRaises(ValueError, list, self.sc.sparql_query_pages(
+            "CONSTRUCT { ?a ?b ?c } WHERE { ?a ?b ?c }"))
+        self.assertEqual(self.broker.requests["/query"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
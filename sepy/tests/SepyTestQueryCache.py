@@ -0,0 +1,147 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestQueryCache.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import unittest
+
+import logging
+import time
+from sepy.SEPA import SEPA
+from sepy.SAPObject import SAPObject
+from sepy.QueryCache import QueryCache
+from sepy.benchmark.MockBroker import MockBroker
+from sepy.benchmark.Scenarios import QUERIES, UPDATES, NAMESPACES
+
+
+def results(*values):
+    return {"head": {"vars": ["value"]}, "results": {"bindings": [
+        {"value": {"type": "literal", "value": value}} for value in values]}}
+
+
+def values(results):
+    return sorted(b["value"]["value"] for b in results["results"]["bindings"])
+
+
+class SepyTestQueryCache(unittest.TestCase):
+    """
+    QueryCache tests, against the local MockBroker.
+    """
+    def setUp(self):
+        self.broker = MockBroker().start()
+        self.sap = SAPObject(
+            self.broker.sap(QUERIES, UPDATES, NAMESPACES), log=logging.ERROR)
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def client(self, cache):
+        sc = SEPA(self.sap, logLevel=logging.ERROR, query_cache=cache)
+        self.addCleanup(sc.close)
+        return sc
+
+    def insert(self, sc, i):
+        sc.update("INSERT_READING", {"sensor": "bench:s{}".format(i), "value": str(i)})
+
+    def queries(self):
+        return self.broker.requests["/query"]
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condition not met in {}s".format(timeout))
+            time.sleep(0.01)
+
+    def expire(self, cache):
+        # as if the ttl of every entry had elapsed
+        for entry in cache._entries.values():
+            entry.expires = time.monotonic() - 1
+
+    def test_0(self):
+        # least recently used entries are evicted beyond max_entries
+        cache = QueryCache(max_entries=2)
+        cache.put("h", "a", results("a"), 10)
+        cache.put("h", "b", results("b"), 10)
+        cache.get("h", "a")
+        cache.put("h", "c", results("c"), 10)
+        self.assertIsNone(cache.get("h", "b"))
+        self.assertEqual(values(cache.get("h", "a")), ["a"])
+        self.assertIsNotNone(cache.get("h", "c"))
+        self.assertEqual((len(cache), cache.size), (2, 20))
+
+    def test_1(self):
+        # and beyond max_bytes
+        cache = QueryCache(max_bytes=100)
+        cache.put("h", "a", results("a"), 60)
+        cache.put("h", "b", results("b"), 30)
+        cache.put("h", "c", results("c"), 30)
+        self.assertIsNone(cache.get("h", "a"))
+        self.assertEqual((len(cache), cache.size), (2, 60))
+        cache.put("h", "d", results("d"), 200)
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_2(self):
+        # repeated queries are answered by the cache, until they expire
+        sc = self.client(QueryCache(ttl=60))
+        self.insert(sc, 1)
+        first = sc.query("READINGS")
+        self.assertIs(sc.query("READINGS"), first)
+        self.assertEqual(self.queries(), 1)
+        # bypassing the cache
+        sc.query("READINGS", cache=False)
+        self.assertEqual(self.queries(), 2)
+        self.expire(sc.query_cache)
+        self.insert(sc, 2)
+        self.assertEqual(values(sc.query("READINGS")), ["1", "2"])
+        self.assertEqual(self.queries(), 3)
+
+    def test_3(self):
+        # live entries are patched by the notifications of their
+        # subscription, and never reach SEPA again
+        cache = QueryCache(live=True, ttl=60)
+        sc = self.client(cache)
+        self.insert(sc, 1)
+        self.assertEqual(values(sc.query("READINGS")), ["1"])
+        self.assertEqual(len(sc.get_subscriptions()), 1)
+        self.insert(sc, 2)
+        self.insert(sc, 3)
+        sc.sparql_update(self.sap.prefix_block() + "delete data {bench:s1 bench:value '1'}")
+        self.wait_for(lambda: values(sc.query("READINGS")) == ["2", "3"])
+        # live entries do not expire
+        self.expire(cache)
+        self.assertEqual(values(sc.query("READINGS")), ["2", "3"])
+        self.assertEqual(self.queries(), 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_4(self):
+        # evicted live entries are unsubscribed
+        sc = self.client(QueryCache(live=True, max_entries=1))
+        sc.query("READINGS")
+        sc.query("SENSOR", {"sensor": "bench:s1"})
+        self.assertEqual(len(sc.get_subscriptions()), 1)
+        self.wait_for(lambda: len(self.broker.subscriptions) == 1)
+        sc.query_cache.clear()
+        self.assertEqual(sc.get_subscriptions(), {})
+        self.wait_for(lambda: not self.broker.subscriptions)
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
@@ -0,0 +1,171 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestReconnect.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import unittest
+
+import logging
+import time
+from sepy.SEPA import SEPA
+from sepy.SAPObject import SAPObject
+from sepy.benchmark.MockBroker import MockBroker
+from sepy.benchmark.Scenarios import QUERIES, UPDATES, NAMESPACES, Waiter
+
+
+def values(bindings):
+    return sorted(binding["value"]["value"] for binding in bindings)
+
+
+class Recorder(Waiter):
+    """
+    Keeps the notifications received, as (added values, removed values).
+    """
+    def __init__(self):
+        super().__init__()
+        self.notifications = []
+
+    def __call__(self, added, removed):
+        self.notifications.append((values(added), values(removed)))
+        super().__call__(added, removed)
+
+
+class SepyTestReconnect(unittest.TestCase):
+    """
+    Renewal of the subscriptions whose websocket drops, against the
+    local MockBroker.
+    """
+    def setUp(self):
+        self.broker = MockBroker().start()
+        self.sap = SAPObject(
+            self.broker.sap(QUERIES, UPDATES, NAMESPACES), log=logging.ERROR)
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def client(self, **kwargs):
+        kwargs.setdefault("reconnect", True)
+        sc = SEPA(self.sap, logLevel=logging.CRITICAL, **kwargs)
+        self.addCleanup(sc.close)
+        return sc
+
+    def insert(self, sc, i):
+        sc.update("INSERT_READING", {"sensor": "bench:s{}".format(i), "value": str(i)})
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condition not met in {}s".format(timeout))
+            time.sleep(0.01)
+
+    def test_0(self):
+        # the subscription is renewed with the same id, and its handler
+        # gets the difference between the old and the new results
+        sc = self.client()
+        self.insert(sc, 1)
+        self.insert(sc, 2)
+        recorder = Recorder()
+        subid = sc.subscribe("READINGS", "readings", handler=recorder)
+        recorder.wait(1)
+        self.assertEqual(recorder.notifications, [(["1", "2"], [])])
+        spuid = next(iter(self.broker.subscriptions))
+
+        self.broker.disconnect()
+        self.wait_for(lambda: not self.broker.subscriptions)
+        # changes made while the websocket is down
+        self.insert(sc, 3)
+        sc.sparql_update(
+            self.sap.prefix_block() + "delete data {bench:s1 bench:value '1'}")
+
+        recorder.wait(2)
+        self.assertEqual(recorder.notifications[1], (["3"], ["1"]))
+        self.assertIn(subid, sc.get_subscriptions())
+        self.assertNotEqual(next(iter(self.broker.subscriptions)), spuid)
+
+        # notifications flow again, routed to the same handler
+        self.insert(sc, 4)
+        recorder.wait(3)
+        self.assertEqual(recorder.notifications[2], (["4"], []))
+        sc.unsubscribe(subid)
+        self.wait_for(lambda: not self.broker.subscriptions)
+
+    def test_1(self):
+        # no difference, no notification
+        sc = self.client()
+        self.insert(sc, 1)
+        recorder = Recorder()
+        sc.subscribe("READINGS", "readings", handler=recorder)
+        recorder.wait(1)
+        self.broker.disconnect()
+        self.wait_for(lambda: not self.broker.subscriptions)
+        self.wait_for(lambda: self.broker.subscriptions)
+        self.insert(sc, 2)
+        recorder.wait(2)
+        self.assertEqual(recorder.notifications, [(["1"], []), (["2"], [])])
+
+    def test_2(self):
+        # reconnect=False: a dropped subscription is gone
+        sc = self.client(reconnect=False)
+        recorder = Recorder()
+        subid = sc.subscribe("READINGS", "readings", handler=recorder)
+        recorder.wait(1)
+        socket = sc.connectionManager._sockets[self.sap.subscribe_url]
+        self.broker.disconnect()
+        socket.thread.join(timeout=10)
+        self.assertFalse(socket.thread.is_alive())
+        self.assertNotIn(subid, sc.get_subscriptions())
+        self.insert(sc, 1)
+        self.assertEqual(self.broker.subscriptions, {})
+        self.assertEqual(self.broker.requests["/subscribe"], 1)
+        self.assertEqual(recorder.count, 1)
+
+    def test_3(self):
+        # a subscription removed while it is being renewed is not
+        # created again
+        sc = self.client(max_backoff=0.1)
+        recorder = Recorder()
+        subid = sc.subscribe("READINGS", "readings", handler=recorder)
+        other = Recorder()
+        otherid = sc.subscribe("READINGS", "other", handler=other)
+        recorder.wait(1)
+        other.wait(1)
+        manager = sc.connectionManager
+        subscription = manager._subscriptions[subid]
+        socket = subscription.socket
+        request = subscription.request
+
+        def unsubscribing_request():
+            sc.unsubscribe(subid)
+            return request()
+
+        subscription.request = unsubscribing_request
+        spuid = manager._subscriptions[otherid].spuid
+        self.broker.disconnect()
+        self.wait_for(lambda: (manager._subscriptions[otherid].spuid != spuid)
+                      and (socket.unsubscribing == 0)
+                      and (len(self.broker.subscriptions) == 1))
+        self.assertEqual(list(sc.get_subscriptions()), [otherid])
+        self.insert(sc, 1)
+        other.wait(2)
+        self.assertEqual(recorder.count, 1)
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
@@ -0,0 +1,95 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestResults.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import unittest
+
+import json
+from sepy.Results import iterBindings, mergeNotifications, ColumnarResults, XSD
+
+
+def literal(value):
+    return {"o": {"type": "literal", "value": value}}
+
+
+class SepyTestResults(unittest.TestCase):
+    """
+    Tests on SPARQL results handling, that do not need a SEPA instance.
+    """
+    def test_0(self):
+        # bindings split across chunks, at any point
+        bindings = [literal("caffè {}]".format(i)) for i in range(100)]
+        document = json.dumps(
+            {"head": {"vars": ["o"]}, "results": {"bindings": bindings}},
+            ensure_ascii=False).encode("utf-8")
+        for size in (1, 5, 64, len(document)):
+            chunks = [document[i:i+size] for i in range(0, len(document), size)]
+            self.assertEqual(list(iterBindings(chunks)), bindings)
+
+    def test_1(self):
+        self.assertEqual(
+            list(iterBindings([b'{"head": {"vars": []}, "results": {"bindings": []}}'])),
+            [])
+        with self.assertRaises(ValueError):
+            list(iterBindings([b'{"error": {"message": "wrong query"}}']))
+        with self.assertRaises(ValueError):
+            list(iterBindings([b'{"head": {"vars": ["o"]}, "results": {"bindings": [{"o"']))
+
+    def test_2(self):
+        added, removed = mergeNotifications([
+            ([literal("a"), literal("b")], []),
+            ([], [literal("a"), literal("c")])])
+        self.assertEqual(added, [literal("b")])
+        self.assertEqual(removed, [literal("c")])
+
+    def test_3(self):
+        bindings = [
+            {"s": {"type": "uri", "value": "http://a.org/s"}, "o": literal("1")["o"]},
+            {"s": {"type": "bnode", "value": "b0"},
+             "l": {"type": "literal", "value": "ciao", "xml:lang": "it"}},
+            {"o": {"type": "literal", "value": "1",
+                   "datatype": "http://www.w3.org/2001/XMLSchema#integer"}}]
+        results = ColumnarResults.from_results(
+            {"head": {"vars": ["s", "o"]}, "results": {"bindings": bindings}})
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results.vars, ["s", "o", "l"])
+        self.assertEqual(results.to_results()["results"]["bindings"], bindings)
+        self.assertEqual(results.column("o"), ["1", None, "1"])
+        self.assertNotIn("s", results[2])
+        self.assertEqual(results[1]["l"]["xml:lang"], "it")
+
+    def test_4(self):
+        results = ColumnarResults(bindings=[
+            {"n": {"type": "literal", "value": "3", "datatype": XSD + "integer"},
+             "x": {"type": "literal", "value": "1.5", "datatype": XSD + "double"}},
+            {"x": {"type": "literal", "value": "2", "datatype": XSD + "integer"}}])
+        self.assertEqual(results.kind("n"), "int")
+        self.assertEqual(results.kind("x"), "float")
+        arrays = results.to_arrays()
+        self.assertEqual(list(arrays["n"][0])[:1], [3])
+        self.assertEqual(list(arrays["n"][1]), [0, 1])
+        self.assertEqual(list(arrays["x"][0]), [1.5, 2.0])
+        values, mask = results.to_arrays(dtypes={"x": "str"})["x"]
+        self.assertEqual(values, ["1.5", "2"])
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
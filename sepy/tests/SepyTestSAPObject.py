@@ -0,0 +1,140 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestSAPObject.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from os.path import dirname, join
+from tempfile import TemporaryDirectory
+
+import os
+import unittest
+
+import logging
+from sepy.SAPObject import SAPObject, SAPGenerator, sparqlBuilder
+
+PREFIXES = "PREFIX schema: <http://schema.org> PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> PREFIX test: <http://wot.arces.unibo.it/test#> "
+
+
+class SepyTestSAPObject(unittest.TestCase):
+    """
+    SAPObject tests that do not need a SEPA instance.
+    """
+    def setUp(self):
+        self.ysap = SAPObject.from_file(
+            join(dirname(__file__), "testUnsecure.ysap"), cache_dir=None,
+            log=logging.ERROR)
+
+    def test_0(self):
+        self.assertEqual(
+            self.ysap.getUpdate(
+                "INSERT_VARIABLE_GREETING",
+                forcedBindings={"nome": "test:Fabio", "qualcosa": "Hello"}),
+            PREFIXES + "insert data {test:Fabio test:dice 'Hello'}")
+        self.assertEqual(
+            self.ysap.getUpdate("INSERT_GREETING", prefixes=False),
+            " insert data {test:Francesco test:dice 'Ciao'}")
+
+    def test_1(self):
+        # ?x must not be substituted into ?xy
+        self.assertEqual(
+            sparqlBuilder(
+                "select ?xy where {?x ?p ?xy}",
+                {"x": {"type": "uri", "value": "http://a.org/b"}}),
+            " select ?xy where {<http://a.org/b> ?p ?xy}")
+
+    def test_2(self):
+        self.ysap.update_namespaces("ex", "http://example.org#")
+        self.assertEqual(
+            self.ysap.getUpdate("INSERT_GREETING"),
+            PREFIXES + "PREFIX ex: <http://example.org#> insert data {test:Francesco test:dice 'Ciao'}")
+
+    def test_3(self):
+        # the SAP is not modified by forced bindings
+        self.ysap.getUpdate(
+            "INSERT_VARIABLE_GREETING",
+            forcedBindings={"nome": "test:Fabio", "qualcosa": "Hello"})
+        bindings = self.ysap.updates["INSERT_VARIABLE_GREETING"]["forcedBindings"]
+        self.assertEqual(bindings["nome"]["value"], "")
+        self.assertEqual(bindings["qualcosa"]["value"], "")
+        self.assertRaises(
+            KeyError, self.ysap.getUpdate, "INSERT_VARIABLE_GREETING",
+            forcedBindings={"nome": "test:Fabio"})
+
+    def test_4(self):
+        # compiled templates are reused, until the template file changes
+        generator = SAPGenerator()
+        params = {"host": "localhost",
+                  "sparql11": {"protocol": "http", "port": 8000,
+                               "query": {"path": "/query", "method": "POST", "format": "JSON"},
+                               "update": {"path": "/update", "method": "POST", "format": "JSON"}},
+                  "sparql11se": {"protocol": "ws"},
+                  "queries": {"Q": {"sparql": "select * where {?a ?b ?c}"}}}
+        with TemporaryDirectory() as directory:
+            path = join(directory, "template.sap")
+            with open(path, "w") as template:
+                template.write("host: {{ host_ip_address }}")
+            self.assertIs(generator.template(path), generator.template(path))
+            saps = generator.generate_many(
+                path, [dict(params, host=host) for host in ("a", "b")],
+                destinations=[join(directory, "a.ysap"), join(directory, "b.ysap")])
+            self.assertEqual(saps, ["host: a", "host: b"])
+            with open(join(directory, "b.ysap")) as sap:
+                self.assertEqual(sap.read(), "host: b\n")
+            with open(path, "w") as template:
+                template.write("server: {{ host_ip_address }}")
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(generator.generate(path, **params), "server: localhost")
+
+    def test_5(self):
+        # the parsed sap is cached, and urls follow the sap changes
+        with TemporaryDirectory() as directory:
+            path = join(dirname(__file__), "testUnsecure.ysap")
+            sap = SAPObject.from_file(path, cache_dir=directory, log=logging.ERROR)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            cached = SAPObject.from_file(path, cache_dir=directory, log=logging.ERROR)
+            self.assertEqual(cached.parsed_sap, sap.parsed_sap)
+            self.assertEqual(cached.parsed_sap, self.ysap.parsed_sap)
+        url = sap.query_url
+        sap.parsed_sap["host"] = "example.org"
+        self.assertEqual(sap.query_url, url)
+        sap.invalidate()
+        self.assertNotEqual(sap.query_url, url)
+        self.assertIn("example.org", sap.query_url)
+
+    def test_6(self):
+        # compiled sparqls follow in-place changes of the sap entries
+        self.ysap.getUpdate("INSERT_GREETING", prefixes=False)
+        entry = self.ysap.updates["INSERT_GREETING"]
+        entry["sparql"] = "insert data {test:Luca test:dice 'Ciao'}"
+        self.assertEqual(
+            self.ysap.getUpdate("INSERT_GREETING", prefixes=False),
+            " insert data {test:Luca test:dice 'Ciao'}")
+        entry["forcedBindings"] = {"nome": {"type": "uri", "value": "test:Fabio"}}
+        entry["sparql"] = "insert data {?nome test:dice 'Ciao'}"
+        self.ysap.getUpdate("INSERT_GREETING", prefixes=False)
+        entry["forcedBindings"]["nome"]["value"] = "test:Luca"
+        self.ysap.invalidate()
+        self.assertEqual(
+            self.ysap.getUpdate("INSERT_GREETING", prefixes=False),
+            " insert data {test:Luca test:dice 'Ciao'}")
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
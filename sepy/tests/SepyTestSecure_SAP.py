@@ -29,7 +29,6 @@ from collections import defaultdict
 from urllib.parse import urlparse
 
 import logging
-import yaml
 from sepy.SAPObject import SAPObject, generate, YsapTemplate, defaultdict_to_dict
 from sepy.SEPA import SEPA
 from sepy.tablaze import tablify, check_table_equivalence
@@ -65,8 +64,7 @@ EXPECTED_TABLE_test3b = """+--------------------+-----------------+
 1 result(s)"""
 
 
-with open(resource_filename(__name__, "testSecure.ysap"), "r") as sap_file:
-    ysap = SAPObject(yaml.load(sap_file))
+ysap = SAPObject.from_file(resource_filename(__name__, "testSecure.ysap"))
 engine = SEPA(sapObject=ysap, client_id="TESTSECURE", logLevel=logging.ERROR)
 prefixes = ysap.get_namespaces(stringList=True)
 
@@ -0,0 +1,86 @@
+#!/usr/bin python3
+# -*- coding: utf-8 -*-
+#
+#  SepyTestTablaze.py
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+from io import StringIO
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import unittest
+
+import json
+from sepy.tablaze import tablify, stream
+
+PREFIXES = ["PREFIX ex: <http://ex.org/>", "PREFIX exa: <http://ex.org/a/>"]
+
+RESULTS = {
+    "head": {"vars": ["s", "o"]},
+    "results": {"bindings": [
+        {"s": {"type": "uri", "value": "http://ex.org/a/b"},
+         "o": {"type": "literal", "value": "http://ex.org/c"}},
+        {"s": {"type": "uri", "value": "http://ex.org/d"},
+         "o": {"type": "literal", "value": "日本\nx"}},
+        {"o": {"type": "literal", "value": ""}}]}}
+
+# as printed by prettytable
+TABLE = """+-------------+---------------------------+
+|      s      |             o             |
++-------------+---------------------------+
+| (uri) exa:b | (literal) http://ex.org/c |
+|  (uri) ex:d |       (literal) 日本      |
+|             |             x             |
+|             |                           |
++-------------+---------------------------+
+3 result(s)"""
+
+
+class SepyTestTablaze(unittest.TestCase):
+    """
+    Tests on the tablaze renderer.
+    """
+    def test_0(self):
+        # the longest prefix is used, literals are left as they are
+        self.assertEqual(tablify(RESULTS, PREFIXES, destination=None), TABLE)
+        with TemporaryDirectory() as directory:
+            path = join(directory, "results.json")
+            with open(path, "w") as results:
+                json.dump(RESULTS, results)
+            output = StringIO()
+            self.assertEqual(stream(path, PREFIXES, destination=output), 3)
+            self.assertEqual(output.getvalue(), TABLE + "\n")
+
+    def test_1(self):
+        # fixed widths cut the longer cells
+        output = StringIO()
+        stream(RESULTS, PREFIXES, destination=output, width=8)
+        self.assertEqual(
+            output.getvalue().split("\n")[3], "| (uri)... | (lite... |")
+        # as do the widths computed on the first rows
+        results = {"head": RESULTS["head"],
+                   "results": {"bindings": RESULTS["results"]["bindings"][::-1]}}
+        output = StringIO()
+        stream(results, PREFIXES, destination=output, sample=2)
+        self.assertEqual(
+            output.getvalue().split("\n")[6], "| (uri) e... | (literal) h... |")
+
+
+if __name__ == '__main__':
+    unittest.main(failfast=True)
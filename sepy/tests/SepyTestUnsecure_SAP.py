@@ -67,8 +67,7 @@ EXPECTED_TABLE_test3b = """+--------------------+-----------------+
 class SepyTestUnsecure_SAP(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        with open(resource_filename(__name__, "testUnsecure.ysap"), "r") as sap_file:
-            self.ysap = SAPObject(yaml.load(sap_file))
+        self.ysap = SAPObject.from_file(resource_filename(__name__, "testUnsecure.ysap"))
         self.engine = SEPA(sapObject=self.ysap, logLevel=logging.ERROR)
         self.prefixes = self.ysap.get_namespaces(stringList=True)
         
@@ -17,9 +17,13 @@ setuptools.setup(name='sepy',
       install_requires=[
           "websocket-client",
           "argparse",
-          "prettytable",
           "pyyaml",
           "jinja2"
       ],
+      extras_require={
+          "async": ["aiohttp"],
+          "fast": ["orjson"],
+          "numpy": ["numpy"]
+      },
       include_package_data=True,
       zip_safe=False)